@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- contention benchmark
+#
+# Measures how long 'display_message' calls are blocked in the message
+# handler while its worker displays messages. The notification daemon is
+# replaced by stand-ins whose display takes a configurable time, so that a
+# slow daemon can be simulated. Half of the messages (by default) append to
+# the previous one, so that they revise the visible message.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from argparse import ArgumentParser
+
+from random import random
+
+from threading import Condition, Timer
+
+from time import perf_counter, sleep
+
+from pynoter.server.message_handler import MessageHandler
+
+
+class Handler:
+    """
+    Minimal stand-in for a client handler.
+    """
+    id = "bench_handler"
+    program_name = "bench"
+
+
+class Message:
+    """
+    Minimal stand-in for a message whose display takes some time.
+    """
+
+    def __init__(self, number, reference, append, display_time, visible_time):
+        self.id = "message_{}".format(number)
+        self.reference = reference
+        self.client = "bench_client"
+        self.subject = "Benchmark"
+        self.body = "Message {}".format(number)
+        self.icon = ""
+        self.timeout = int(visible_time * 1000)
+        self.appends = append
+        self.updates = False
+        self.closed_reason = None
+
+        self._display_time = display_time
+        self._visible_time = visible_time
+        self._listeners = []
+        self._condition = Condition()
+
+    def _set_closed(self, reason):
+        with self._condition:
+            if self.closed_reason is not None:
+                return
+
+            self.closed_reason = reason
+            listeners, self._listeners = self._listeners, []
+
+            self._condition.notify_all()
+
+        for listener in listeners:
+            listener(self, reason == 1)
+
+    @property
+    def closed(self):
+        return self.closed_reason is not None
+
+    def close(self):
+        self._set_closed(3)
+        return True
+
+    def discard(self):
+        self._set_closed(3)
+
+    def display(self, use_flags = True):
+        # Simulate the round trip to the notification daemon.
+        sleep(self._display_time)
+
+        Timer(self._visible_time, self._set_closed, (1,)).start()
+
+        return True
+
+    def wait_for_closed(self):
+        with self._condition:
+            if self.closed_reason is None:
+                self._condition.wait(self._visible_time)
+
+        return self.closed_reason == 1
+
+    def notify_if_closed(self, callback):
+        with self._condition:
+            if self.closed_reason is None:
+                self._listeners.append(callback)
+                return
+
+        callback(self, self.closed_reason == 1)
+
+
+def percentile(values, ratio):
+    """
+    Get the given percentile of the values.
+
+    :rtype: float
+    :return: The percentile.
+    """
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark how long enqueuing a " +
+            "message blocks while the message handler displays messages.")
+    parser.add_argument("--messages", type=int, default=2000,
+            help="The number of messages which are enqueued.")
+    parser.add_argument("--revisions", type=float, default=0.5,
+            help="The ratio of messages which append to the previous one.")
+    parser.add_argument("--display", type=float, default=20,
+            help="The time in ms which displaying a message takes.")
+    parser.add_argument("--visible", type=float, default=50,
+            help="The time in ms for which a message is visible.")
+    parser.add_argument("--interval", type=float, default=1,
+            help="The time in ms between two messages.")
+    arguments = parser.parse_args()
+
+    handler = MessageHandler()
+    handler.start()
+
+    bench_handler = Handler()
+    latencies = []
+    previous = ""
+
+    for number in range(arguments.messages):
+        append = previous != "" and random() < arguments.revisions
+        message = Message(number, previous if append else "", append,
+                arguments.display / 1000, arguments.visible / 1000)
+
+        start = perf_counter()
+        handler.enqueue(bench_handler, message)
+        latencies.append(perf_counter() - start)
+
+        previous = message.id
+        sleep(arguments.interval / 1000)
+
+    # Drop the messages which are still queued, so that we do not wait until
+    # all of them were displayed.
+    handler.take_pending()
+    handler.stop()
+    handler.join()
+
+    print("{:>10} {:>10} {:>10} {:>10}".format("messages", "p50 (us)",
+        "p99 (us)", "max (us)"))
+    print("{:>10} {:>10.1f} {:>10.1f} {:>10.1f}".format(len(latencies),
+        percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6,
+        max(latencies) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- journal benchmark
+#
+# Measures how the recovery time of the journal grows with its size as well
+# as the throughput of the group committing writer.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from argparse import ArgumentParser
+
+from os import listdir
+from os.path import getsize, join
+
+from tempfile import TemporaryDirectory
+
+from time import perf_counter
+
+from pynoter.server.journal import Journal
+
+
+class Handler:
+    """
+    Minimal stand-in for a client handler.
+    """
+    id = "bench_handler"
+    program_name = "bench"
+    multi_client = False
+    lingering = True
+
+
+class Message:
+    """
+    Minimal stand-in for a message.
+    """
+
+    def __init__(self, number):
+        self.id = "message_{}".format(number)
+        self.client = "bench_client"
+        self.subject = "Benchmark message {}".format(number)
+        self.body = "This is the body of the benchmark message."
+        self.icon = "dialog-information"
+        self.timeout = 6000
+        self.appends = False
+        self.updates = False
+        self.reference = ""
+
+
+def fill(directory, count, pending_ratio):
+    """
+    Write a journal with the given number of messages of which the given
+    ratio is still pending.
+
+    :rtype: float
+    :return: The number of records written per second.
+    """
+    journal = Journal(directory)
+    journal.recover()
+    journal.start()
+
+    start = perf_counter()
+
+    messages = [Message(i) for i in range(count)]
+    handler = Handler()
+
+    for message in messages:
+        journal.record_enqueue(handler, message)
+
+    for message in messages[int(count * pending_ratio):]:
+        journal.record_display(message)
+
+    journal.flush()
+    duration = perf_counter() - start
+
+    journal.stop()
+    journal.join()
+
+    return (2 * count - int(count * pending_ratio)) / duration
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the pynoter journal.")
+    parser.add_argument("--sizes", type=int, nargs='+',
+            default=[1000, 10000, 100000, 500000],
+            help="The number of messages written to the journal.")
+    parser.add_argument("--pending", type=float, default=1.0,
+            help="The ratio of messages which are still pending.")
+    arguments = parser.parse_args()
+
+    print("{:>10} {:>12} {:>14} {:>12} {:>10}".format("messages",
+        "journal (KiB)", "writes (rec/s)", "recovery (s)", "pending"))
+
+    for count in arguments.sizes:
+        with TemporaryDirectory() as directory:
+            rate = fill(directory, count, arguments.pending)
+
+            size = sum(getsize(join(directory, name))
+                    for name in listdir(directory))
+
+            start = perf_counter()
+            pending = Journal(directory).recover()
+            duration = perf_counter() - start
+
+        print("{:>10} {:>12} {:>14.0f} {:>12.3f} {:>10}".format(count,
+            size // 1024, rate, duration, len(pending)))
+
+
+if __name__ == "__main__":
+    main()
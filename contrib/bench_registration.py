@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- registration benchmark
+#
+# Measures how fast new programs can register at the server during a burst
+# of registrations (e.g. at a cron minute boundary), with and without a pool
+# of pre-created client handlers. The server runs in this process but the
+# clients reach it via the session bus, as real clients do.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from argparse import ArgumentParser
+
+from os import getpid
+
+from time import perf_counter, sleep
+
+from pynoter import Client, Server
+
+
+def percentile(values, ratio):
+    """
+    Get the given percentile of the values.
+
+    :rtype: float
+    :return: The percentile.
+    """
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def run(pool, bursts, burst, pause):
+    """
+    Register the given number of bursts of new programs at a server with the
+    given pool size.
+
+    :rtype: (float, list[float])
+    :return: The registrations per second within the bursts and the latency
+             of each registration.
+    """
+    server = Server(bus_suffix="bench_{}_{}".format(getpid(), pool),
+            handler_pool=pool, history_size=0)
+    server.start()
+
+    # Give the server the time to fill its pool.
+    sleep(pause)
+
+    latencies = []
+    duration = 0
+
+    for number in range(bursts):
+        clients = []
+        start = perf_counter()
+
+        for i in range(burst):
+            before = perf_counter()
+            clients.append(Client("bench_{}_{}".format(number, i),
+                server_bus_suffix="bench_{}_{}".format(getpid(), pool)))
+            latencies.append(perf_counter() - before)
+
+        duration += perf_counter() - start
+
+        # Unregister all clients, so that their handlers vanish, and give the
+        # server the time to refill its pool.
+        del clients
+        sleep(pause)
+
+    server.stop()
+
+    return bursts * burst / duration, latencies
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the registration of new " +
+            "programs at the pynoter server.")
+    parser.add_argument("--pools", type=int, nargs='+', default=[0, 4, 32],
+            help="The sizes of the handler pool which are compared.")
+    parser.add_argument("--bursts", type=int, default=10,
+            help="The number of bursts.")
+    parser.add_argument("--burst", type=int, default=32,
+            help="The number of programs which register in each burst.")
+    parser.add_argument("--pause", type=float, default=1.0,
+            help="The time in s between two bursts.")
+    arguments = parser.parse_args()
+
+    print("{:>6} {:>16} {:>10} {:>10}".format("pool", "registrations/s",
+        "p50 (ms)", "p99 (ms)"))
+
+    for pool in arguments.pools:
+        rate, latencies = run(pool, arguments.bursts, arguments.burst,
+                arguments.pause)
+
+        print("{:>6} {:>16.0f} {:>10.2f} {:>10.2f}".format(pool, rate,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- soak test
+#
+# Runs a server for a long time against a stand-in notification daemon on a
+# private session bus and drives it with simulated traffic: short living,
+# lingering and multi client programs, clients which crash without
+# unregistering and messages which the daemon never closes. The message
+# timeouts are short, so an hour of the test covers far more traffic than a
+# day of real usage. Meanwhile, the RSS of the server, its number of
+# messages, message items, client handlers and threads and the sizes of its
+# queues are sampled. The test fails if any of them grows by more than the
+# allowed amount between the start and the end of the test.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from argparse import ArgumentParser
+
+from multiprocessing import get_context
+
+from os import _exit, environ
+
+from random import Random
+
+from subprocess import PIPE, Popen
+
+from time import monotonic, sleep
+
+import sys
+
+
+SUFFIX = "soak"                 #< The bus suffix of the server under test.
+
+STICKY = "[sticky]"             #< Marker of messages which are never closed
+                                #  by the stand-in daemon.
+
+METRICS = ['rss', 'messages', 'message_items', 'client_handlers', 'threads',
+        'queued', 'indexed', 'shown', 'revisions', 'scheduled']
+
+
+def daemon(ready):
+    """
+    Run a stand-in for the notification daemon. Notifications expire after
+    their timeout, are dismissed at random or, if their summary contains the
+    sticky marker, are never closed.
+    """
+    from dbus import SessionBus, UInt32
+    from dbus.mainloop.glib import DBusGMainLoop
+    from dbus.service import BusName, Object, method, signal
+
+    import gi.repository.GLib as glib
+
+    class Notifications(Object):
+
+        def __init__(self, bus):
+            super(Notifications, self).__init__(bus,
+                    '/org/freedesktop/Notifications')
+
+            self._next = 1
+            self._timers = {}
+            self._random = Random(1)
+
+        def _close(self, notification_id, reason):
+            self._timers.pop(notification_id, None)
+            self.NotificationClosed(UInt32(notification_id), UInt32(reason))
+
+            return False
+
+        @method(dbus_interface='org.freedesktop.Notifications',
+                in_signature='susssasa{sv}i', out_signature='u')
+        def Notify(self, app_name, replaces_id, app_icon, summary, body,
+                actions, hints, expire_timeout):
+            notification_id = replaces_id
+
+            if notification_id == 0:
+                notification_id = self._next
+                self._next += 1
+
+            timer = self._timers.pop(notification_id, None)
+            if timer is not None:
+                glib.source_remove(timer)
+
+            if STICKY not in summary:
+                if self._random.random() < 0.1:
+                    # The user dismisses the notification early.
+                    timeout, reason = self._random.randrange(1, 100), 2
+                else:
+                    timeout, reason = max(expire_timeout, 1), 1
+
+                self._timers[notification_id] = glib.timeout_add(timeout,
+                        self._close, notification_id, reason)
+
+            return notification_id
+
+        @method(dbus_interface='org.freedesktop.Notifications',
+                in_signature='u')
+        def CloseNotification(self, notification_id):
+            timer = self._timers.pop(notification_id, None)
+            if timer is not None:
+                glib.source_remove(timer)
+
+            self._close(notification_id, 3)
+
+        @method(dbus_interface='org.freedesktop.Notifications',
+                out_signature='as')
+        def GetCapabilities(self):
+            return ['body']
+
+        @method(dbus_interface='org.freedesktop.Notifications',
+                out_signature='ssss')
+        def GetServerInformation(self):
+            return ('soak', 'pynoter', '1.0', '1.2')
+
+        @signal(dbus_interface='org.freedesktop.Notifications',
+                signature='uu')
+        def NotificationClosed(self, notification_id, reason):
+            pass
+
+    bus = SessionBus(mainloop=DBusGMainLoop())
+    name = BusName('org.freedesktop.Notifications', bus)
+    notifications = Notifications(bus)
+
+    ready.set()
+    glib.MainLoop().run()
+
+
+def server(stop, idle_timeout):
+    """
+    Run the server under test until the stop event is set.
+    """
+    from pynoter import Server
+
+    instance = Server(bus_suffix=SUFFIX, handler_idle_timeout=idle_timeout)
+    instance.start()
+
+    stop.wait()
+
+    instance.stop()
+
+
+def crash(program, seed):
+    """
+    Register a client, send some messages and exit without unregistering.
+    """
+    from pynoter import Client
+
+    random = Random(seed)
+
+    client = Client(program, server_bus_suffix=SUFFIX,
+            lingering=random.random() < 0.5)
+
+    for number in range(random.randrange(1, 4)):
+        client.display_message("Crash", "Message {}".format(number),
+                timeout=random.randrange(20, 200))
+
+    _exit(1)
+
+
+def traffic(index, duration, rate, seed):
+    """
+    Send a random mix of messages from short living, lingering, multi client
+    and crashing programs for the given time.
+    """
+    from pynoter import Client
+
+    context = get_context('spawn')
+    random = Random(seed)
+
+    multi = Client("soak-multi-{}".format(index % 2), server_bus_suffix=SUFFIX,
+            multi_client=True)
+    previous = ""
+
+    deadline = monotonic() + duration
+
+    while monotonic() < deadline:
+        scenario = random.random()
+        timeout = random.randrange(20, 500)
+        program = "soak-{}".format(random.randrange(64))
+
+        if scenario < 0.35:
+            client = Client(program, server_bus_suffix=SUFFIX)
+            client.display_message("Plain", "Body", timeout=timeout)
+            del client
+        elif scenario < 0.55:
+            client = Client(program + "-lingering", server_bus_suffix=SUFFIX,
+                    lingering=True)
+            client.display_message("Lingering", "Body", timeout=timeout)
+            del client
+        elif scenario < 0.85:
+            flag = random.random()
+            previous = multi.display_message("Multi", "Body",
+                    timeout=timeout, append=flag < 0.3,
+                    update=0.3 <= flag < 0.6,
+                    reference=previous if flag < 0.6 else None)
+        elif scenario < 0.95:
+            multi.display_message("Never closed " + STICKY, "Body",
+                    timeout=timeout)
+        else:
+            process = context.Process(target=crash, args=(program + "-crash",
+                random.random()))
+            process.start()
+            process.join()
+
+        sleep(random.expovariate(rate))
+
+
+def rss(pid):
+    """
+    Get the resident set size of a process in MiB.
+
+    :rtype: float
+    :return: The resident set size.
+    """
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+    return 0.0
+
+
+def sample(proxy, pid):
+    """
+    Sample the metrics of the server.
+
+    :rtype: dict
+    :return: The value of each metric.
+    """
+    values = dict((str(key), float(value))
+            for key, value in proxy.get_object_counts(True).items())
+    values['rss'] = rss(pid)
+
+    return values
+
+
+def median(values):
+    """
+    Get the median of the values.
+
+    :rtype: float
+    :return: The median.
+    """
+    values = sorted(values)
+
+    return values[len(values) // 2]
+
+
+def main():
+    parser = ArgumentParser(description="Run the pynoter server for a long " +
+            "time with simulated traffic and check that it does not leak.")
+    parser.add_argument("--duration", type=float, default=3600,
+            help="The time in s for which traffic is sent.")
+    parser.add_argument("--warmup", type=float, default=120,
+            help="The time in s after which the baseline is sampled.")
+    parser.add_argument("--interval", type=float, default=30,
+            help="The time in s between two samples.")
+    parser.add_argument("--workers", type=int, default=4,
+            help="The number of processes which send traffic.")
+    parser.add_argument("--rate", type=float, default=20,
+            help="The number of actions per second of each worker.")
+    parser.add_argument("--idle-timeout", type=int, default=30,
+            help="The time in s after which idle handlers are removed.")
+    parser.add_argument("--max-rss", type=float, default=16,
+            help="The allowed growth of the RSS in MiB.")
+    parser.add_argument("--max-objects", type=float, default=200,
+            help="The allowed growth of the number of messages, message " +
+            "items, client handlers and queued items.")
+    parser.add_argument("--max-threads", type=float, default=4,
+            help="The allowed growth of the number of threads.")
+    arguments = parser.parse_args()
+
+    if arguments.warmup + 3 * arguments.interval > arguments.duration:
+        parser.error("The duration is too short for the warmup and three " +
+                "samples.")
+
+    # Run everything on a private bus, so that neither the real notification
+    # daemon nor a running pynoter server is involved.
+    bus = Popen(["dbus-daemon", "--session", "--nofork", "--print-address"],
+            stdout=PIPE, universal_newlines=True)
+    environ['DBUS_SESSION_BUS_ADDRESS'] = bus.stdout.readline().strip()
+
+    context = get_context('spawn')
+
+    ready = context.Event()
+    stand_in = context.Process(target=daemon, args=(ready,), daemon=True)
+    stand_in.start()
+    ready.wait()
+
+    stop = context.Event()
+    server_process = context.Process(target=server, args=(stop,
+        arguments.idle_timeout))
+    server_process.start()
+
+    from dbus import SessionBus
+
+    session = SessionBus()
+    while not session.name_has_owner("org.pynoter." + SUFFIX):
+        sleep(0.1)
+
+    proxy = session.get_object("org.pynoter." + SUFFIX, '/')
+
+    workers = [context.Process(target=traffic, args=(index,
+        arguments.duration, arguments.rate, index))
+        for index in range(arguments.workers)]
+    for worker in workers:
+        worker.start()
+
+    start = monotonic()
+    samples = []
+
+    print("{:>8} ".format("time (s)") + " ".join("{:>10}".format(m[:10])
+        for m in METRICS))
+
+    try:
+        sleep(arguments.warmup)
+
+        while monotonic() - start < arguments.duration:
+            values = sample(proxy, server_process.pid)
+            samples.append(values)
+
+            print("{:>8.0f} ".format(monotonic() - start) +
+                    " ".join("{:>10.1f}".format(values.get(m, 0))
+                        for m in METRICS))
+            sys.stdout.flush()
+
+            sleep(arguments.interval)
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+        stop.set()
+        server_process.join(30)
+        bus.terminate()
+
+    # Compare the medians of the first and the last samples, so that a single
+    # burst of traffic does not fail the test.
+    window = max(1, min(3, len(samples) // 3))
+    limits = {'rss': arguments.max_rss, 'threads': arguments.max_threads}
+
+    failed = False
+
+    for metric in METRICS:
+        first = median([s.get(metric, 0) for s in samples[:window]])
+        last = median([s.get(metric, 0) for s in samples[-window:]])
+        limit = limits.get(metric, arguments.max_objects)
+
+        if last - first > limit:
+            print("FAIL: {} grew from {:.1f} to {:.1f} (allowed {:.1f})."
+                    .format(metric, first, last, limit))
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+    print("OK: No metric grew by more than allowed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,9 +11,10 @@
 # (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
 ################################################################################
 
+from pynoter.buffer import FlushPolicy
 from pynoter.client import Client
-from pynoter.server import Server
+from pynoter.server import LocalClient, Server
 
 
-__all__ = ['Client', 'Server']
+__all__ = ['Client', 'FlushPolicy', 'LocalClient', 'Server']
 
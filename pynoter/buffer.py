@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- buffer
+#
+# The message buffer of the pynoter package. A client which uses a buffer
+# does not send each message to the server right away. Instead, the messages
+# are collected and a background thread sends them in batches, at most as
+# many per second as the flush policy allows. A message which updates the
+# message right before it in the buffer replaces it there, so a loop which
+# keeps updating one message only sends the latest state. Hence, neither
+# the program which produces the messages waits for the bus, nor does the bus
+# see more calls than the policy allows.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from threading import Condition, Thread
+
+from time import monotonic
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['FlushPolicy', 'MessageBuffer']
+
+
+class FlushPolicy:
+    """
+    This class describes when and how fast a buffer sends its messages.
+    """
+
+    def __init__(self, interval = 0.05, rate = 50, max_batch = 64,
+            max_pending = 1024, block = True):
+        """
+        Constructor of the class.
+
+        :param interval: The time in s during which messages are collected
+                         before they are sent together. (Defaults to 0.05)
+        :type interval: float
+        :param rate: The maximum number of messages per second which are sent
+                     to the server. Use None to not limit the rate.
+                     (Defaults to 50)
+        :type rate: float
+        :param max_batch: The maximum number of messages which are sent with
+                          one call. (Defaults to 64)
+        :type max_batch: int
+        :param max_pending: The maximum number of messages which wait in the
+                            buffer. (Defaults to 1024)
+        :type max_pending: int
+        :param block: Flag which indicates whether adding a message to a full
+                      buffer waits until there is space again. Otherwise, the
+                      oldest waiting message is dropped. (Defaults to True)
+        :type block: bool
+        :raises ValueError: If one of the parameters is invalid.
+        """
+        if interval < 0 or (rate is not None and rate <= 0) or \
+                max_batch < 1 or max_pending < 1:
+            raise ValueError("Invalid flush policy.")
+
+        self.interval = interval
+        self.rate = rate
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.block = block
+
+
+class MessageBuffer:
+    """
+    This class collects the messages of a client and sends them in batches on
+    a background thread.
+
+    Each message is a tuple of its identifier, subject, body, icon, timeout,
+    append flag, update flag and reference, as it is passed to the batch call
+    of the client handler.
+    """
+
+    def __init__(self, send, policy, dropped = None):
+        """
+        Constructor of the class. The background thread is started here.
+
+        :param send: The function which sends a batch of messages to the
+                     server.
+        :type send: callable
+        :param policy: The flush policy.
+        :type policy: FlushPolicy
+        :param dropped: The function which is called with the identifier of
+                        each message which is never sent, because it was
+                        replaced by an update, dropped from a full buffer or
+                        its batch failed to be sent. In the last case, the
+                        error is passed as second argument, otherwise None.
+                        (Defaults to None)
+        :type dropped: callable
+        """
+        # Internal variables
+        self._send = send
+        self._policy = policy
+        self._dropped = dropped
+
+        self._pending = []              #< The messages which wait to be sent.
+        self._sending = False           #< Whether a batch is being sent.
+        self._urgent = False            #< Whether all messages should be sent
+                                        #  right away.
+        self._closed = False            #< Whether the buffer is closed.
+        self._error = None              #< The error of the last batch which
+                                        #  failed to be sent, until it is
+                                        #  raised.
+
+        self._tokens = float(policy.max_batch) #< The number of messages which
+                                        #  may be sent now.
+        self._refilled = monotonic()    #< The time the tokens were refilled.
+
+        self._condition = Condition()   #< Lock and condition for all of the
+                                        #  above.
+
+        self._thread = Thread(target=self._run, name="pynoter-flush",
+                daemon=True)
+        self._thread.start()
+
+    def _collapse(self, message):
+        """
+        Replace the last waiting message if the given message updates it. The
+        lock must be held.
+
+        :param message: The new message.
+        :type message: tuple
+        :rtype: str
+        :return: The identifier of the replaced message or None.
+        """
+        if not self._pending:
+            return None
+
+        message_id, subject, body, icon, timeout, append, update, reference = \
+                message
+        last = self._pending[-1]
+
+        if not update or append or reference not in ("", last[0]) or \
+                last[5]:
+            # Only plain messages and updates can be replaced, as the text of
+            # an appending message depends on the one before.
+            return None
+
+        # The new message takes the place of the last one, including whether
+        # and what the last one updates.
+        self._pending[-1] = (message_id, subject, body, icon, timeout, False,
+                last[6], last[7])
+
+        return last[0]
+
+    def _raise_error(self):
+        """
+        Raise the error of the last batch which failed to be sent, if it was
+        not raised yet. The lock must be held.
+        """
+        error = self._error
+        self._error = None
+
+        if error is not None:
+            raise error
+
+    def _take(self):
+        """
+        Wait until messages may be sent and take them from the buffer.
+
+        :rtype: list[tuple]
+        :return: The messages which should be sent or None if the buffer is
+                 closed and empty.
+        """
+        policy = self._policy
+
+        with self._condition:
+            while not self._pending:
+                if self._closed:
+                    return None
+
+                self._condition.wait()
+
+            # Give the program some time to add further messages, which are
+            # sent together or replace the waiting ones.
+            deadline = monotonic() + policy.interval
+
+            while not self._urgent and \
+                    len(self._pending) < policy.max_batch:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+
+                self._condition.wait(remaining)
+
+            count = min(len(self._pending), policy.max_batch)
+
+            if policy.rate is not None and not self._urgent:
+                now = monotonic()
+                self._tokens = min(self._tokens + (now - self._refilled) *
+                        policy.rate, float(policy.max_batch))
+                self._refilled = now
+
+                if self._tokens < 1:
+                    # Wait for the next token. New messages may still replace
+                    # the waiting ones in the meantime.
+                    self._condition.wait((1 - self._tokens) / policy.rate)
+                    return []
+
+                count = min(count, int(self._tokens))
+                self._tokens -= count
+
+            batch = self._pending[:count]
+            del self._pending[:count]
+
+            self._sending = True
+            self._condition.notify_all()
+
+            return batch
+
+    def _run(self):
+        """
+        Send the messages until the buffer is closed.
+
+        This method runs on the background thread.
+        """
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+
+            if batch:
+                try:
+                    self._send(batch)
+                except Exception as e:
+                    logger.warning("Failed to send {} messages: {}".format(
+                        len(batch), e))
+
+                    with self._condition:
+                        self._error = e
+
+                    # No one should wait for the messages.
+                    if self._dropped is not None:
+                        for message in batch:
+                            self._dropped(message[0], e)
+
+            with self._condition:
+                self._sending = False
+
+                if not self._pending:
+                    self._urgent = False
+
+                self._condition.notify_all()
+
+    def add(self, message):
+        """
+        Add a message to the buffer.
+
+        :param message: The message.
+        :type message: tuple
+        :raises RuntimeError: If the buffer is closed.
+        :raises Exception: The error of the last batch which failed to be
+                           sent. The message is not added then.
+        """
+        dropped = None
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The buffer is closed.")
+
+            self._raise_error()
+
+            dropped = self._collapse(message)
+
+            if dropped is None:
+                while len(self._pending) >= self._policy.max_pending:
+                    if not self._policy.block:
+                        dropped = self._pending.pop(0)[0]
+                        break
+
+                    self._condition.wait()
+
+                self._pending.append(message)
+
+            self._condition.notify_all()
+
+        if dropped is not None and self._dropped is not None:
+            self._dropped(dropped, None)
+
+    def flush(self):
+        """
+        Send all waiting messages right away, regardless of the policy, and
+        wait until they are sent.
+
+        :raises Exception: The error of the last batch which failed to be
+                           sent.
+        """
+        with self._condition:
+            if self._pending or self._sending:
+                self._urgent = True
+                self._condition.notify_all()
+
+                while self._pending or self._sending:
+                    self._condition.wait()
+
+            self._raise_error()
+
+    def close(self):
+        """
+        Send all waiting messages and stop the background thread. The error
+        of a batch which failed to be sent is not raised any more.
+        """
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        self._thread.join()
+
+    @property
+    def pending(self):
+        """
+        Get the number of messages which wait to be sent.
+
+        :rtype: int
+        :return: The number of waiting messages.
+        """
+        with self._condition:
+            return len(self._pending)
@@ -13,7 +13,26 @@
 # (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
 ###############################################################################
 
-from dbus import SessionBus, SystemBus, Interface
+from dbus.exceptions import DBusException
+
+import gi.repository.GLib as glib
+
+from collections import OrderedDict
+
+from concurrent.futures import Future, TimeoutError
+
+from math import isfinite
+
+from threading import Lock
+
+from time import monotonic, sleep, time
+
+from uuid import uuid4
+
+from pynoter.buffer import MessageBuffer
+from pynoter.connection import SharedConnection
+from pynoter.spool import SpoolWriter
+from pynoter.template import Template
 
 
 class Client:
@@ -21,8 +40,16 @@ class Client:
     This class should be used to establish connections to the server
     as well as sending messages to it.
     """
+
+    CLOSED_HISTORY = 256    #< The number of close reasons which are kept for
+                            #  messages for which no one waited yet.
+    PROBE_INTERVAL = 5      #< The time in s between two checks whether the
+                            #  server is running, while the client writes to
+                            #  the spool.
+
     def __init__(self, program_name, server_bus_suffix = None,
-            multi_client = False, lingering = False, use_system_bus = False):
+            multi_client = False, lingering = False, use_system_bus = False,
+            spool_dir = None, flush_policy = None):
         """
         Constructor for the class. The connection to the server is
         established here.
@@ -49,12 +76,24 @@ class Client:
                                DBus or the normal session bus should be used.
                                (Defaults to False)
         :type use_system_bus: bool
+        :param spool_dir: The spool directory where messages should be written
+                          to if the server is not running. In this case the
+                          client does not wait for the server to be started
+                          but returns immediately. The server will display the
+                          messages as soon as it starts, and the client
+                          switches over to the server within a few seconds
+                          after that. Use 'None' to always connect to the
+                          server. (Defaults to None)
+        :type spool_dir: str
+        :param flush_policy: The policy of the buffer for the messages of this
+                             client. If it is given, 'display_message' only
+                             adds the message to the buffer, which sends it
+                             in the background, and an update of the message
+                             which is still waiting there replaces it. Use
+                             'None' to send each message right away.
+                             (Defaults to None)
+        :type flush_policy: FlushPolicy
         """
-        if use_system_bus:
-            self._dbus_bus = SystemBus()
-        else:
-            self._dbus_bus = SessionBus()
-
         # Internal variables
         self._id = None                 #< The identifier of this client which
                                         #  we get from the handler.
@@ -62,11 +101,66 @@ class Client:
         self._handler = None            #< The client handler which serves us.
 
         self._last_message = ''         #< The id of the message which was
+                                        #  sent last.
+
+        self._handler_path = None       #< The object path of our handler.
+
+        # The bus name of the server.
+        self._server_bus = Client._server_bus_name(server_bus_suffix)
+
+        self._closed_futures = {}       #< The futures of the messages for which
+                                        #  someone waits until they are closed.
+
+        self._closed_reasons = OrderedDict() #< The close reasons of the most
+                                        #  recently closed messages for which
+                                        #  no one waited yet.
+
+        self._closed_lock = Lock()      #< Lock for the futures and reasons, as
+                                        #  they are resolved on the main loop.
+
+        self._spool = None              #< The spool where messages are written
+                                        #  to if the server is not running.
+        self._next_probe = 0            #< The time when it is checked again
+                                        #  whether the server is running.
+        self._registration = (program_name, multi_client, lingering,
+                use_system_bus)         #< The arguments of the registration,
+                                        #  which happens later if the server
+                                        #  is not running yet.
+        self._flush_policy = flush_policy
+
+        self._templates = {}            #< The registered templates by id, so
+                                        #  that they can be registered again
+                                        #  or rendered locally.
+
+        self._buffer = None             #< The buffer of the messages which are
+                                        #  sent in the background.
+
+        # All clients of the process share the connection to the bus.
+        try:
+            self._connection = SharedConnection.get(use_system_bus)
+        except DBusException:
+            if spool_dir is None:
+                raise
+
+            self._connection = None
+
+        if spool_dir is not None and (self._connection is None or
+                not self._connection.has_server(self._server_bus)):
+            # The server is not running. Do not wait until it got activated
+            # but use the spool instead.
+            self._spool = SpoolWriter(spool_dir, program_name, multi_client,
+                    lingering)
+            self._id = str(uuid4()).replace('-', '_')
+            self._next_probe = monotonic() + Client.PROBE_INTERVAL
+
+            return
 
         # Register at the server.
-        self._register(program_name, server_bus_suffix, multi_client, lingering)
+        self._register(program_name, multi_client, lingering)
 
-                                        #  sent last.
+        if flush_policy is not None:
+            self._buffer = MessageBuffer(self._send_messages, flush_policy,
+                    self._message_dropped)
 
     def __del__(self):
         """
@@ -76,18 +170,159 @@ class Client:
         # Unregister before quitting.
         self._unregister()
 
-    def _register(self, program_name, server_bus_suffix, multi_client,
-            lingering):
+    @staticmethod
+    def _server_bus_name(server_bus_suffix):
         """
-        Register the current client at the server.
+        Get the bus name of the server.
 
-        :param program_name: The name which should be used for registration.
+        :param server_bus_suffix: An optional name suffix where the server is
+                                  located.
+        :type server_bus_suffix: str
+        :rtype: str
+        :return: The bus name of the server.
+        """
+        if server_bus_suffix is None:
+            return 'org.pynoter'
+
+        return 'org.pynoter.' + server_bus_suffix
+
+    @staticmethod
+    def query_history(program_name = "", since = None, limit = 100,
+            server_bus_suffix = None, use_system_bus = False):
+        """
+        Get messages from the history of the server. This does not need a
+        registered client.
+
+        If no time is given, the most recently received messages are returned.
+        Otherwise the messages which were received after the given time are
+        returned. To get the next page, call this method again with the receive
+        time of the last returned message.
+
+        :param program_name: The name of the program whose messages should be
+                             returned. Use '' for all programs.
+                             (Defaults to '')
         :type program_name: str
+        :param since: Only messages which were received after this time (in s
+                      since the epoch) are returned. (Defaults to None)
+        :type since: float
+        :param limit: The maximum number of messages which are returned.
+                      (Defaults to 100)
+        :type limit: int
         :param server_bus_suffix: An optional name suffix where the server is
-                                  located. This is only needed if there are
-                                  multiple servers on the same Bus.
-                                  (Defaults to None)
+                                  located. (Defaults to None)
         :type server_bus_suffix: str
+        :param use_system_bus: Flag which indicates, whether the system bus of
+                               DBus or the normal session bus should be used.
+                               (Defaults to False)
+        :type use_system_bus: bool
+        :rtype: list[tuple]
+        :return: The id, program, subject, body, icon, the times when the
+                 message was received, displayed and closed (or 0) and the
+                 reason why it was closed (or 0) of each message, oldest first.
+        """
+        server = SharedConnection.get(use_system_bus).server(
+                Client._server_bus_name(server_bus_suffix))
+
+        if since is None:
+            entries = server.recent_history(program_name, limit)
+        else:
+            entries = server.history(program_name, since, limit)
+
+        return [(str(m), str(p), str(s), str(b), str(i), float(r), float(d),
+                float(c), int(reason))
+                for m, p, s, b, i, r, d, c, reason in entries]
+
+    @staticmethod
+    def profile_server(mode = 'trace', every = 1, duration = 10, limit = 20,
+            server_bus_suffix = None, use_system_bus = False):
+        """
+        Profile the hot paths of a running server for the given time and get
+        the results. This does not need a registered client.
+
+        :param mode: Either 'trace' to measure the duration of the calls per
+                     program or 'cprofile' to run cProfile around them, with
+                     one profile per program. (Defaults to 'trace')
+        :type mode: str
+        :param every: Only every n-th call is measured. (Defaults to 1)
+        :type every: int
+        :param duration: The time in s for which the server is profiled.
+                         (Defaults to 10)
+        :type duration: float
+        :param limit: The number of functions which are listed per program if
+                      cProfile is used. (Defaults to 20)
+        :type limit: int
+        :param server_bus_suffix: An optional name suffix where the server is
+                                  located. (Defaults to None)
+        :type server_bus_suffix: str
+        :param use_system_bus: Flag which indicates, whether the system bus of
+                               DBus or the normal session bus should be used.
+                               (Defaults to False)
+        :type use_system_bus: bool
+        :rtype: str
+        :return: The human readable results.
+        """
+        server = SharedConnection.get(use_system_bus).server(
+                Client._server_bus_name(server_bus_suffix))
+
+        server.start_profiling(mode, every, duration)
+
+        try:
+            sleep(duration)
+        finally:
+            server.stop_profiling()
+
+        return str(server.profiling_report(limit))
+
+    def _check_online(self):
+        """
+        Make sure that the client is connected to the server.
+
+        :raises RuntimeError: If the client writes to the spool.
+        """
+        self._probe()
+
+        if self._spool is not None:
+            raise RuntimeError("The client is not connected to the server.")
+
+    def _probe(self):
+        """
+        Stop writing to the spool and register at the server if it started in
+        the meantime. The server is asked at most once per probe interval.
+        The messages which are in the spool already are drained by the server
+        on its own.
+        """
+        if self._spool is None or monotonic() < self._next_probe:
+            return
+
+        self._next_probe = monotonic() + Client.PROBE_INTERVAL
+
+        program_name, multi_client, lingering, use_system_bus = \
+                self._registration
+
+        try:
+            if self._connection is None:
+                self._connection = SharedConnection.get(use_system_bus)
+
+            if not self._connection.has_server(self._server_bus):
+                return
+
+            self._register(program_name, multi_client, lingering)
+        except DBusException:
+            # Keep using the spool and try again later.
+            return
+
+        self._spool = None
+
+        if self._flush_policy is not None:
+            self._buffer = MessageBuffer(self._send_messages,
+                    self._flush_policy, self._message_dropped)
+
+    def _register(self, program_name, multi_client, lingering):
+        """
+        Register the current client at the server.
+
+        :param program_name: The name which should be used for registration.
+        :type program_name: str
         :param multi_client: Flag which indicates if there will be more clients
                              registering for the same client_name, which should
                              be treated as one client.
@@ -97,37 +332,254 @@ class Client:
                           vanishes.
         :type lingering: bool
         """
-        if server_bus_suffix is None:
-            server_bus = 'org.pynoter'
-        else:
-            server_bus = 'org.pynoter.' + server_bus_suffix
-
-        # Connect to the server.
-        server = Interface(
-                self._dbus_bus.get_object(server_bus, '/'),
-                dbus_interface='org.pynoter.server'
-        )
-
-        # Get the handler for this client.
-        handler_path = server.get_handler(program_name, multi_client,
-                lingering)
-        handler = Interface(
-                self._dbus_bus.get_object(server_bus, handler_path),
-                dbus_interface='org.pynoter.client_handler'
-        )
-
-        # Register at the handler.
-        self._id = handler.register()
+        while True:
+            # Get the handler for this client.
+            path, handler, cached = self._connection.acquire_handler(
+                    self._server_bus, program_name, multi_client, lingering)
+
+            # Register at the handler.
+            try:
+                self._id = str(handler.register())
+                break
+            except DBusException:
+                self._connection.release_handler(self._server_bus, path)
+
+                if not cached:
+                    raise
+
+                # A handler which another client of this process uses might
+                # have vanished or stopped serving multiple clients. Ask the
+                # server for the right one once.
+                self._connection.forget_handler(self._server_bus, path)
+
+        self._connection.add_client(self._id, self, self._server_bus, path)
+
         self._handler = handler
+        self._handler_path = path
 
     def _unregister(self):
         """
         Unregister the current client from the server.
         """
-        self._handler.unregister(self._id)
+        if self._handler is None:
+            # We never registered at the server.
+            return
+
+        if self._buffer is not None:
+            # Deliver the messages which are still waiting.
+            self._buffer.close()
+            self._buffer = None
+
+        handler = self._handler
+        self._handler = None
+
+        self._connection.remove_client(self._id)
+        self._connection.release_handler(self._server_bus, self._handler_path)
+
+        handler.unregister(self._id)
+
+    def _message_closed(self, client, message_id, reason):
+        """
+        Callback for the 'message_closed' signal of the handler.
+
+        :param client: The identifier of the client which sent the message.
+        :type client: str
+        :param message_id: The identifier of the message which got closed.
+        :type message_id: str
+        :param reason: The reason why the message got closed.
+        :type reason: int
+        """
+        with self._closed_lock:
+            future = self._closed_futures.pop(str(message_id), None)
+
+            if future is not None:
+                future.set_result(int(reason))
+                return
+
+            # No one waits for the message yet. Remember the reason for a short
+            # while in case someone asks for it later.
+            self._closed_reasons[str(message_id)] = int(reason)
+
+            while len(self._closed_reasons) > Client.CLOSED_HISTORY:
+                self._closed_reasons.popitem(last=False)
+
+    def _send_messages(self, messages):
+        """
+        Send a batch of messages from the buffer to the handler.
+
+        This method runs on the thread of the buffer.
+
+        :param messages: The messages as they are passed to the handler.
+        :type messages: list[tuple]
+        """
+        self._handler.display_messages(self._id, messages)
+
+    def _message_dropped(self, message_id, error):
+        """
+        Callback of the buffer for a message which is never sent, because an
+        update replaced it, the buffer was full or sending it failed. The
+        message counts as closed explicitly in the first two cases and for an
+        unknown reason in the last one.
+
+        :param message_id: The identifier of the message.
+        :type message_id: str
+        :param error: The error why sending the message failed or None.
+        :type error: Exception
+        """
+        self._message_closed(self._id, message_id, 3 if error is None else -1)
+
+    def _messages_closed(self, client, closed):
+        """
+        Callback for the 'messages_closed' signal of the handler.
+
+        :param client: The identifier of the client which sent the messages.
+        :type client: str
+        :param closed: The identifiers of the messages which got closed
+                       together with the reasons why.
+        :type closed: list[(str, int)]
+        """
+        for message_id, reason in closed:
+            self._message_closed(client, message_id, reason)
+
+    @property
+    def offline(self):
+        """
+        Whether or not the client writes its messages to the spool because
+        the server is not running.
+
+        :rtype: bool
+        :return: Whether or not the client is offline.
+        """
+        return self._spool is not None
+
+    def closed_future(self, message_id):
+        """
+        Get a future which is resolved as soon as the given message got closed.
+
+        The future is resolved from the GLib main loop. So either a main loop
+        must run somewhere in the program, or 'wait_closed' must be used.
+
+        :param message_id: The identifier of the message.
+        :type message_id: str
+        :rtype: Future
+        :return: A future whose result is the reason why the message got
+                 closed (1: expired, 2: dismissed, 3: closed explicitly,
+                 -1: unknown).
+        """
+        self._check_online()
+
+        with self._closed_lock:
+            future = self._closed_futures.get(message_id)
+            if future is not None:
+                return future
+
+            future = Future()
+
+            reason = self._closed_reasons.pop(message_id, None)
+            if reason is not None:
+                # The message is already closed.
+                future.set_result(reason)
+            else:
+                self._closed_futures[message_id] = future
+
+        return future
+
+    def wait_closed(self, message_id, timeout = None):
+        """
+        Wait until the given message got closed.
+
+        If no other thread runs the GLib main loop, the signals of the server
+        are dispatched while waiting.
+
+        :param message_id: The identifier of the message.
+        :type message_id: str
+        :param timeout: The maximum time in s to wait or None to wait forever.
+                        (Defaults to None)
+        :type timeout: float
+        :rtype: int
+        :return: The reason why the message got closed (see 'closed_future').
+        :raises TimeoutError: If the message did not close in time.
+        """
+        self._check_online()
+
+        future = self.closed_future(message_id)
+        context = glib.MainContext.default()
+
+        if not context.acquire():
+            # Someone else runs the main loop, so it will dispatch the signals.
+            return future.result(timeout)
+
+        try:
+            timed_out = []
+
+            if timeout is not None:
+                timer = glib.timeout_add(int(timeout * 1000),
+                        lambda: timed_out.append(True))
+
+            while not future.done() and not timed_out:
+                context.iteration(True)
+
+            if timeout is not None and not timed_out:
+                glib.source_remove(timer)
+        finally:
+            context.release()
+
+        if not future.done():
+            raise TimeoutError("The message did not close in time.")
+
+        return future.result()
+
+    def close_message(self, message_id):
+        """
+        Withdraw a notification message which was sent before. If the message
+        is not yet displayed it will never be, if it is currently visible it
+        gets closed.
+
+        :param message_id: The unique identifier of the message which should
+                           be closed.
+        :type message_id: str
+        :rtype: bool
+        :return: Whether or not the message could be closed.
+        """
+        self._check_online()
+        self.flush()
+
+        return bool(self._handler.close_message(self._id, message_id))
+
+    def flush(self):
+        """
+        Send the messages which wait in the buffer right away and wait until
+        they are sent. This does nothing if the client has no buffer.
+        """
+        if self._buffer is not None:
+            self._buffer.flush()
+
+    def disable_deduplication(self):
+        """
+        Disable that the server drops messages which are identical to recently
+        shown or queued ones.
+        """
+        self._check_online()
+
+        self._handler.disable_deduplication(self._id)
+
+    def enable_deduplication(self, window):
+        """
+        Enable that the server drops messages which are identical to one which
+        was shown or queued within the given time window. The server will
+        only count the repetitions of the original message.
+
+        :param window: The time in ms during which identical messages are
+                       treated as duplicates.
+        :type window: int
+        """
+        self._check_online()
+
+        self._handler.enable_deduplication(self._id, window)
 
     def display_message(self, subject, body, icon = "", timeout = 6000,
-            append = False, update = False, reference = None):
+            append = False, update = False, reference = None,
+            display_at = None, display_after = None):
         """
         Send a new notification message to the pynoter server.
 
@@ -156,8 +608,20 @@ class Client:
                           used and use '""' to indicate that no reference is
                           given. (Defaults to None)
         :type reference: str
+        :param display_at: The time (in s since the epoch) when the message
+                           should be displayed. Use 'None' to display the
+                           message as soon as possible. (Defaults to None)
+        :type display_at: float
+        :param display_after: The time (in ms) after which the message should
+                              be displayed. This is ignored if 'display_at' is
+                              given. (Defaults to None)
+        :type display_after: int
         :rtype: str
         :return: The unique identifier for this message.
+        :raises DBusException: If the message could not be sent or, for a
+                               client with a buffer, if the last batch of
+                               messages could not be sent. The messages of
+                               that batch are reported as closed.
         """
         # As it is not possible to send None via DBus, change the meaning of
         # the reference variable accordingly.
@@ -166,8 +630,190 @@ class Client:
         elif reference == "":
             reference = "not-set"
 
+        if display_at is None and display_after is not None:
+            display_at = time() + display_after / 1000
+
+        self._probe()
+
+        if self._spool is not None:
+            # The server is not running, so keep the message in the spool.
+            message_id = str(uuid4()).replace('-', '_')
+
+            self._spool.write(self._id, message_id, subject, body, icon,
+                    timeout, append, update, reference, display_at)
+
+            return message_id
+
+        if self._buffer is not None:
+            if display_at is None:
+                # Let the buffer send the message in the background.
+                message_id = str(uuid4()).replace('-', '_')
+
+                self._buffer.add((message_id, subject, body, icon, timeout,
+                    append, update, reference))
+
+                return message_id
+
+            # Keep the order of the messages.
+            self._buffer.flush()
+
         # Send the message to the handler and return the its unique message id
         # to the client so that it can use it as reference later.
+        if display_at is not None:
+            return self._handler.display_message_at(self._id, subject, body,
+                    icon, timeout, append, update, reference, display_at)
+
         return self._handler.display_message(self._id, subject, body, icon,
                 timeout, append, update, reference)
 
+    def register_template(self, subject, body = "", icon = "",
+            timeout = 6000, append = False, update = False):
+        """
+        Register a template for messages at the server. The subject, body and
+        icon may contain named placeholders in the syntax of 'str.format',
+        e.g. '{host}', which are filled in by 'display_template'. Afterwards,
+        only the values of the placeholders are sent for each message.
+
+        :param subject: The subject of the messages.
+        :type subject: str
+        :param body: The body of the messages. (Defaults to '')
+        :type body: str
+        :param icon: The name or path of the icon of the messages.
+                     (Defaults to '')
+        :type icon: str
+        :param timeout: The time (in ms) the messages should be visible.
+                        (Defaults to 6000ms (6s))
+        :type timeout: int
+        :param append: A flag which indicates that the messages should be
+                       appended to the last one, if possible.
+                       (Defaults to False)
+        :type append: bool
+        :param update: A flag which indicates that the messages should update
+                       (replace) the last message. (Defaults to False)
+        :type update: bool
+        :rtype: str
+        :return: The unique identifier of the template.
+        :raises ValueError: If the template is invalid.
+        """
+        # Parse the template here as well, so that invalid templates are
+        # reported right away.
+        template = Template(subject, body, icon, timeout, append, update)
+
+        if template.id not in self._templates:
+            if self._spool is None:
+                self._handler.register_template(self._id, subject, body, icon,
+                        timeout, append, update)
+
+            self._templates[template.id] = template
+
+        return template.id
+
+    def display_template(self, template_id, arguments = None):
+        """
+        Send a new notification message which is created from a template.
+
+        :param template_id: The unique identifier of the template as returned
+                            by 'register_template'.
+        :type template_id: str
+        :param arguments: The values of the placeholders of the template.
+                          (Defaults to None)
+        :type arguments: dict[str, str]
+        :rtype: str
+        :return: The unique identifier for this message.
+        :raises ValueError: If the template is unknown or an argument is
+                            missing.
+        """
+        template = self._templates.get(template_id)
+        if template is None:
+            raise ValueError("Unknown template.")
+
+        arguments = dict((str(key), str(value))
+                for key, value in (arguments or {}).items())
+
+        # Keep the order of the messages.
+        self.flush()
+
+        self._probe()
+
+        if self._spool is not None:
+            # The server is not running, so render the message ourselves.
+            subject, body, icon = template.render(arguments)
+
+            return self.display_message(subject, body, icon, template.timeout,
+                    template.append, template.update)
+
+        try:
+            return str(self._handler.display_template(self._id, template_id,
+                arguments))
+        except DBusException as e:
+            if "Unknown template" not in (e.get_dbus_message() or ""):
+                raise
+
+        # The server was restarted in the meantime and does not know the
+        # template any more.
+        self._handler.register_template(self._id, *template.source)
+
+        return str(self._handler.display_template(self._id, template_id,
+            arguments))
+
+    def open_progress(self, subject, icon = "", timeout = 6000):
+        """
+        Open a stream which reports the progress of a task as one message.
+        The server only keeps the latest progress of the stream and updates
+        the message at a limited rate, so the progress can be pushed as often
+        as convenient.
+
+        :param subject: The subject of the messages of the stream.
+        :type subject: str
+        :param icon: The name or path of the icon of the messages.
+                     (Defaults to '')
+        :type icon: str
+        :param timeout: The time (in ms) the messages should be visible.
+                        (Defaults to 6000ms (6s))
+        :type timeout: int
+        :rtype: str
+        :return: The unique identifier of the progress stream.
+        """
+        self._check_online()
+
+        return str(self._handler.open_progress(self._id, subject, icon,
+            timeout))
+
+    def push_progress(self, progress_id, value, text = ""):
+        """
+        Report the progress of a task. The stream is closed as soon as the
+        value reaches 100.
+
+        This call does not wait for the server, hence errors, e.g. an unknown
+        stream, are not reported.
+
+        :param progress_id: The unique identifier of the progress stream as
+                            returned by 'open_progress'.
+        :type progress_id: str
+        :param value: The progress in percent.
+        :type value: float
+        :param text: The text which describes the current step.
+                     (Defaults to '')
+        :type text: str
+        :raises ValueError: If the value is not a finite number.
+        """
+        value = float(value)
+        if not isfinite(value):
+            raise ValueError("The progress must be a finite number.")
+
+        self._check_online()
+
+        self._handler.push_progress(self._id, progress_id, value, text,
+                ignore_reply=True)
+
+    def close_progress(self, progress_id):
+        """
+        Close a progress stream before it is complete.
+
+        :param progress_id: The unique identifier of the progress stream as
+                            returned by 'open_progress'.
+        :type progress_id: str
+        """
+        self._check_online()
+
+        self._handler.close_progress(self._id, progress_id)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- connection
+#
+# The shared connection of the pynoter package. All clients of a process use
+# the same bus connection and the same proxies for the server and the
+# handlers. Each client listens for the closed signals with a match rule on
+# its identifier, so that the bus only delivers the signals of its own
+# messages. Hence, creating another client only costs the calls to get the
+# handler and to register there. As long as a client of the process is
+# registered at a multi client handler, even the lookup of the handler is
+# skipped for further clients of the same program, until the server is
+# restarted.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from dbus import SessionBus, SystemBus, Interface
+from dbus.mainloop.glib import DBusGMainLoop
+
+from threading import Lock
+
+from weakref import WeakValueDictionary
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['SharedConnection']
+
+
+class SharedConnection:
+    """
+    This class is the connection to one bus which is shared by all clients of
+    the process.
+    """
+
+    _instances = {}                 #< The connections per bus.
+    _instances_lock = Lock()        #< Lock for the connections per bus.
+
+    @staticmethod
+    def get(use_system_bus):
+        """
+        Get the shared connection to the given bus.
+
+        :param use_system_bus: Flag which indicates, whether the system bus of
+                               DBus or the normal session bus should be used.
+        :type use_system_bus: bool
+        :rtype: SharedConnection
+        :return: The shared connection.
+        :raises DBusException: If the bus can not be reached.
+        """
+        with SharedConnection._instances_lock:
+            connection = SharedConnection._instances.get(use_system_bus)
+
+            if connection is None:
+                connection = SharedConnection(use_system_bus)
+                SharedConnection._instances[use_system_bus] = connection
+
+            return connection
+
+    def __init__(self, use_system_bus):
+        """
+        Constructor of the class. Use 'get' instead, so that the connection is
+        shared.
+
+        :param use_system_bus: Flag which indicates, whether the system bus of
+                               DBus or the normal session bus should be used.
+        :type use_system_bus: bool
+        """
+        logger.debug("Open shared connection to the {} bus.".format(
+            "system" if use_system_bus else "session"))
+
+        # The bus needs a main loop so that the signals of the server can be
+        # received.
+        if use_system_bus:
+            self._bus = SystemBus(mainloop=DBusGMainLoop())
+        else:
+            self._bus = SessionBus(mainloop=DBusGMainLoop())
+
+        self._servers = {}          #< The proxies of the servers by bus name.
+
+        self._handlers = {}         #< The handlers which are used by clients
+                                    #  by bus name and path. Each value is a
+                                    #  list of the proxy and the number of
+                                    #  clients.
+
+        self._multi_handlers = {}   #< The paths of the used multi client
+                                    #  handlers by bus name, program and flags.
+
+        self._clients = WeakValueDictionary() #< The clients by identifier, to
+                                    #  dispatch the signals to them.
+
+        self._receivers = {}        #< The signal receivers by client.
+
+        self._lock = Lock()         #< Lock for the proxies and clients.
+
+    def _message_closed(self, client, message_id, reason):
+        """
+        Dispatch the 'message_closed' signal of a handler to the client.
+
+        :param client: The identifier of the client which sent the message.
+        :type client: str
+        :param message_id: The identifier of the message which got closed.
+        :type message_id: str
+        :param reason: The reason why the message got closed.
+        :type reason: int
+        """
+        receiver = self._clients.get(str(client))
+
+        if receiver is not None:
+            receiver._message_closed(client, message_id, reason)
+
+    def _messages_closed(self, client, closed):
+        """
+        Dispatch the 'messages_closed' signal of a handler to the client.
+
+        :param client: The identifier of the client which sent the messages.
+        :type client: str
+        :param closed: The identifiers of the messages which got closed
+                       together with the reasons why.
+        :type closed: list[(str, int)]
+        """
+        receiver = self._clients.get(str(client))
+
+        if receiver is not None:
+            receiver._messages_closed(client, closed)
+
+    def server(self, server_bus):
+        """
+        Get the proxy of the server with the given bus name.
+
+        :param server_bus: The bus name of the server.
+        :type server_bus: str
+        :rtype: Interface
+        :return: The proxy of the server.
+        """
+        with self._lock:
+            server = self._servers.get(server_bus)
+
+            if server is None:
+                # The proxy must follow the name, as it outlives restarts and
+                # hand-offs of the server.
+                server = Interface(
+                        self._bus.get_object(server_bus, '/',
+                            follow_name_owner_changes=True),
+                        dbus_interface='org.pynoter.server'
+                )
+                self._servers[server_bus] = server
+
+                # The handlers of a restarted server are different ones.
+                self._bus.watch_name_owner(server_bus,
+                        lambda owner: self._server_changed(server_bus))
+
+            return server
+
+    def _server_changed(self, server_bus):
+        """
+        Forget the multi client handlers of a server whose bus name changed
+        its owner.
+
+        :param server_bus: The bus name of the server.
+        :type server_bus: str
+        """
+        with self._lock:
+            for key in [k for k in self._multi_handlers if k[0] == server_bus]:
+                del self._multi_handlers[key]
+
+    def has_server(self, server_bus):
+        """
+        Check whether a server with the given bus name is running.
+
+        :param server_bus: The bus name of the server.
+        :type server_bus: str
+        :rtype: bool
+        :return: Whether or not the server is running.
+        """
+        return self._bus.name_has_owner(server_bus)
+
+    def acquire_handler(self, server_bus, program_name, multi_client,
+            lingering):
+        """
+        Get the handler for a new client of the given program. Each call must
+        be paired with a call of 'release_handler'.
+
+        :param server_bus: The bus name of the server.
+        :type server_bus: str
+        :param program_name: The name of the program.
+        :type program_name: str
+        :param multi_client: Flag which indicates if there will be more clients
+                             registering for the same client_name, which should
+                             be treated as one client.
+        :type multi_client: bool
+        :param lingering: Flag which indicates, that the handler for this
+                          client should stay alive even if the current client
+                          vanishes.
+        :type lingering: bool
+        :rtype: (str, Interface, bool)
+        :return: The path and the proxy of the handler and whether the handler
+                 was used without asking the server.
+        """
+        key = (server_bus, program_name, multi_client, lingering)
+
+        # A multi client handler stays alive as long as one of our clients is
+        # registered there, so it can be used without asking the server.
+        with self._lock:
+            path = self._multi_handlers.get(key)
+
+            if path is not None:
+                entry = self._handlers[(server_bus, path)]
+                entry[1] += 1
+
+                return path, entry[0], True
+
+        path = str(self.server(server_bus).get_handler(program_name,
+            multi_client, lingering))
+
+        with self._lock:
+            entry = self._handlers.get((server_bus, path))
+
+            if entry is None:
+                handler = Interface(
+                        self._bus.get_object(server_bus, path,
+                            follow_name_owner_changes=True),
+                        dbus_interface='org.pynoter.client_handler'
+                )
+
+                entry = [handler, 0]
+                self._handlers[(server_bus, path)] = entry
+
+            entry[1] += 1
+
+            if multi_client:
+                self._multi_handlers[key] = path
+
+            return path, entry[0], False
+
+    def release_handler(self, server_bus, path):
+        """
+        Release a handler which was acquired for a client which unregisters.
+
+        :param server_bus: The bus name of the server.
+        :type server_bus: str
+        :param path: The path of the handler.
+        :type path: str
+        """
+        with self._lock:
+            entry = self._handlers[(server_bus, path)]
+            entry[1] -= 1
+
+            if entry[1] > 0:
+                return
+
+            # This was the last client of the handler, so it might vanish.
+            del self._handlers[(server_bus, path)]
+
+        self.forget_handler(server_bus, path)
+
+    def forget_handler(self, server_bus, path):
+        """
+        Stop using the given handler for further clients without asking the
+        server, e.g. because it vanished or does not serve multiple clients
+        any more.
+
+        :param server_bus: The bus name of the server.
+        :type server_bus: str
+        :param path: The path of the handler.
+        :type path: str
+        :rtype: bool
+        :return: Whether or not the handler was used without asking.
+        """
+        with self._lock:
+            keys = [key for key, handler_path in self._multi_handlers.items()
+                    if key[0] == server_bus and handler_path == path]
+
+            for key in keys:
+                del self._multi_handlers[key]
+
+            return len(keys) > 0
+
+    def add_client(self, client_id, client, server_bus, path):
+        """
+        Listen for the closed signals of the given client and dispatch them
+        to it.
+
+        :param client_id: The identifier of the client.
+        :type client_id: str
+        :param client: The client.
+        :type client: Client
+        :param server_bus: The bus name of the server.
+        :type server_bus: str
+        :param path: The path of the handler of the client.
+        :type path: str
+        """
+        # Only let the bus deliver the signals for the messages of this
+        # client.
+        receivers = [self._bus.add_signal_receiver(callback,
+                signal_name=signal_name,
+                dbus_interface='org.pynoter.client_handler',
+                bus_name=server_bus, path=path, arg0=client_id)
+            for signal_name, callback in [
+                ('message_closed', self._message_closed),
+                ('messages_closed', self._messages_closed)]]
+
+        with self._lock:
+            self._clients[client_id] = client
+            self._receivers[client_id] = receivers
+
+    def remove_client(self, client_id):
+        """
+        Stop dispatching the closed signals of the given client.
+
+        :param client_id: The identifier of the client.
+        :type client_id: str
+        """
+        with self._lock:
+            self._clients.pop(client_id, None)
+            receivers = self._receivers.pop(client_id, [])
+
+        for receiver in receivers:
+            receiver.remove()
+
+    @property
+    def bus(self):
+        """
+        Get the underlying bus connection.
+
+        :rtype: Bus
+        :return: The bus connection.
+        """
+        return self._bus
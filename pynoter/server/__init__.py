@@ -4,14 +4,15 @@
 # pynoter
 #
 # This is the server module file. Just importing this will provide access to the
-# Server class.
+# Server and the LocalClient class.
 #
 # License: GPLv3
 #
 # (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
 ################################################################################
 
+from pynoter.server.local_client import LocalClient
 from pynoter.server.server import Server
 
 
-__all__ = ['Server']
+__all__ = ['LocalClient', 'Server']
@@ -16,14 +16,26 @@ from dbus.service import Object, BusName, method, signal
 import gi
 gi.require_version('Notify', '0.7')
 
+import gi.repository.GLib as glib
 import gi.repository.Notify as notify
 from gi.repository.Notify import Notification
 
 import logging
 
+from math import isfinite
+
+from threading import Lock, RLock
+
+from time import monotonic
+
 from uuid import uuid4
 
+from pynoter.server.dedup_cache import DedupCache
 from pynoter.server.message import Message
+from pynoter.server.profiler import Profiler, profiler
+from pynoter.server.progress import ProgressStream
+from pynoter.template import Template
+from pynoter.trace import TraceRecorder
 
 
 logger = logging.getLogger(__name__)
@@ -37,6 +49,12 @@ class ClientHandler(Object):
     the corresponding server.
     """
 
+    MAX_TEMPLATES = 256     #< The maximum number of templates per handler.
+    MAX_PROGRESS = 64       #< The maximum number of open progress streams
+                            #  per handler.
+    PROGRESS_INTERVAL = 0.25 #< The minimal time in s between two renders of
+                            #  a progress stream.
+
     @staticmethod
     def create_unique_id(program_name):
         """
@@ -62,13 +80,16 @@ class ClientHandler(Object):
 
 
     def __init__(self, program_name, multi_client, lingering,
-            message_handler, bus_name, server):
+            message_handler, connections, server, dedup_window = 0,
+            handler_id = None):
         """
         Constructor of the class. Here the DBus connection will be set up
         as well as other maintenance operations.
 
         :param program_name: The name of the program for which this handler
-                             should handle clients.
+                             should handle clients. Use None to create a
+                             handler for the pool of the server, which is
+                             bound to a program later on (see 'bind').
         :type program_name: str
         :param multi_client: Flag which indicates if there will be more clients
                              registering for the same client_name, which should
@@ -81,24 +102,44 @@ class ClientHandler(Object):
         :param message_handler: The message handler thread, which handles the
                                 displaying of the notifications of the clients.
         :type message_handler: MessageHandler
-        :param bus_name: The DBus bus name where the current server is located.
-        :type bus_name: BusName
+        :param connections: The DBus connections on which the current server
+                            is exported. The handler is exported on all of
+                            them.
+        :type connections: list[Connection]
         :param server: The server object for which the handler is working.
         :type server: Server
+        :param dedup_window: The time in ms during which messages which are
+                             identical to an already shown or queued one are
+                             dropped. A value of 0 disables this.
+                             (Defaults to 0)
+        :type dedup_window: int
+        :param handler_id: The unique identifier of the handler if it is
+                           already known, e.g. because it is taken over from
+                           another server. (Defaults to None)
+        :type handler_id: str
         """
         logger.debug(("Create a new client handler. (program: {}, " +
-                "bus_name: {})").format(
-                    program_name, bus_name.get_name()))
+                "connections: {})").format(program_name, len(connections)))
 
         # First get the unique object path for this handler.
-        self._id = ClientHandler.create_unique_id(program_name)
+        if handler_id is None:
+            handler_id = ClientHandler.create_unique_id(
+                    program_name if program_name is not None else "handler")
+
+        self._id = handler_id
         self._object_path = '/' + self._id
+        self._connections = connections
+
+        # Create the DBus connection. Export the handler on every bus, so that
+        # clients on all of them share it.
+        super(ClientHandler, self).__init__()
 
-        # Create the DBus connection.
-        super(ClientHandler, self).__init__(bus_name, self._object_path)
+        for connection in connections:
+            self.add_to_connection(connection, self._object_path)
 
-        # Initialize the notifications
-        if not notify.init("client_handler_" + self._id):
+        # Initialize the notifications. This is only necessary once per
+        # process.
+        if not notify.is_initted() and not notify.init("pynoter"):
             logger.error("Failed to initialize notifications.")
             raise RuntimeError("Failed to initialize notifications")
 
@@ -106,16 +147,39 @@ class ClientHandler(Object):
 
         # Internal variables
         self._program_name = program_name
-        self._bus_name = bus_name
         self._message_handler = message_handler
         self._server = server
 
         self._clients = []
+        self._owners = {}               #< The connection index and unique bus
+                                        #  name of each client on DBus.
+        self._owner_watches = {}        #< The watches for the bus names of
+                                        #  the clients.
         self._multi_client = multi_client
         self._lingering = lingering
         self._last_message = ""
+        self._open_messages = 0         #< The number of messages which are
+                                        #  pending or visible.
+        self._dedup_cache = DedupCache(dedup_window)
 
-        self._add_to_server()
+        self._closed_pending = {}       #< The closed messages per client for
+                                        #  which no signal was emitted yet.
+        self._closed_lock = Lock()      #< Lock for the pending closed messages.
+        self._closed_scheduled = False  #< Whether the emission of the pending
+                                        #  closed messages is already scheduled
+                                        #  on the main loop.
+        self._closed_listeners = {}     #< Callbacks of local clients which are
+                                        #  called instead of emitting a signal.
+
+        self._templates = {}            #< The registered templates by id.
+        self._progress = {}             #< The open progress streams by id.
+
+        self._lock = RLock()            #< Lock for the clients and messages of
+                                        #  this handler, as local clients call
+                                        #  it from their own threads.
+
+        if program_name is not None:
+            self._add_to_server()
 
     def _add_to_server(self):
         """
@@ -137,21 +201,319 @@ class ClientHandler(Object):
                          not got closed differently.
         :type vanished: bool
         """
+        self._queue_closed_signal(message)
+
+        with self._lock:
+            self._open_messages -= 1
+            remaining = self._open_messages
+
+        self._server.touch_client_handler(self)
+
         if self._lingering and len(self._clients) == 0:
-            if message.id == self._last_message:
+            if message.id == self._last_message and remaining == 0:
                 # The message which just was closed was the last message which
-                # issued by this handler. Hence, it is save to remove the
-                # handler now.
+                # issued by this handler and no scheduled one is pending.
+                # Hence, it is save to remove the handler now. Deliver the outstanding signals before, as this
+                # is not possible any more afterwards.
+                self._emit_closed_signals()
                 self._remove_from_server()
 
+    def _queue_closed_signal(self, message):
+        """
+        Remember that the given message got closed so that the corresponding
+        signal is emitted on the main loop. Messages which close at the same
+        time are batched into one signal per client.
+
+        :param message: The message which got closed.
+        :type message: Message
+        """
+        self._queue_closed(message.client, message.id,
+                int(message.closed_reason))
+
+    def _queue_closed(self, client, message_id, reason):
+        """
+        Remember that a message of a client got closed so that the
+        corresponding signal is emitted on the main loop.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param message_id: The unique identifier of the message.
+        :type message_id: str
+        :param reason: The reason why the message got closed.
+        :type reason: int
+        """
+        with self._closed_lock:
+            self._closed_pending.setdefault(client, []).append(
+                    (message_id, reason))
+
+            if self._closed_scheduled:
+                return
+
+            self._closed_scheduled = True
+
+        glib.idle_add(self._emit_closed_signals)
+
+    def _emit_closed_signals(self):
+        """
+        Emit the signals for all messages which got closed since the last
+        emission.
+
+        :rtype: bool
+        :return: Always False, so that the main loop does not call this
+                 function again.
+        """
+        with self._closed_lock:
+            pending = self._closed_pending
+            self._closed_pending = {}
+            self._closed_scheduled = False
+
+            listeners = dict(self._closed_listeners)
+
+        for client, closed in pending.items():
+            listener = listeners.get(client)
+            if listener is not None:
+                listener(closed)
+            elif len(closed) == 1:
+                message_id, reason = closed[0]
+                self.message_closed(client, message_id, reason)
+            else:
+                self.messages_closed(client, closed)
+
+        return False
+
+    def _create_message(self, client, subject, body, icon, timeout, append,
+            update, reference, message_id = None):
+        """
+        Create the message object for a message sent by a client.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param subject: The subject of the message.
+        :type subject: str
+        :param body: The body of the message.
+        :type body: str
+        :param icon: The icon which should be displayed with the message.
+        :type icon: str
+        :param timeout: The time in ms how long the message should be visible.
+        :type timeout: int
+        :param append: Flag which indicates whether this message should be
+                       appended to the last one if possible.
+        :type append: bool
+        :param update: Flag which indicates whether this message should replace
+                       the last one if possible.
+        :type update: bool
+        :param reference: The unique identifier of the message which this
+                          message should replace or be appended to.
+        :type reference: str
+        :param message_id: The unique identifier of the message if it is
+                           already known. (Defaults to None)
+        :type message_id: str
+        :rtype: Message
+        :return: The new message object.
+        """
+        # Use the id of the last message as reference if this was not given by
+        # the user.
+        if reference == "":
+            reference = self._last_message
+
+        # Start to load the icon, so that it is ready when the message is
+        # displayed.
+        icon_cache = self._server.icon_cache
+        if icon_cache is not None:
+            icon_cache.prefetch(icon)
+
+        return Message(self, subject, body, icon, timeout, append, update,
+                reference, client, message_id)
+
+    def _track_message(self, message, last = True):
+        """
+        Remember the given message as the last one issued by this handler and
+        watch for it to close.
+
+        :param message: The message which is going to be displayed.
+        :type message: Message
+        :param last: Whether or not the message becomes the last one issued by
+                     this handler now. Scheduled messages only become it when
+                     they are due (see 'message_due'). (Defaults to True)
+        :type last: bool
+        """
+        if last:
+            self._last_message = message.id
+
+        self._open_messages += 1
+
+        message.notify_if_closed(self._message_callback)
+
+        self._server.touch_client_handler(self)
+
+    def _record(self, kind, client, message = "", reference = "",
+            timeout = 0, append = False, update = False):
+        """
+        Record a call of a client if the server records the traffic.
+
+        :param kind: The kind of the call (see 'TraceRecorder').
+        :type kind: int
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param message: The unique identifier of the message which is
+                        displayed. (Defaults to '')
+        :type message: str
+        :param reference: The reference of the message as given by the client.
+                          (Defaults to '')
+        :type reference: str
+        :param timeout: The timeout of the message in ms. (Defaults to 0)
+        :type timeout: int
+        :param append: Flag which indicates whether the message appends.
+                       (Defaults to False)
+        :type append: bool
+        :param update: Flag which indicates whether the message updates.
+                       (Defaults to False)
+        :type update: bool
+        """
+        recorder = self._server.recorder
+        if recorder is None:
+            return
+
+        recorder.record(kind, TraceRecorder.flags(self._multi_client,
+            self._lingering, append, update), self._program_name, client,
+            message, reference, timeout)
+
+    def _schedule_progress(self, stream):
+        """
+        Schedule the next render of a progress stream on the main loop unless
+        it is scheduled already. The lock must be held.
+
+        :param stream: The progress stream.
+        :type stream: ProgressStream
+        """
+        if stream.scheduled:
+            # The pending render picks up the latest value.
+            return
+
+        stream.scheduled = True
+
+        delay = stream.delay(monotonic(), ClientHandler.PROGRESS_INTERVAL)
+        if delay > 0:
+            glib.timeout_add(int(delay * 1000) + 1, self._render_progress,
+                    stream)
+        else:
+            glib.idle_add(self._render_progress, stream)
+
+    def _render_progress(self, stream):
+        """
+        Display the latest state of a progress stream as a message which
+        replaces the previous message of the stream. Completed streams are
+        closed afterwards.
+
+        This method runs on the main loop.
+
+        :param stream: The progress stream.
+        :type stream: ProgressStream
+        :rtype: bool
+        :return: Always False, so that the main loop does not call this
+                 function again.
+        """
+        with self._lock:
+            stream.scheduled = False
+
+            if self._progress.get(stream.id) is not stream:
+                # The stream was dropped in the meantime.
+                return False
+
+            if stream.changed:
+                body = stream.render(monotonic())
+
+                # Progress messages bypass the duplicate detection, as they
+                # must always show the latest state.
+                message = self._create_message(stream.client, stream.subject,
+                        body, stream.icon, stream.timeout, False,
+                        stream.message_id != "",
+                        stream.message_id or "not-set")
+
+                self._track_message(message)
+                self._message_handler.enqueue(self, message)
+
+                stream.message_id = message.id
+
+            if stream.finished:
+                logger.debug("Progress stream {} completed.".format(
+                    stream.id))
+
+                del self._progress[stream.id]
+
+        return False
+
+    def _watch_owner(self, client, index, owner):
+        """
+        Watch the bus name of a client, so that the client is unregistered if
+        it vanishes from the bus without unregistering, e.g. because it
+        crashed.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param index: The index of the connection on which the client calls.
+        :type index: int
+        :param owner: The unique bus name of the client.
+        :type owner: str
+        """
+        if index >= len(self._connections):
+            return
+
+        def changed(new_owner):
+            if new_owner == "":
+                self._owner_vanished(client)
+
+        self._owners[client] = (index, owner)
+        self._owner_watches[client] = \
+                self._connections[index].watch_name_owner(owner, changed)
+
+    def _owner_vanished(self, client):
+        """
+        Unregister a client whose bus name vanished.
+
+        This method runs on the main loop.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        """
+        with self._lock:
+            if not client in self._clients:
+                return
+
+        logger.info("Client {} of {} vanished without unregistering.".format(
+            client, self._program_name))
+
+        self.unregister(client)
+
+    def _unwatch_owner(self, client):
+        """
+        Stop watching the bus name of a client.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        """
+        self._owners.pop(client, None)
+
+        watch = self._owner_watches.pop(client, None)
+        if watch is not None:
+            watch.cancel()
+
     def _remove_from_server(self):
         """
         Remove this handler from the current pynoter server and from DBus.
         """
         self._server.remove_client_handler(self)
 
-        # Tear down the DBus connection.
-        self.remove_from_connection(self._bus_name.get_bus(), self._object_path)
+        with self._lock:
+            for client in list(self._owner_watches):
+                self._unwatch_owner(client)
+
+        # Tear down the DBus connections. This is already done if the server
+        # handed over to another one.
+        try:
+            self.remove_from_connection()
+        except LookupError:
+            pass
 
     # DBus Interface
 
@@ -213,6 +575,71 @@ class ClientHandler(Object):
 
         self._lingering = True
 
+    @method(dbus_interface='org.pynoter.client_handler', in_signature='ss',
+            out_signature='b')
+    def close_message(self, client, message_id):
+        """
+        Withdraw a notification message. If the message is still waiting to be
+        displayed it is removed, if it is currently visible it gets closed.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param message_id: The unique identifier of the message which should
+                           be closed.
+        :type message_id: str
+        :rtype: bool
+        :return: Whether or not the message could be closed.
+        """
+        if not client in self._clients:
+            raise ValueError("This is not a registered client.")
+
+        logger.debug("Close message {} for {}.".format(message_id, client))
+
+        message = self._server.scheduler.cancel(self, message_id)
+        if message is not None:
+            # The message was not yet due, so it never got displayed.
+            message.discard()
+
+            return True
+
+        return self._message_handler.close(self, message_id)
+
+    @method(dbus_interface='org.pynoter.client_handler', in_signature='s')
+    def disable_deduplication(self, client):
+        """
+        Disable that this handler drops messages which are identical to
+        recently shown or queued ones.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        """
+        if not client in self._clients:
+            raise ValueError("This is not a registered client.")
+
+        self._dedup_cache.window = 0
+
+    @method(dbus_interface='org.pynoter.client_handler', in_signature='si')
+    def enable_deduplication(self, client, window):
+        """
+        Enable this handler to drop messages which are identical to one which
+        was shown or queued within the given time window. Instead of
+        displaying the duplicate, the repeat counter of the original message
+        is increased.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param window: The time in ms during which identical messages are
+                       treated as duplicates.
+        :type window: int
+        """
+        if not client in self._clients:
+            raise ValueError("This is not a registered client.")
+
+        if window <= 0:
+            raise ValueError("The time window must be positive.")
+
+        self._dedup_cache.window = window
+
     @method(dbus_interface='org.pynoter.client_handler', in_signature='ssssibbs',
             out_signature='s')
     def display_message(self, client, subject, body = "", icon = "",
@@ -247,59 +674,418 @@ class ClientHandler(Object):
         :return: The unique identifier of the message which is going to be
                  displayed.
         """
-        if not client in self._clients:
-            raise ValueError("This is not a registered client.")
+        program = self._program_name
+        start = profiler.enter(Profiler.DISPLAY_MESSAGE, program) \
+                if profiler.active else 0
 
-        logger.debug("Received new message from {}.".format(client))
+        try:
+            with self._lock:
+                if not client in self._clients:
+                    raise ValueError("This is not a registered client.")
 
-        # Create the message object and enqueue it at the message handlers
-        # queue. Use the id of the last message as reference if this was not
-        # given by the user.
-        if reference == "":
-            reference = self._last_message
+                logger.debug("Received new message from {}.".format(client))
 
-        message = Message(self._notification, subject, body, icon, timeout,
-                append, update, reference)
-        self._last_message = message.id
+                message = self._create_message(client, subject, body, icon,
+                        timeout, append, update, reference)
 
-        message.notify_if_closed(self._message_callback)
+                duplicate = self._dedup_cache.lookup(message)
+                if duplicate is not None:
+                    logger.debug("Drop duplicate of message {}.".format(
+                        duplicate.id))
+
+                    # The same message was shown or queued recently. Just count
+                    # the repetition instead of displaying it again.
+                    duplicate.repeat()
+
+                    message = duplicate
+                else:
+                    self._dedup_cache.insert(message)
+                    self._track_message(message)
+
+                    self._message_handler.enqueue(self, message)
+
+            self._record(TraceRecorder.DISPLAY, client, message.id, reference,
+                    timeout, append, update)
+        finally:
+            if start:
+                profiler.leave(Profiler.DISPLAY_MESSAGE, program, start)
+
+        return message.id
+
+    @method(dbus_interface='org.pynoter.client_handler',
+            in_signature='sa(ssssibbs)')
+    def display_messages(self, client, messages):
+        """
+        Display multiple notification messages in the given order. The client
+        chooses the identifiers of the messages, so it does not have to wait
+        for this call.
+
+        A message which is dropped as a duplicate of a recent one is reported
+        as closed right away, as its identifier is never displayed.
+
+        The whole batch is refused if one of the identifiers is empty, is used
+        twice or belongs to a message which is still pending or visible, so
+        that no message can take the place of another one.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param messages: The identifier, subject, body, icon, timeout, append
+                         flag, update flag and reference of each message (see
+                         'display_message').
+        :type messages: list[(str, str, str, str, int, bool, bool, str)]
+        :raises ValueError: If one of the identifiers is invalid.
+        """
+        program = self._program_name
+        start = profiler.enter(Profiler.DISPLAY_MESSAGE, program) \
+                if profiler.active else 0
+
+        try:
+            with self._lock:
+                if not client in self._clients:
+                    raise ValueError("This is not a registered client.")
+
+                logger.debug("Received {} messages from {}.".format(
+                    len(messages), client))
+
+                ids = [str(m[0]) for m in messages]
+
+                if not all(ids):
+                    raise ValueError("The message has no identifier.")
+
+                if len(set(ids)) != len(ids) or \
+                        any(self._message_handler.knows(i) for i in ids):
+                    raise ValueError("The message identifier is in use.")
+
+                for message_id, subject, body, icon, timeout, append, \
+                        update, reference in messages:
+                    message = self._create_message(client, subject, body,
+                            icon, timeout, append, update, reference,
+                            str(message_id))
+
+                    duplicate = self._dedup_cache.lookup(message)
+                    if duplicate is not None:
+                        duplicate.repeat()
+
+                        self._queue_closed(client, message.id,
+                                int(Message.ClosedReason.Unknown))
+                    else:
+                        self._dedup_cache.insert(message)
+                        self._track_message(message)
+
+                        self._message_handler.enqueue(self, message)
+
+                    self._record(TraceRecorder.DISPLAY, client, message.id,
+                            reference, timeout, append, update)
+        finally:
+            if start:
+                profiler.leave(Profiler.DISPLAY_MESSAGE, program, start)
+
+    @method(dbus_interface='org.pynoter.client_handler',
+            in_signature='ssssibb', out_signature='s')
+    def register_template(self, client, subject, body = "", icon = "",
+            timeout = 6000, append = False, update = False):
+        """
+        Register a template for messages. The subject, body and icon may
+        contain named placeholders in the syntax of 'str.format', e.g.
+        '{host}', which are filled in by 'display_template'.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param subject: The subject of the messages.
+        :type subject: str
+        :param body: The body of the messages. (Defaults to "")
+        :type body: str
+        :param icon: The icon of the messages. (Defaults to "")
+        :type icon: str
+        :param timeout: The time in ms how long the messages should be visible.
+                        (Defaults to 6000)
+        :type timeout: int
+        :param append: Flag which indicates whether the messages should be
+                       appended to the last one if possible. (Defaults to False)
+        :type append: bool
+        :param update: Flag which indicates whether the messages should replace
+                       the last one if possible. (Defaults to False)
+        :type update: bool
+        :rtype: str
+        :return: The unique identifier of the template. Registering the same
+                 template again yields the same identifier.
+        """
+        with self._lock:
+            if not client in self._clients:
+                raise ValueError("This is not a registered client.")
+
+            template_id = Template.create_id(subject, body, icon, timeout,
+                    append, update)
+
+            if template_id in self._templates:
+                return template_id
+
+            if len(self._templates) >= ClientHandler.MAX_TEMPLATES:
+                raise ValueError("Too many templates are registered.")
+
+            logger.debug("Register template {} for {}.".format(template_id,
+                self._program_name))
+
+            self._templates[template_id] = Template(subject, body, icon,
+                    timeout, append, update)
+
+        return template_id
+
+    @method(dbus_interface='org.pynoter.client_handler',
+            in_signature='ssa{ss}', out_signature='s')
+    def display_template(self, client, template_id, arguments):
+        """
+        Display a notification message which is created from a template.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param template_id: The unique identifier of the template.
+        :type template_id: str
+        :param arguments: The values of the placeholders of the template.
+        :type arguments: dict[str, str]
+        :rtype: str
+        :return: The unique identifier of the message which is going to be
+                 displayed.
+        """
+        template = self._templates.get(template_id)
+        if template is None:
+            raise ValueError("Unknown template.")
+
+        subject, body, icon = template.render(arguments)
+
+        return self.display_message(client, subject, body, icon,
+                template.timeout, template.append, template.update)
+
+    @method(dbus_interface='org.pynoter.client_handler',
+            in_signature='sssi', out_signature='s')
+    def open_progress(self, client, subject, icon = "", timeout = 6000):
+        """
+        Open a stream which reports the progress of a task. The progress is
+        displayed as one message which is updated with the latest value at a
+        limited rate, no matter how often the client pushes to the stream.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param subject: The subject of the messages of the stream.
+        :type subject: str
+        :param icon: The icon of the messages of the stream. (Defaults to "")
+        :type icon: str
+        :param timeout: The time in ms how long the messages should be visible.
+                        (Defaults to 6000)
+        :type timeout: int
+        :rtype: str
+        :return: The unique identifier of the progress stream.
+        """
+        with self._lock:
+            if not client in self._clients:
+                raise ValueError("This is not a registered client.")
+
+            if len(self._progress) >= ClientHandler.MAX_PROGRESS:
+                raise ValueError("Too many progress streams are open.")
+
+            stream = ProgressStream(client, subject, icon, timeout)
+            self._progress[stream.id] = stream
+
+        logger.debug("Open progress stream {} for {}.".format(stream.id,
+            client))
+
+        return stream.id
+
+    @method(dbus_interface='org.pynoter.client_handler', in_signature='ssds')
+    def push_progress(self, client, progress_id, value, text = ""):
+        """
+        Report the progress of a task. Only the latest value of a stream is
+        kept until it is rendered. If the value reaches 100, the stream is
+        rendered a last time and closed.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param progress_id: The unique identifier of the progress stream.
+        :type progress_id: str
+        :param value: The progress in percent.
+        :type value: float
+        :param text: The text which describes the current step.
+                     (Defaults to "")
+        :type text: str
+        :raises ValueError: If the stream is unknown or the value is not a
+                            finite number.
+        """
+        if not isfinite(value):
+            raise ValueError("The progress must be a finite number.")
+
+        with self._lock:
+            stream = self._progress.get(progress_id)
+            if stream is None or stream.client != client:
+                raise ValueError("Unknown progress stream.")
+
+            stream.push(value, text)
 
-        self._message_handler.enqueue(self, message)
+            self._schedule_progress(stream)
+
+    @method(dbus_interface='org.pynoter.client_handler', in_signature='ss')
+    def close_progress(self, client, progress_id):
+        """
+        Close a progress stream before it is complete. Its latest value is
+        still rendered.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param progress_id: The unique identifier of the progress stream.
+        :type progress_id: str
+        """
+        with self._lock:
+            stream = self._progress.get(progress_id)
+            if stream is None or stream.client != client:
+                raise ValueError("Unknown progress stream.")
+
+            stream.finished = True
+
+            self._schedule_progress(stream)
+
+    @method(dbus_interface='org.pynoter.client_handler',
+            in_signature='ssssibbsd', out_signature='s')
+    def display_message_at(self, client, subject, body = "", icon = "",
+            timeout = 6000, append = False, update = False, reference = "",
+            display_at = 0):
+        """
+        Display a notification message at a later point in time.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param subject: The subject of the message.
+        :type subject: str
+        :param body: The body of the message. (Defaults to "")
+        :type body: str
+        :param icon: The icon which should be displayed with the message. This
+                     can be either a name or a path. (Defaults to "")
+        :type icon: str
+        :param timeout: The time in ms how long the notification message should
+                        be visible. (Defaults to 6000)
+        :type timeout: int
+        :param append: Flag which indicates whether this message should be
+                       appended to the last one if possible. (Defaults to False)
+        :type append: bool
+        :param update: Flag which indicates whether this message should replace
+                       the last one if possible. (Defaults to False)
+        :type update: bool
+        :param reference: The unique identifier of the message which this message
+                          should replace or be appended to. This is only
+                          important if one of these flags are set.
+                          (Defaults to the id of the last displayed message)
+        :type reference: str
+        :param display_at: The time (in s since the epoch) when the message
+                           should be displayed. Times in the past cause the
+                           message to be displayed immediately. (Defaults to 0)
+        :type display_at: float
+        :rtype: str
+        :return: The unique identifier of the message which is going to be
+                 displayed.
+        """
+        with self._lock:
+            if not client in self._clients:
+                raise ValueError("This is not a registered client.")
+
+            logger.debug("Received new scheduled message from {}.".format(
+                client))
+
+            message = self._create_message(client, subject, body, icon,
+                    timeout, append, update, reference)
+
+            # The message is only referenced by the following ones once it
+            # is due.
+            self._track_message(message, False)
+
+            self._server.scheduler.schedule(self, message, display_at)
 
         return message.id
 
-    @signal(dbus_interface='org.pynoter.client_handler', signature='s')
-    def message_closed(self, message_id):
+    def message_due(self, message):
+        """
+        Remember that a scheduled message is due now, so that it is the last
+        one issued by this handler.
+
+        This method is normally executed on the scheduler's thread.
+
+        :param message: The message which is due.
+        :type message: Message
+        """
+        with self._lock:
+            self._last_message = message.id
+
+        self._server.touch_client_handler(self)
+
+    @signal(dbus_interface='org.pynoter.client_handler', signature='ssi')
+    def message_closed(self, client, message_id, reason):
         """
         Emit the message closed signal.
 
+        The client identifier is the first argument, so that clients can use
+        a match rule on it to only receive signals for their own messages.
+
+        :param client: The identifier of the client which sent the message.
+        :type client: str
         :param message_id: The identifier of the message which just got closed.
         :type message_id: str
+        :param reason: The reason why the message got closed.
+        :type reason: int
         """
         logger.debug("Emit 'message_closed' for {}.".format(message_id))
 
-    @method(dbus_interface='org.pynoter.client_handler', out_signature='s')
-    def register(self):
+    @signal(dbus_interface='org.pynoter.client_handler', signature='sa(si)')
+    def messages_closed(self, client, closed):
+        """
+        Emit the signal for multiple messages of a client which got closed at
+        the same time.
+
+        :param client: The identifier of the client which sent the messages.
+        :type client: str
+        :param closed: The identifiers of the messages which just got closed
+                       together with the reason why.
+        :type closed: list[(str, int)]
+        """
+        logger.debug("Emit 'messages_closed' for {} messages.".format(
+            len(closed)))
+
+    @method(dbus_interface='org.pynoter.client_handler', out_signature='s',
+            sender_keyword='sender', connection_keyword='connection')
+    def register(self, sender = None, connection = None):
         """
         Register a client at this handler.
 
+        :param sender: The unique bus name of the client or None for a client
+                       in the process of the server. (Set by DBus)
+        :type sender: str
+        :param connection: The connection on which the client calls.
+                           (Set by DBus)
+        :type connection: Connection
         :rtype: str
         :return: The unique identifier for the client.
         """
         logger.debug("A client registers for {} (handler: {})".format(
             self._program_name, self._id))
 
-        if len(self._clients) >= 1 and not self._multi_client:
-            # There is already a client registered and this handler can not
-            # handle multiple of them. So refuse to handle this client.
-            logger.error(("Another client tries to register although this " +
-                    "handler can not handle multiple clients. +"
-                    "(handler: {})").format(self._id))
-            raise ValueError("This handler only serves one client.")
+        with self._lock:
+            if self._program_name is None:
+                raise ValueError("This handler is not bound to a program.")
+
+            if len(self._clients) >= 1 and not self._multi_client:
+                # There is already a client registered and this handler can not
+                # handle multiple of them. So refuse to handle this client.
+                logger.error(("Another client tries to register although " +
+                        "this handler can not handle multiple clients. +"
+                        "(handler: {})").format(self._id))
+                raise ValueError("This handler only serves one client.")
 
-        # Create and save the unique identifier for the client.
-        client_id = ClientHandler.create_uniqe_client_id()
-        self._clients.append(client_id)
+            # Create and save the unique identifier for the client.
+            client_id = ClientHandler.create_uniqe_client_id()
+            self._clients.append(client_id)
+
+            for index, candidate in enumerate(self._connections):
+                if sender is not None and candidate is connection:
+                    self._watch_owner(client_id, index, sender)
+
+        self._server.touch_client_handler(self)
+        self._record(TraceRecorder.REGISTER, client_id)
 
         return client_id
 
@@ -311,15 +1097,28 @@ class ClientHandler(Object):
         :param client: The unique identifier of the client.
         :type client: str
         """
-        if not client in self._clients:
-            raise ValueError("This is not a registered client.")
+        with self._lock:
+            if not client in self._clients:
+                raise ValueError("This is not a registered client.")
 
-        logger.debug("A client unregisters for {} (handler: {})".format(
-            self._program_name, self._id))
+            logger.debug("A client unregisters for {} (handler: {})".format(
+                self._program_name, self._id))
+
+            self._clients.remove(client)
+            self._unwatch_owner(client)
+            remaining = len(self._clients)
 
-        self._clients.remove(client)
+            # Drop the progress streams of the client.
+            for stream in [s for s in self._progress.values()
+                    if s.client == client]:
+                del self._progress[stream.id]
 
-        if len(self._clients) == 0 and not self._lingering:
+        self._record(TraceRecorder.UNREGISTER, client)
+
+        with self._closed_lock:
+            self._closed_listeners.pop(client, None)
+
+        if remaining == 0 and not self._lingering:
             logger.debug(("Remove this handler as the last client unregistered. " +
                     "(handler: {})").format(self._id))
             # The last client unregistered and lingering is not supported.
@@ -328,6 +1127,111 @@ class ClientHandler(Object):
 
     # Normal Interface
 
+    def inject_message(self, client, subject, body, icon, timeout, append,
+            update, reference, message_id, display_at = None):
+        """
+        Enqueue a message which did not arrive via DBus, e.g. because it is
+        restored after a restart of the server. In contrast to
+        'display_message' the client must not be registered and the identifier
+        of the message is kept.
+
+        :param client: The unique identifier of the client which originally
+                       sent the message.
+        :type client: str
+        :param subject: The subject of the message.
+        :type subject: str
+        :param body: The body of the message.
+        :type body: str
+        :param icon: The icon which should be displayed with the message.
+        :type icon: str
+        :param timeout: The time in ms how long the message should be visible.
+        :type timeout: int
+        :param append: Flag which indicates whether this message should be
+                       appended to the last one if possible.
+        :type append: bool
+        :param update: Flag which indicates whether this message should replace
+                       the last one if possible.
+        :type update: bool
+        :param reference: The unique identifier of the message which this
+                          message should replace or be appended to. Use "" to
+                          reference the last message of this handler.
+        :type reference: str
+        :param message_id: The unique identifier of the message.
+        :type message_id: str
+        :param display_at: The time (in s since the epoch) when the message
+                           should be displayed or None to display it as soon as
+                           possible. (Defaults to None)
+        :type display_at: float
+        :rtype: Message
+        :return: The enqueued message.
+        """
+        logger.debug("Inject message {}.".format(message_id))
+
+        with self._lock:
+            message = self._create_message(client, subject, body, icon,
+                    timeout, append, update, reference, message_id)
+
+            self._track_message(message, display_at is None)
+
+            if display_at is not None:
+                self._server.scheduler.schedule(self, message, display_at)
+            else:
+                self._message_handler.enqueue(self, message)
+
+        return message
+
+    def bind(self, program_name, multi_client, lingering, dedup_window = 0):
+        """
+        Bind a handler from the pool of the server to a program and add it to
+        the server.
+
+        :param program_name: The name of the program for which this handler
+                             should handle clients.
+        :type program_name: str
+        :param multi_client: Flag which indicates if there will be more clients
+                             registering for the same client_name, which should
+                             be treated as one client.
+        :type multi_client: bool
+        :param lingering: Flag which indicates, that the handler for this
+                          client should stay alive even if the current client
+                          vanishes.
+        :type lingering: bool
+        :param dedup_window: The time in ms during which messages which are
+                             identical to an already shown or queued one are
+                             dropped. A value of 0 disables this.
+                             (Defaults to 0)
+        :type dedup_window: int
+        """
+        if self._program_name is not None:
+            raise RuntimeError("The handler is already bound to a program.")
+
+        logger.debug("Bind client handler {} to {}.".format(self._id,
+            program_name))
+
+        self._program_name = program_name
+        self._multi_client = multi_client
+        self._lingering = lingering
+        self._dedup_cache.window = dedup_window
+
+        self._add_to_server()
+
+    def set_closed_listener(self, client, listener):
+        """
+        Deliver the closed messages of a local client to the given callback
+        instead of emitting the DBus signals. The listener is dropped as soon
+        as the client unregisters.
+
+        The callback is called on the main loop with the list of identifiers
+        of the closed messages together with the reasons why.
+
+        :param client: The unique identifier of the client.
+        :type client: str
+        :param listener: The callback.
+        :type listener: callable
+        """
+        with self._closed_lock:
+            self._closed_listeners[client] = listener
+
     def can_handle(self, program_name, multi_client, lingering):
         """
         Check whether this handler can handle a client for the given program.
@@ -357,6 +1261,73 @@ class ClientHandler(Object):
 
         return False
 
+    def restore(self, state):
+        """
+        Restore the state of a handler which was taken over from another
+        server.
+
+        :param state: The state as created by 'snapshot'.
+        :type state: dict
+        """
+        self._clients = list(state['clients'])
+        self._last_message = state['last_message']
+
+        for client in list(self._owner_watches):
+            if not client in self._clients:
+                self._unwatch_owner(client)
+
+        for client, (index, owner) in state.get('owners', {}).items():
+            if client in self._clients and client not in self._owner_watches:
+                self._watch_owner(client, index, owner)
+
+        self._dedup_cache.window = state['dedup_window']
+
+        for source in state.get('templates', []):
+            template = Template(*source)
+            self._templates[template.id] = template
+
+    def snapshot(self):
+        """
+        Create a snapshot of the state of this handler, so that another server
+        can take it over.
+
+        :rtype: dict
+        :return: The state of this handler.
+        """
+        return {
+            'id': self._id,
+            'program': self._program_name,
+            'multi_client': self._multi_client,
+            'lingering': self._lingering,
+            'clients': list(self._clients),
+            'owners': dict((c, list(o)) for c, o in self._owners.items()),
+            'last_message': self._last_message,
+            'dedup_window': self._dedup_cache.window,
+            'templates': [t.source for t in self._templates.values()]
+        }
+
+    @property
+    def clients(self):
+        """
+        Get the identifiers of the currently registered clients.
+
+        :rtype: list[str]
+        :return: The identifiers of the registered clients.
+        """
+        return list(self._clients)
+
+    @property
+    def idle(self):
+        """
+        Whether or not this handler neither serves clients nor has messages
+        which are pending or visible, so that it can be removed safely.
+
+        :rtype: bool
+        :return: Whether or not the handler is idle.
+        """
+        with self._lock:
+            return len(self._clients) == 0 and self._open_messages == 0
+
     @property
     def id(self):
         """
@@ -367,6 +1338,36 @@ class ClientHandler(Object):
         """
         return self._id
 
+    @property
+    def icon_cache(self):
+        """
+        Get the cache of the decoded icons of the server.
+
+        :rtype: IconCache
+        :return: The icon cache or None if icons are not cached.
+        """
+        return self._server.icon_cache
+
+    @property
+    def lingering(self):
+        """
+        Whether or not this handler stays alive if all clients vanished.
+
+        :rtype: bool
+        :return: Whether or not lingering is enabled.
+        """
+        return self._lingering
+
+    @property
+    def multi_client(self):
+        """
+        Whether or not this handler serves multiple clients.
+
+        :rtype: bool
+        :return: Whether or not multi client is enabled.
+        """
+        return self._multi_client
+
     @property
     def notification(self):
         """
@@ -377,6 +1378,16 @@ class ClientHandler(Object):
         """
         return self._notification
 
+    @notification.setter
+    def notification(self, notification):
+        """
+        Set the internal notification object of this handler.
+
+        :param notification: The new notification object of this handler.
+        :type notification: Notification
+        """
+        self._notification = notification
+
     @property
     def path(self):
         """
@@ -387,3 +1398,13 @@ class ClientHandler(Object):
         """
         return self._object_path
 
+    @property
+    def program_name(self):
+        """
+        Get the name of the program which this handler serves.
+
+        :rtype: str
+        :return: The name of the program.
+        """
+        return self._program_name
+
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- deduplication cache
+#
+# The deduplication cache of the pynoter package. This class was designed to
+# detect messages which are identical to one which was recently shown or
+# queued by the same client handler, so that they are not displayed over and
+# over again.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from collections import OrderedDict
+
+from time import monotonic
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['DedupCache']
+
+
+class DedupCache:
+    """
+    A bounded LRU cache which maps the content of a message to the message
+    which was last seen with this content. Entries older than the configured
+    time window are treated as if they would not exist.
+    """
+
+    def __init__(self, window = 0, capacity = 256):
+        """
+        Constructor of the class.
+
+        :param window: The time in ms during which an identical message is
+                       treated as duplicate. A value of 0 disables the cache.
+                       (Defaults to 0)
+        :type window: int
+        :param capacity: The maximum number of entries which are kept in the
+                         cache. (Defaults to 256)
+        :type capacity: int
+        """
+        if capacity <= 0:
+            raise ValueError("The capacity of the cache must be positive.")
+
+        self._entries = OrderedDict()   #< Mapping from the content hash to a
+                                        #  tuple of the time of the first
+                                        #  occurrence and the message.
+
+        self._window = 0                #< The time window in seconds.
+        self._capacity = capacity       #< The maximum number of entries.
+
+        self.window = window
+
+    @staticmethod
+    def key(message):
+        """
+        Calculate the cache key for the given message.
+
+        :param message: The message for which the key should be calculated.
+        :type message: Message
+        :rtype: int
+        :return: The cache key of the message.
+        """
+        return hash((message.subject, message.body, message.icon,
+            message.appends, message.updates))
+
+    def lookup(self, message):
+        """
+        Find a message which was seen within the time window and which is
+        identical to the given one.
+
+        :param message: The message for which a duplicate should be searched.
+        :type message: Message
+        :rtype: Message
+        :return: The identical message or None if there is none.
+        """
+        if not self.enabled:
+            return None
+
+        key = DedupCache.key(message)
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        timestamp, original = entry
+
+        if monotonic() - timestamp > self._window:
+            # The entry is outdated. So it can not be used any longer.
+            del self._entries[key]
+            return None
+
+        # Mark the entry as recently used.
+        self._entries.move_to_end(key)
+
+        if original.subject != message.subject or \
+                original.body != message.body or \
+                original.icon != message.icon:
+            # Just a hash collision.
+            return None
+
+        return original
+
+    def insert(self, message):
+        """
+        Remember the given message so that following identical messages can
+        be detected.
+
+        :param message: The message which should be remembered.
+        :type message: Message
+        """
+        if not self.enabled:
+            return
+
+        key = DedupCache.key(message)
+
+        self._entries[key] = (monotonic(), message)
+        self._entries.move_to_end(key)
+
+        # Bound the memory usage of the cache by evicting the least recently
+        # used entries.
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        self._entries.clear()
+
+    def __len__(self):
+        """
+        Get the number of entries in the cache.
+
+        :rtype: int
+        :return: The number of entries in the cache.
+        """
+        return len(self._entries)
+
+    @property
+    def capacity(self):
+        """
+        Get the maximum number of entries of the cache.
+
+        :rtype: int
+        :return: The maximum number of entries.
+        """
+        return self._capacity
+
+    @property
+    def enabled(self):
+        """
+        Whether or not the cache is enabled.
+
+        :rtype: bool
+        :return: Whether or not duplicates are detected.
+        """
+        return self._window > 0
+
+    @property
+    def window(self):
+        """
+        Get the time window of the cache.
+
+        :rtype: int
+        :return: The time in ms during which identical messages are treated
+                 as duplicates.
+        """
+        return int(self._window * 1000)
+
+    @window.setter
+    def window(self, window):
+        """
+        Set the time window of the cache.
+
+        :param window: The time in ms during which identical messages are
+                       treated as duplicates. A value of 0 disables the cache.
+        :type window: int
+        """
+        if window < 0:
+            raise ValueError("The time window must not be negative.")
+
+        self._window = window / 1000
+
+        if not self.enabled:
+            self.clear()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- flight recorder
+#
+# The flight recorder of the pynoter package. This class keeps the most
+# recent events of the server (enqueued, revised, displayed and closed
+# messages, closures and the life cycle of the client handlers) in a ring of
+# preallocated slots, so that it can always be on. Recording an event does
+# not take a lock and does not allocate a slot. The ring is only ordered and
+# formatted when it is dumped, e.g. after a stall, to see what the server did
+# last.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from itertools import count
+
+from os import fdopen, makedirs, remove, rename
+from os.path import basename, dirname
+
+from tempfile import mkstemp
+
+from time import localtime, strftime, time
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['FlightRecorder']
+
+
+class FlightRecorder:
+    """
+    This class is the ring buffer which keeps the most recent events.
+
+    Events can be recorded from any thread. If two threads record at the same
+    time, each of them gets its own slot. A dump which runs concurrently may
+    miss the events which are just recorded.
+    """
+
+    ENQUEUE = 0                 #< A message was enqueued.
+    REVISE = 1                  #< A message revises a displayed one.
+    CLOSURE = 2                 #< The closure of a message was calculated.
+    DISPLAY = 3                 #< A message was displayed.
+    DISPLAY_FAILED = 4          #< A message could not be displayed.
+    CLOSE = 5                   #< A message got closed.
+    HANDLER_CREATE = 6          #< A client handler was created.
+    HANDLER_BIND = 7            #< A pooled client handler was bound.
+    HANDLER_REMOVE = 8          #< A client handler was removed.
+    HANDLER_EVICT = 9           #< An idle client handler was evicted.
+
+    NAMES = ['enqueue', 'revise', 'closure', 'display', 'display-failed',
+            'close', 'handler-create', 'handler-bind', 'handler-remove',
+            'handler-evict']    #< The names of the events by kind.
+
+    def __init__(self, size = 4096):
+        """
+        Constructor of the class. All slots are allocated here.
+
+        :param size: The number of events which are kept. (Defaults to 4096)
+        :type size: int
+        """
+        # Internal variables
+        self._size = max(size, 1)
+
+        self._counter = count()         #< The sequence number of the next
+                                        #  event. Taking a number is atomic.
+
+        self._sequences = [-1] * self._size #< The sequence number of the
+                                        #  event in each slot or -1.
+        self._times = [0.0] * self._size #< The time of the event in each slot.
+        self._kinds = [0] * self._size  #< The kind of the event in each slot.
+        self._ids = [""] * self._size   #< The identifier of the message or
+                                        #  handler in each slot.
+        self._details = [""] * self._size #< Further details in each slot.
+
+    def record(self, kind, ident, detail = ""):
+        """
+        Record an event.
+
+        :param kind: The kind of the event.
+        :type kind: int
+        :param ident: The identifier of the message or handler.
+        :type ident: str
+        :param detail: Further details of the event. (Defaults to '')
+        :type detail: str
+        """
+        sequence = next(self._counter)
+        slot = sequence % self._size
+
+        # Mark the slot as incomplete while it is written.
+        self._sequences[slot] = -1
+        self._times[slot] = time()
+        self._kinds[slot] = kind
+        self._ids[slot] = ident
+        self._details[slot] = detail
+        self._sequences[slot] = sequence
+
+    def events(self):
+        """
+        Get the events which are currently kept.
+
+        :rtype: list[(float, str, str, str)]
+        :return: The time, the name of the kind, the identifier and the details
+                 of each event, oldest first.
+        """
+        events = []
+
+        for slot in range(self._size):
+            sequence = self._sequences[slot]
+            if sequence < 0:
+                continue
+
+            events.append((sequence, self._times[slot],
+                FlightRecorder.NAMES[self._kinds[slot]], self._ids[slot],
+                self._details[slot]))
+
+        events.sort()
+
+        return [event[1:] for event in events]
+
+    def dump(self, path):
+        """
+        Write the events which are currently kept to the given file. An
+        existing file is replaced.
+
+        The events are written to a new temporary file next to it first, which
+        is created exclusively, so that a symlink planted at a predictable
+        name can not redirect the dump.
+
+        :param path: The path of the file.
+        :type path: str
+        :rtype: int
+        :return: The number of events which were written.
+        """
+        events = self.events()
+
+        directory = dirname(path)
+        if directory:
+            makedirs(directory, exist_ok=True)
+
+        fd, temporary = mkstemp(prefix=basename(path) + ".",
+                suffix=".tmp", dir=directory or None)
+
+        try:
+            with fdopen(fd, 'w') as f:
+                for at, kind, ident, detail in events:
+                    line = "{}.{:06d} {:<15} {} {}".format(
+                            strftime("%Y-%m-%d %H:%M:%S", localtime(at)),
+                            int(at % 1 * 1000000), kind, ident, detail)
+
+                    f.write(line.rstrip() + "\n")
+
+            # Renaming replaces a symlink at the path instead of following it.
+            rename(temporary, path)
+        except BaseException:
+            remove(temporary)
+            raise
+
+        logger.debug("Dumped {} events to {}.".format(len(events), path))
+
+        return len(events)
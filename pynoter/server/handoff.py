@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- handoff
+#
+# The hand-off protocol of the pynoter package. It allows a newly started
+# server to take over the state of a running one without dropping any client.
+# The servers talk over a local socket:
+#
+#   new -> old: HANDOFF           old holds back its messages and sends the
+#                                 snapshot of its handlers
+#   old -> new: <snapshot>
+#   new -> old: READY             new restored the snapshot and waits for the
+#                                 bus name
+#   old -> new: <snapshot>        old released the bus name and sends its
+#                                 pending messages and what changed in the
+#                                 meantime
+#
+# The old server keeps processing DBus calls while it waits for the new one,
+# but does not display any message anymore.
+# Only taking the snapshots and releasing the bus name run on its main loop.
+# The socket lives in the private runtime directory and only accepts
+# connections of processes of the same user.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from json import dumps, loads
+
+from os import getuid, remove, stat
+from os.path import join
+
+from socket import socket, AF_UNIX, SOCK_STREAM, SOL_SOCKET, SO_PEERCRED
+
+from struct import Struct
+
+from threading import Thread
+
+import logging
+
+from pynoter.spool import runtime_dir
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['HandoffListener', 'handoff_address', 'request_handoff',
+        'confirm_handoff', 'serve_handoff']
+
+
+LENGTH = Struct('!I')           #< The length prefix of each message.
+
+TIMEOUT = 10                    #< The time in s each side waits for the other.
+
+CREDENTIALS = Struct('3i')      #< The pid, uid and gid of a peer.
+
+
+def handoff_address(bus_name):
+    """
+    Get the address of the hand-off socket of the server with the given bus
+    name.
+
+    :param bus_name: The bus name of the server.
+    :type bus_name: str
+    :rtype: str
+    :return: The path of the socket.
+    :raises RuntimeError: If the runtime directory is not private.
+    """
+    return join(runtime_dir(), bus_name + '.handoff')
+
+
+def send_message(connection, message):
+    """
+    Send a message over the hand-off socket.
+
+    :param connection: The socket.
+    :type connection: socket
+    :param message: The message, which must be serializable as JSON.
+    :type message: object
+    """
+    data = dumps(message).encode()
+    connection.sendall(LENGTH.pack(len(data)) + data)
+
+
+def receive_message(connection):
+    """
+    Receive a message from the hand-off socket.
+
+    :param connection: The socket.
+    :type connection: socket
+    :rtype: object
+    :return: The received message.
+    """
+    def receive(size):
+        data = b''
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("The other server closed the connection.")
+            data += chunk
+
+        return data
+
+    length, = LENGTH.unpack(receive(LENGTH.size))
+
+    return loads(receive(length).decode())
+
+
+def request_handoff(bus_name):
+    """
+    Ask the running server with the given bus name to hand over its state.
+
+    :param bus_name: The bus name of the running server.
+    :type bus_name: str
+    :rtype: (socket, dict)
+    :return: The connection to the old server and its snapshot.
+    """
+    logger.debug("Request hand-off from {}.".format(bus_name))
+
+    connection = socket(AF_UNIX, SOCK_STREAM)
+    connection.settimeout(TIMEOUT)
+
+    try:
+        connection.connect(handoff_address(bus_name))
+
+        send_message(connection, "HANDOFF")
+        snapshot = receive_message(connection)
+    except (OSError, RuntimeError, ValueError) as e:
+        connection.close()
+
+        logger.error("Failed to receive the state of the running server: {}"
+                .format(e))
+        raise ValueError("The running server did not hand over its state.")
+
+    return connection, snapshot
+
+
+def confirm_handoff(connection):
+    """
+    Tell the old server that the snapshot was restored and wait until it
+    released the bus name.
+
+    :param connection: The connection to the old server.
+    :type connection: socket
+    :rtype: dict
+    :return: The snapshot of the state which changed on the old server since
+             the first snapshot.
+    """
+    try:
+        send_message(connection, "READY")
+
+        snapshot = receive_message(connection)
+        if not isinstance(snapshot, dict):
+            raise ValueError("Unexpected answer.")
+
+        return snapshot
+    except (OSError, ValueError) as e:
+        logger.error("The running server did not release its name: {}"
+                .format(e))
+        raise ValueError("The running server did not release its name.")
+    finally:
+        connection.close()
+
+
+class HandoffListener(Thread):
+    """
+    This class is the thread which waits for a new server to request the state
+    of the current one.
+    """
+
+    def __init__(self, server, bus_name):
+        """
+        Constructor of the class.
+
+        :param server: The server whose state should be handed over.
+        :type server: Server
+        :param bus_name: The bus name of the server.
+        :type bus_name: str
+        """
+        super(HandoffListener, self).__init__(daemon=True)
+
+        self._server = server
+        self._address = handoff_address(bus_name)
+
+        try:
+            remove(self._address)
+        except FileNotFoundError:
+            pass
+
+        self._socket = socket(AF_UNIX, SOCK_STREAM)
+        self._socket.bind(self._address)
+        self._socket.listen(1)
+
+        # Remember the socket file, so that we do not remove the one of the
+        # server which took over.
+        self._inode = stat(self._address).st_ino
+
+    def run(self):
+        """
+        Main execution routine of the listener.
+        """
+        logger.debug("Hand-off listener started at {}.".format(self._address))
+
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                # The socket got closed.
+                break
+
+            connection.settimeout(TIMEOUT)
+
+            # Only the same user may take over the server, as the snapshot
+            # contains the messages of all clients.
+            _, uid, _ = CREDENTIALS.unpack(connection.getsockopt(SOL_SOCKET,
+                SO_PEERCRED, CREDENTIALS.size))
+
+            if uid != getuid():
+                logger.warning("Refuse hand-off request of user {}.".format(
+                    uid))
+                connection.close()
+                continue
+
+            try:
+                if receive_message(connection) != "HANDOFF":
+                    raise ValueError("Unexpected request.")
+            except (OSError, ValueError) as e:
+                logger.warning("Invalid hand-off request: {}".format(e))
+                connection.close()
+                continue
+
+            if self._server.hand_off(connection):
+                break
+
+        logger.debug("Hand-off listener stopped.")
+
+    def stop(self):
+        """
+        Stop listening for hand-off requests.
+        """
+        self._socket.close()
+
+        try:
+            if stat(self._address).st_ino == self._inode:
+                remove(self._address)
+        except FileNotFoundError:
+            pass
+
+
+def serve_handoff(connection, snapshot, release):
+    """
+    Perform the old server's part of the hand-off after the snapshot was
+    taken.
+
+    :param connection: The connection to the new server.
+    :type connection: socket
+    :param snapshot: The snapshot of the old server.
+    :type snapshot: dict
+    :param release: Function which releases the bus name of the old server
+                    and returns the snapshot of what changed since the first
+                    one.
+    :type release: callable
+    :rtype: bool
+    :return: Whether or not the new server took over.
+    """
+    released = False
+
+    try:
+        send_message(connection, snapshot)
+
+        if receive_message(connection) != "READY":
+            raise ValueError("Unexpected answer.")
+
+        changes = release()
+        released = True
+
+        send_message(connection, changes)
+    except (OSError, ValueError) as e:
+        logger.error("Hand-off failed: {}".format(e))
+    finally:
+        connection.close()
+
+    return released
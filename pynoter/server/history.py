@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- history
+#
+# The history of the pynoter package. This sink keeps the most recent
+# messages in a ring buffer of fixed size, so that they can still be looked
+# up after they closed. The buffer is indexed by message id and by program.
+# As messages enter the buffer in the order in which they were received, the
+# buffer and the per program indexes are sorted by time as well and can be
+# searched with a binary search instead of a scan. To keep this true for
+# events which were submitted by different threads, the receive times are
+# made strictly increasing, which also makes them usable as paging tokens.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from threading import Lock
+
+import logging
+
+from pynoter.server.sink import Sink
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['History']
+
+
+class History(Sink):
+    """
+    A sink which keeps a bounded, queryable history of all messages.
+    """
+
+    MAX_BODY = 1024             #< The maximum length of a body which is kept.
+
+    class Entry:
+        """
+        A single message in the history.
+        """
+
+        __slots__ = ['sequence', 'id', 'program', 'subject', 'body', 'icon',
+                'received', 'displayed', 'closed', 'reason']
+
+        def __init__(self, sequence, event, received):
+            """
+            Constructor of the class.
+
+            :param sequence: The sequence number of the entry.
+            :type sequence: int
+            :param event: The 'enqueued' event of the message.
+            :type event: dict
+            :param received: The time (in s since the epoch) when the message
+                             was received.
+            :type received: float
+            """
+            self.sequence = sequence
+            self.id = event['id']
+            self.program = event['program']
+            self.subject = event['subject']
+            self.body = event['body'][:History.MAX_BODY]
+            self.icon = event['icon']
+            self.received = received
+            self.displayed = 0.0
+            self.closed = 0.0
+            self.reason = 0
+
+        def as_tuple(self):
+            """
+            Get the entry as tuple, as it is sent via DBus.
+
+            :rtype: tuple
+            :return: The id, program, subject, body, icon, the times when the
+                     message was received, displayed and closed (or 0) and the
+                     reason why it was closed (or 0).
+            """
+            return (self.id, self.program, self.subject, self.body, self.icon,
+                    self.received, self.displayed, self.closed, self.reason)
+
+    def __init__(self, capacity = 1000):
+        """
+        Constructor of the class.
+
+        :param capacity: The maximum number of messages which are kept.
+                         (Defaults to 1000)
+        :type capacity: int
+        """
+        super(History, self).__init__("history")
+
+        if capacity <= 0:
+            raise ValueError("The capacity of the history must be positive.")
+
+        self._buffer = [None] * capacity #< The ring buffer of entries.
+        self._size = capacity       #< The number of slots of the ring buffer.
+        self._next = 0              #< The sequence number of the next entry.
+        self._last = 0.0            #< The receive time of the newest entry.
+
+        self._by_id = {}            #< Index of the entries by message id.
+
+        self._by_program = {}       #< Index of the entries by program. Each
+                                    #  value is a list of sequence numbers and
+                                    #  the position of the first valid one.
+
+        self._lock = Lock()         #< Lock to protect the buffer and indexes.
+
+    def _first(self):
+        """
+        Get the sequence number of the oldest entry.
+
+        :rtype: int
+        :return: The sequence number of the oldest entry.
+        """
+        return max(0, self._next - self._size)
+
+    def _entry(self, sequence):
+        """
+        Get the entry with the given sequence number.
+
+        :param sequence: The sequence number.
+        :type sequence: int
+        :rtype: Entry
+        :return: The entry.
+        """
+        return self._buffer[sequence % self._size]
+
+    def _add(self, event):
+        """
+        Add a new entry for the given 'enqueued' event. If the buffer is full,
+        the oldest entry is overwritten.
+
+        :param event: The event of the message.
+        :type event: dict
+        """
+        sequence = self._next
+        old = self._buffer[sequence % self._size]
+
+        if old is not None:
+            # Remove the overwritten entry from the indexes. As it is the oldest
+            # entry, it is the first one of its program as well.
+            if self._by_id.get(old.id) is old:
+                del self._by_id[old.id]
+
+            sequences = self._by_program[old.program]
+            sequences[1] += 1
+
+            if sequences[1] == len(sequences[0]):
+                del self._by_program[old.program]
+            elif sequences[1] > len(sequences[0]) // 2:
+                # Compact the list from time to time.
+                del sequences[0][:sequences[1]]
+                sequences[1] = 0
+
+        self._last = max(event['time'], self._last + 1e-6)
+        entry = History.Entry(sequence, event, self._last)
+
+        self._buffer[sequence % self._size] = entry
+        self._by_id[entry.id] = entry
+        self._by_program.setdefault(entry.program, [[], 0])[0].append(sequence)
+
+        self._next += 1
+
+    def _bisect(self, sequences, low, since):
+        """
+        Find the first position in a list of sequence numbers whose entry was
+        received after the given time.
+
+        :param sequences: The sequence numbers, sorted by time.
+        :type sequences: list[int] or range
+        :param low: The first valid position in the list.
+        :type low: int
+        :param since: The time (in s since the epoch).
+        :type since: float
+        :rtype: int
+        :return: The position of the first newer entry.
+        """
+        high = len(sequences)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self._entry(sequences[middle]).received <= since:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def process(self, event):
+        """
+        Record the event in the history.
+
+        :param event: The event which should be processed.
+        :type event: dict
+        """
+        with self._lock:
+            if event['kind'] == 'enqueued':
+                self._add(event)
+                return
+
+            entry = self._by_id.get(event['id'])
+            if entry is None:
+                return
+
+            if event['kind'] == 'displayed':
+                entry.displayed = event['time']
+            elif event['kind'] == 'closed':
+                entry.closed = event['time']
+                entry.reason = event['reason']
+
+    def lookup(self, message_id):
+        """
+        Get the history entry of the given message.
+
+        :param message_id: The identifier of the message.
+        :type message_id: str
+        :rtype: tuple
+        :return: The entry (see 'Entry.as_tuple') or None if the message is not
+                 part of the history.
+        """
+        with self._lock:
+            entry = self._by_id.get(message_id)
+
+            return entry.as_tuple() if entry is not None else None
+
+    def query(self, program = "", since = 0, limit = 100):
+        """
+        Get the messages which were received after the given time. To get the
+        next page, use the receive time of the last returned message.
+
+        :param program: The program whose messages should be returned. Use ""
+                        for all programs. (Defaults to "")
+        :type program: str
+        :param since: Only messages received after this time (in s since the
+                      epoch) are returned. (Defaults to 0)
+        :type since: float
+        :param limit: The maximum number of messages which are returned.
+                      (Defaults to 100)
+        :type limit: int
+        :rtype: list[tuple]
+        :return: The entries (see 'Entry.as_tuple'), oldest first.
+        """
+        with self._lock:
+            if program == "":
+                sequences = range(self._next)
+                low = self._first()
+            elif program in self._by_program:
+                sequences, low = self._by_program[program]
+            else:
+                return []
+
+            start = self._bisect(sequences, low, since)
+            stop = min(len(sequences), start + max(limit, 0))
+
+            return [self._entry(sequences[i]).as_tuple()
+                    for i in range(start, stop)]
+
+    def recent(self, program = "", limit = 100):
+        """
+        Get the most recently received messages.
+
+        :param program: The program whose messages should be returned. Use ""
+                        for all programs. (Defaults to "")
+        :type program: str
+        :param limit: The maximum number of messages which are returned.
+                      (Defaults to 100)
+        :type limit: int
+        :rtype: list[tuple]
+        :return: The entries (see 'Entry.as_tuple'), oldest first.
+        """
+        with self._lock:
+            if program == "":
+                sequences = range(self._next)
+                low = self._first()
+            elif program in self._by_program:
+                sequences, low = self._by_program[program]
+            else:
+                return []
+
+            start = max(low, len(sequences) - max(limit, 0))
+
+            return [self._entry(sequences[i]).as_tuple()
+                    for i in range(start, len(sequences))]
+
+    def __len__(self):
+        """
+        Get the number of messages in the history.
+
+        :rtype: int
+        :return: The number of messages.
+        """
+        with self._lock:
+            return self._next - self._first()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- icon cache
+#
+# The icon cache of the pynoter package. Icons which are given as paths to
+# image files are decoded and scaled once on a small pool of worker threads,
+# as soon as a message which uses them arrives. When the message is displayed
+# later on, the decoded image is handed to the notification daemon directly,
+# so neither the worker of the message handler nor the daemon has to load the
+# file again. The decoded images are kept in a least recently used cache which
+# is bounded by their size in bytes. They are keyed by the path together with
+# the modification time and the size of the file, so that an image file which
+# is replaced is decoded again. Icon names of the icon theme are passed
+# on unchanged, as the notification daemon resolves them itself.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+
+from gi.repository.GdkPixbuf import Pixbuf
+from gi.repository.GLib import Error as GLibError
+
+from collections import OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor
+
+from os import stat
+from os.path import abspath, expanduser
+
+from threading import Lock
+
+from urllib.parse import unquote, urlparse
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['IconCache']
+
+
+class IconCache:
+    """
+    This class resolves and decodes the icons of messages in the background
+    and keeps the decoded images.
+    """
+
+    FAILED = object()               #< Marker for icons which can not be
+                                    #  decoded.
+
+    def __init__(self, max_bytes = 32 * 1024 * 1024, workers = 2,
+            icon_size = 64):
+        """
+        Constructor of the class.
+
+        :param max_bytes: The maximum size of all decoded images in bytes.
+                          (Defaults to 32MiB)
+        :type max_bytes: int
+        :param workers: The number of threads which decode the images.
+                        (Defaults to 2)
+        :type workers: int
+        :param icon_size: The size in pixel to which the images are scaled
+                          down, keeping their aspect ratio. (Defaults to 64)
+        :type icon_size: int
+        """
+        logger.debug("Create icon cache with {} bytes.".format(max_bytes))
+
+        # Internal variables
+        self._max_bytes = max_bytes
+        self._icon_size = icon_size
+
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1),
+                thread_name_prefix="pynoter-icons") #< The decoding workers.
+
+        self._paths = {}                #< The resolved path of each icon or
+                                        #  None if it is a name.
+
+        self._images = OrderedDict()    #< The decoded images by key, the
+                                        #  least recently used first.
+        self._keys = {}                 #< The key of the decoded image of
+                                        #  each path.
+        self._bytes = 0                 #< The size of all decoded images.
+
+        self._pending = set()           #< The keys which are being decoded.
+
+        self._hits = 0                  #< The number of displayed icons which
+                                        #  were decoded already.
+        self._misses = 0                #< The number of displayed icons which
+                                        #  were not decoded yet.
+        self._evicted = 0               #< The number of evicted images.
+
+        self._lock = Lock()             #< Lock for the paths and images.
+
+    @staticmethod
+    def _resolve(icon):
+        """
+        Get the path of the image file of an icon.
+
+        :param icon: The icon as given by the client.
+        :type icon: str
+        :rtype: str
+        :return: The absolute path or None if the icon is a name.
+        """
+        if icon.startswith('file://'):
+            return abspath(unquote(urlparse(icon).path))
+
+        if icon.startswith('/') or icon.startswith('~') or \
+                icon.startswith('.'):
+            return abspath(expanduser(icon))
+
+        return None
+
+    @staticmethod
+    def _key(path):
+        """
+        Get the key of the image file at the given path in the cache.
+
+        :param path: The path of the image file.
+        :type path: str
+        :rtype: tuple
+        :return: The path together with the modification time and the size of
+                 the file, which are None if the file can not be accessed.
+        """
+        try:
+            st = stat(path)
+        except OSError:
+            return (path, None, None)
+
+        return (path, st.st_mtime_ns, st.st_size)
+
+    @staticmethod
+    def _size(image):
+        """
+        Get the size of a decoded image in bytes.
+
+        :param image: The decoded image.
+        :type image: Pixbuf
+        :rtype: int
+        :return: The size in bytes.
+        """
+        if image is IconCache.FAILED:
+            # Count failed icons as well, so that their number is bounded.
+            return 1024
+
+        return image.get_rowstride() * image.get_height()
+
+    def _decode(self, key):
+        """
+        Decode and scale the image with the given key and add it to the cache.
+
+        This method runs on the workers.
+
+        :param key: The key of the image file (see '_key').
+        :type key: tuple
+        """
+        path = key[0]
+
+        try:
+            image = Pixbuf.new_from_file_at_scale(path, self._icon_size,
+                    self._icon_size, True)
+        except GLibError as e:
+            logger.warning("Failed to load icon {}: {}".format(path, e))
+            image = IconCache.FAILED
+
+        size = IconCache._size(image)
+
+        with self._lock:
+            self._pending.discard(key)
+
+            if size > self._max_bytes:
+                return
+
+            # Drop the image of an older version of the file.
+            outdated = self._keys.pop(path, None)
+            if outdated is not None and outdated in self._images:
+                self._bytes -= IconCache._size(self._images.pop(outdated))
+
+            self._images[key] = image
+            self._keys[path] = key
+            self._bytes += size
+
+            while self._bytes > self._max_bytes:
+                (evicted_path, _, _), evicted = self._images.popitem(
+                        last=False)
+                self._bytes -= IconCache._size(evicted)
+                self._evicted += 1
+
+                del self._keys[evicted_path]
+
+    def _path(self, icon):
+        """
+        Get the resolved path of an icon, resolving it only once. The lock
+        must be held.
+
+        :param icon: The icon as given by the client.
+        :type icon: str
+        :rtype: str
+        :return: The absolute path or None if the icon is a name.
+        """
+        try:
+            return self._paths[icon]
+        except KeyError:
+            pass
+
+        path = IconCache._resolve(icon)
+
+        # Do not let a client fill the memory with distinct icon names.
+        if len(self._paths) >= 4096:
+            self._paths.clear()
+
+        self._paths[icon] = path
+
+        return path
+
+    def prefetch(self, icon):
+        """
+        Start to decode the given icon in the background if it is an image
+        file which is not decoded yet.
+
+        :param icon: The icon as given by the client.
+        :type icon: str
+        """
+        if not icon:
+            return
+
+        with self._lock:
+            path = self._path(icon)
+
+        if path is not None:
+            self._prefetch(IconCache._key(path))
+
+    def _prefetch(self, key):
+        """
+        Start to decode the image with the given key in the background if it
+        is not decoded yet.
+
+        :param key: The key of the image file (see '_key').
+        :type key: tuple
+        """
+        with self._lock:
+            if key in self._images or key in self._pending:
+                return
+
+            self._pending.add(key)
+
+        try:
+            self._executor.submit(self._decode, key)
+        except RuntimeError:
+            # The cache was shut down in the meantime.
+            with self._lock:
+                self._pending.discard(key)
+
+    def lookup(self, icon):
+        """
+        Get the decoded image of the given icon. This never waits for an image
+        which is still being decoded.
+
+        :param icon: The icon as given by the client.
+        :type icon: str
+        :rtype: Pixbuf
+        :return: The decoded image or None if the icon should be passed on as
+                 it is.
+        """
+        if not icon:
+            return None
+
+        with self._lock:
+            path = self._path(icon)
+            if path is None:
+                return None
+
+        # Check whether the file changed since it was decoded.
+        key = IconCache._key(path)
+
+        with self._lock:
+            image = self._images.get(key)
+
+            if image is None:
+                self._misses += 1
+            else:
+                self._images.move_to_end(key)
+                self._hits += 1
+
+        if image is None:
+            # Make sure that the next message with this icon finds it.
+            self._prefetch(key)
+            return None
+
+        if image is IconCache.FAILED:
+            return None
+
+        return image
+
+    def shutdown(self):
+        """
+        Stop the workers and drop all decoded images.
+        """
+        self._executor.shutdown(wait=False)
+
+        with self._lock:
+            self._images.clear()
+            self._keys.clear()
+            self._bytes = 0
+
+    @property
+    def statistics(self):
+        """
+        Get the statistics of the cache.
+
+        :rtype: dict
+        :return: The number of cached images, their size in bytes and the
+                 number of hits, misses and evicted images.
+        """
+        with self._lock:
+            return {
+                'images': float(len(self._images)),
+                'bytes': float(self._bytes),
+                'hits': float(self._hits),
+                'misses': float(self._misses),
+                'evicted': float(self._evicted)
+            }
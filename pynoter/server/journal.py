@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- journal
+#
+# The journal of the pynoter package. This class was designed to keep the
+# messages which are waiting to be displayed safe across restarts and crashes
+# of the server. Every enqueue, display and close is appended to a segmented
+# log on disk. Scheduled messages are recorded as soon as they are scheduled,
+# together with the time when they are due. A dedicated writer thread collects
+# all records which arrived while the previous batch was written and commits
+# them together, so that only one fsync is needed per batch. Segments which
+# only contain messages which were already displayed or closed are deleted
+# again.
+#
+# Each server writes into its own instance directory below the journal
+# directory, as a server which takes over from another one runs at the same
+# time for a while. The instances of servers which are gone are recovered by
+# the next server which starts without a hand-off.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from json import dumps, loads
+
+from os import fsync, listdir, makedirs, mkdir, remove, rmdir
+from os.path import join
+
+from struct import Struct
+
+from threading import Thread, Condition
+
+from zlib import crc32
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['Journal']
+
+
+class Journal(Thread):
+    """
+    This class is the worker thread which writes the records of the journal
+    to disk. It also provides the facility to recover the messages which were
+    still pending when the server stopped.
+    """
+
+    ENQUEUE = 1                 #< Record kind for an enqueued message.
+    DISPLAY = 2                 #< Record kind for a displayed message.
+    CLOSE = 3                   #< Record kind for a closed message.
+
+    HEADER = Struct('<IIB')     #< The header of each record consisting of the
+                                #  length and checksum of the payload and the
+                                #  kind of the record.
+
+    SEGMENT_NAME = "segment-{:08d}.log" #< The file name of a segment.
+
+    INSTANCE_NAME = "instance-{:08d}" #< The name of the directory of the
+                                #  segments of one server.
+
+    def __init__(self, directory, segment_size = 4 * 1024 * 1024):
+        """
+        Constructor of the class.
+
+        :param directory: The directory where the segments of the journal are
+                          stored. The segments of this journal are written to
+                          a new instance directory within it.
+        :type directory: str
+        :param segment_size: The size in bytes after which a new segment is
+                             started. (Defaults to 4MiB)
+        :type segment_size: int
+        """
+        logger.debug("Create a new journal in {}.".format(directory))
+
+        # Call the super constructor to properly setup the thread.
+        super(Journal, self).__init__()
+
+        makedirs(directory, exist_ok=True)
+
+        # Internal variables.
+        self._base = directory      #< The directory of all instances.
+        self._directory = self._create_instance() #< The directory of the
+                                    #  segments of this journal.
+        self._segment_size = segment_size
+
+        self._should_stop = False   #< Indicates that the thread should stop
+                                    #  its loop.
+
+        self._pending = []          #< The encoded records which are waiting
+                                    #  to be written.
+
+        self._written = 0           #< The number of records written so far.
+        self._submitted = 0         #< The number of records submitted so far.
+
+        self._condition = Condition() #< Condition to protect the pending
+                                    #  records and to wake up the thread.
+
+        self._segments = []         #< The numbers of all existing segments
+                                    #  in ascending order.
+
+        self._next_segment = 0      #< The number of the next segment.
+
+        self._segment = None        #< The file of the active segment.
+        self._segment_bytes = 0     #< The size of the active segment.
+
+        self._live = {}             #< Mapping of the ids of all messages
+                                    #  which are not displayed or closed yet
+                                    #  to the segment they were enqueued in.
+
+        self._live_count = {}       #< The number of live messages per
+                                    #  segment.
+
+        self._recovered = set()     #< The ids of recovered messages which are
+                                    #  already part of the journal again.
+
+    @staticmethod
+    def _numbers(directory, prefix, suffix):
+        """
+        Get the numbers of the entries of a directory with the given name
+        pattern in ascending order.
+
+        :param directory: The directory.
+        :type directory: str
+        :param prefix: The prefix of the names.
+        :type prefix: str
+        :param suffix: The suffix of the names.
+        :type suffix: str
+        :rtype: list[int]
+        :return: The numbers.
+        """
+        end = -len(suffix) if suffix else None
+
+        return sorted(int(name[len(prefix):end]) for name in listdir(directory)
+                if name.startswith(prefix) and name.endswith(suffix) and
+                name[len(prefix):end].isdigit())
+
+    def _create_instance(self):
+        """
+        Create the instance directory of this journal.
+
+        :rtype: str
+        :return: The path of the instance directory.
+        """
+        while True:
+            numbers = Journal._numbers(self._base, "instance-", "")
+            number = numbers[-1] + 1 if numbers else 0
+
+            path = join(self._base, Journal.INSTANCE_NAME.format(number))
+
+            try:
+                mkdir(path, 0o700)
+                return path
+            except FileExistsError:
+                # Another server created it in the meantime.
+                continue
+
+    def _segment_path(self, number, directory = None):
+        """
+        Get the path to the segment with the given number.
+
+        :param number: The number of the segment.
+        :type number: int
+        :param directory: The directory of the segment.
+                          (Defaults to the instance directory of this journal)
+        :type directory: str
+        :rtype: str
+        :return: The path of the segment.
+        """
+        return join(directory if directory is not None else self._directory,
+                Journal.SEGMENT_NAME.format(number))
+
+    def _encode(self, kind, payload):
+        """
+        Encode a record.
+
+        :param kind: The kind of the record.
+        :type kind: int
+        :param payload: The payload of the record.
+        :type payload: bytes
+        :rtype: bytes
+        :return: The encoded record.
+        """
+        return Journal.HEADER.pack(len(payload), crc32(payload), kind) + \
+                payload
+
+    def _read_segment(self, path):
+        """
+        Read all intact records of a segment. Reading stops at the first
+        record which is torn or corrupted.
+
+        :param path: The path of the segment.
+        :type path: str
+        :rtype: list[(int, bytes)]
+        :return: The kind and payload of all records in the segment.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        records = []
+        offset = 0
+        header_size = Journal.HEADER.size
+
+        while offset + header_size <= len(data):
+            length, checksum, kind = Journal.HEADER.unpack_from(data, offset)
+            offset += header_size
+
+            payload = data[offset:offset + length]
+            if len(payload) != length or crc32(payload) != checksum:
+                logger.warning("Found corrupted record in segment {}.".format(
+                    path))
+                break
+
+            offset += length
+            records.append((kind, payload))
+
+        return records
+
+    def _submit(self, kind, message_id, payload):
+        """
+        Submit a record for writing.
+
+        :param kind: The kind of the record.
+        :type kind: int
+        :param message_id: The identifier of the message of the record.
+        :type message_id: str
+        :param payload: The payload of the record.
+        :type payload: bytes
+        """
+        record = (kind, message_id, self._encode(kind, payload))
+
+        with self._condition:
+            self._pending.append(record)
+            self._submitted += 1
+            self._condition.notify_all()
+
+    def _open_segment(self):
+        """
+        Start a new segment and make it the active one.
+        """
+        if self._segment is not None:
+            self._segment.close()
+
+        number = self._next_segment
+        self._next_segment += 1
+
+        self._segment = open(self._segment_path(number), 'ab')
+        self._segment_bytes = 0
+        self._segments.append(number)
+        self._live_count[number] = 0
+
+    def _write(self, records):
+        """
+        Write a batch of records to the active segment and commit them.
+
+        This method is only called from the writer thread.
+
+        :param records: The records which should be written.
+        :type records: list[(int, str, bytes)]
+        """
+        for kind, message_id, encoded in records:
+            if self._segment_bytes >= self._segment_size:
+                self._segment.flush()
+                fsync(self._segment.fileno())
+                self._open_segment()
+
+            self._segment.write(encoded)
+            self._segment_bytes += len(encoded)
+
+            number = self._segments[-1]
+            if kind == Journal.ENQUEUE:
+                # A scheduled message is recorded again when it is due.
+                previous = self._live.get(message_id)
+                if previous is not None:
+                    self._live_count[previous] -= 1
+
+                self._live[message_id] = number
+                self._live_count[number] += 1
+            else:
+                number = self._live.pop(message_id, None)
+
+                if number is not None:
+                    self._live_count[number] -= 1
+
+        # Commit the whole batch at once.
+        self._segment.flush()
+        fsync(self._segment.fileno())
+
+        # Delete the oldest segments if they do not contain any pending message
+        # any more. Later segments can only be deleted after the earlier ones,
+        # as their display and close records may refer to those.
+        while len(self._segments) > 1 and \
+                self._live_count[self._segments[0]] == 0:
+            number = self._segments.pop(0)
+            del self._live_count[number]
+
+            logger.debug("Delete journal segment {}.".format(number))
+            remove(self._segment_path(number))
+
+    def recover(self):
+        """
+        Read the journals of all servers which ran before and find all
+        messages which were enqueued but neither displayed nor closed.
+
+        The pending messages are rewritten into a fresh segment before the
+        old instances are deleted, so that they stay safe until they are
+        enqueued again. This must be called before the thread is started and
+        only if no other server uses the journal directory, i.e. not while
+        taking over from another server.
+
+        :rtype: list[dict]
+        :return: The records of all pending messages in the order in which
+                 they were enqueued.
+        """
+        # Segments directly in the journal directory were written before
+        # there were instances.
+        directories = [self._base] + [
+                join(self._base, Journal.INSTANCE_NAME.format(number))
+                for number in Journal._numbers(self._base, "instance-", "")]
+        directories.remove(self._directory)
+
+        segments = [self._segment_path(number, directory)
+                for directory in directories
+                for number in Journal._numbers(directory, "segment-", ".log")]
+
+        pending = {}
+        for path in segments:
+            for kind, payload in self._read_segment(path):
+                if kind == Journal.ENQUEUE:
+                    record = loads(payload.decode())
+                    pending[record['id']] = record
+                else:
+                    pending.pop(payload.decode(), None)
+
+        logger.debug("Recovered {} pending messages from {} segments.".format(
+            len(pending), len(segments)))
+
+        # Write the pending messages into a new segment and forget about the
+        # old ones.
+        self._open_segment()
+        self._write([(Journal.ENQUEUE, message_id,
+            self._encode(Journal.ENQUEUE, dumps(record).encode()))
+            for message_id, record in pending.items()])
+
+        for path in segments:
+            remove(path)
+
+        for directory in directories[1:]:
+            try:
+                rmdir(directory)
+            except OSError as e:
+                logger.warning("Failed to remove journal instance {}: {}"
+                        .format(directory, e))
+
+        self._recovered = set(pending.keys())
+
+        return list(pending.values())
+
+    def record_enqueue(self, handler, message, display_at = None):
+        """
+        Record that a message got enqueued or scheduled.
+
+        :param handler: The client handler of the message.
+        :type handler: ClientHandler
+        :param message: The message which got enqueued.
+        :type message: Message
+        :param display_at: The time (in s since the epoch) when the scheduled
+                           message is due or None if it was enqueued.
+                           (Defaults to None)
+        :type display_at: float
+        """
+        if message.id in self._recovered:
+            # The message is restored from the journal and hence already
+            # contained in it.
+            self._recovered.discard(message.id)
+            return
+
+        record = {
+            'id': message.id,
+            'handler': handler.id,
+            'program': handler.program_name,
+            'multi_client': handler.multi_client,
+            'lingering': handler.lingering,
+            'client': message.client,
+            'subject': message.subject,
+            'body': message.body,
+            'icon': message.icon,
+            'timeout': message.timeout,
+            'append': bool(message.appends),
+            'update': bool(message.updates),
+            'reference': message.reference,
+            'display_at': display_at
+        }
+
+        self._submit(Journal.ENQUEUE, message.id, dumps(record).encode())
+
+    def record_display(self, message):
+        """
+        Record that a message got displayed.
+
+        :param message: The message which got displayed.
+        :type message: Message
+        """
+        self._submit(Journal.DISPLAY, message.id, message.id.encode())
+
+    def record_close(self, message):
+        """
+        Record that a message got closed.
+
+        :param message: The message which got closed.
+        :type message: Message
+        """
+        self._submit(Journal.CLOSE, message.id, message.id.encode())
+
+    def flush(self):
+        """
+        Wait until all records which were submitted so far are written.
+        """
+        with self._condition:
+            target = self._submitted
+
+            while self._written < target and self.is_alive():
+                self._condition.wait(0.1)
+
+    def run(self):
+        """
+        Main execution routine of the journal.
+        """
+        logger.debug("Journal started.")
+
+        if self._segment is None:
+            self._open_segment()
+
+        while True:
+            with self._condition:
+                while not self._pending and not self._should_stop:
+                    self._condition.wait()
+
+                if not self._pending and self._should_stop:
+                    break
+
+                # Take everything which accumulated while the last batch was
+                # written.
+                records = self._pending
+                self._pending = []
+
+            self._write(records)
+
+            with self._condition:
+                self._written += len(records)
+                self._condition.notify_all()
+
+        self._segment.close()
+
+        # Nothing has to be recovered from this instance, so do not leave it
+        # behind.
+        if not self._live:
+            for number in self._segments:
+                remove(self._segment_path(number))
+
+            rmdir(self._directory)
+
+        logger.debug("Journal stopped.")
+
+    def stop(self):
+        """
+        Stop the execution of this journal after all pending records are
+        written.
+        """
+        logger.debug("Stopping journal.")
+
+        with self._condition:
+            self._should_stop = True
+            self._condition.notify_all()
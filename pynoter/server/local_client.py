@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- local client
+#
+# The local client of the pynoter package. This class provides the same
+# interface as the normal client, but is meant for programs which embed the
+# server. Instead of going through DBus, it calls the client handler of the
+# server directly, so no message is marshalled and no bus is involved.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from collections import OrderedDict
+
+from concurrent.futures import Future
+
+from threading import Lock
+
+from time import time
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['LocalClient']
+
+
+class LocalClient:
+    """
+    This class should be used to send messages to a server which runs in the
+    same process.
+    """
+
+    CLOSED_HISTORY = 256    #< The number of close reasons which are kept for
+                            #  messages for which no one waited yet.
+
+    def __init__(self, server, program_name, multi_client = False,
+            lingering = False):
+        """
+        Constructor for the class. The client registers at a handler of the
+        given server here.
+
+        :param server: The server which runs in this process. It must be
+                       started so that closed messages are reported.
+        :type server: Server
+        :param program_name: The name of the program for which messages
+                            should be displayed.
+        :type program_name: str
+        :param multi_client: Flag which indicates, whether there will be
+                             multiple clients registering for the same name,
+                             which should be treated as one client.
+                             (Defaults to False)
+        :type multi_client: bool
+        :param lingering: Flag which indicates, that the handler for this
+                          client should stay alive even if the current client
+                          vanishes. (Defaults to False)
+        :type lingering: bool
+        """
+        logger.debug("Create local client for {}.".format(program_name))
+
+        # Internal variables
+        self._handler = None            #< The client handler which serves us.
+
+        self._closed_futures = {}       #< The futures of the messages for which
+                                        #  someone waits until they are closed.
+
+        self._closed_reasons = OrderedDict() #< The close reasons of the most
+                                        #  recently closed messages for which
+                                        #  no one waited yet.
+
+        self._lock = Lock()             #< Lock for the futures and reasons, as
+                                        #  they are resolved on the main loop.
+
+        self._handler = server.handler_for(program_name, multi_client,
+                lingering)
+
+        self._id = self._handler.register()
+        self._handler.set_closed_listener(self._id, self._messages_closed)
+
+    def __del__(self):
+        """
+        Destructor for the class. The client unregisters from its handler
+        here.
+        """
+        self._unregister()
+
+    def _unregister(self):
+        """
+        Unregister the current client from its handler.
+        """
+        if self._handler is None:
+            return
+
+        try:
+            self._handler.unregister(self._id)
+        except ValueError:
+            # The server was stopped or handed over in the meantime.
+            pass
+
+        self._handler = None
+
+    def _messages_closed(self, closed):
+        """
+        Callback of the handler for messages of this client which got closed.
+
+        :param closed: The identifiers of the messages which got closed
+                       together with the reasons why.
+        :type closed: list[(str, int)]
+        """
+        with self._lock:
+            for message_id, reason in closed:
+                future = self._closed_futures.pop(message_id, None)
+
+                if future is not None:
+                    future.set_result(reason)
+                    continue
+
+                # No one waits for the message yet. Remember the reason for a
+                # short while in case someone asks for it later.
+                self._closed_reasons[message_id] = reason
+
+            while len(self._closed_reasons) > LocalClient.CLOSED_HISTORY:
+                self._closed_reasons.popitem(last=False)
+
+    @property
+    def offline(self):
+        """
+        Whether or not the client writes its messages to the spool. A local
+        client is always connected to its server.
+
+        :rtype: bool
+        :return: Always False.
+        """
+        return False
+
+    def closed_future(self, message_id):
+        """
+        Get a future which is resolved as soon as the given message got closed.
+
+        The future is resolved from the main loop of the server.
+
+        :param message_id: The identifier of the message.
+        :type message_id: str
+        :rtype: Future
+        :return: A future whose result is the reason why the message got
+                 closed (1: expired, 2: dismissed, 3: closed explicitly,
+                 -1: unknown).
+        """
+        with self._lock:
+            future = self._closed_futures.get(message_id)
+            if future is not None:
+                return future
+
+            future = Future()
+
+            reason = self._closed_reasons.pop(message_id, None)
+            if reason is not None:
+                # The message is already closed.
+                future.set_result(reason)
+            else:
+                self._closed_futures[message_id] = future
+
+        return future
+
+    def wait_closed(self, message_id, timeout = None):
+        """
+        Wait until the given message got closed.
+
+        :param message_id: The identifier of the message.
+        :type message_id: str
+        :param timeout: The maximum time in s to wait or None to wait forever.
+                        (Defaults to None)
+        :type timeout: float
+        :rtype: int
+        :return: The reason why the message got closed (see 'closed_future').
+        :raises TimeoutError: If the message did not close in time.
+        """
+        return self.closed_future(message_id).result(timeout)
+
+    def close_message(self, message_id):
+        """
+        Withdraw a notification message which was sent before. If the message
+        is not yet displayed it will never be, if it is currently visible it
+        gets closed.
+
+        :param message_id: The unique identifier of the message which should
+                           be closed.
+        :type message_id: str
+        :rtype: bool
+        :return: Whether or not the message could be closed.
+        """
+        return self._handler.close_message(self._id, message_id)
+
+    def disable_deduplication(self):
+        """
+        Disable that the server drops messages which are identical to recently
+        shown or queued ones.
+        """
+        self._handler.disable_deduplication(self._id)
+
+    def enable_deduplication(self, window):
+        """
+        Enable that the server drops messages which are identical to one which
+        was shown or queued within the given time window.
+
+        :param window: The time in ms during which identical messages are
+                       treated as duplicates.
+        :type window: int
+        """
+        self._handler.enable_deduplication(self._id, window)
+
+    def display_message(self, subject, body, icon = "", timeout = 6000,
+            append = False, update = False, reference = None,
+            display_at = None, display_after = None):
+        """
+        Hand a new notification message to the server.
+
+        :param subject: The subject for the message.
+        :type subject: str
+        :param body: The body of the message.
+        :type body: str
+        :param icon: The name or path of the icon which should be displayed
+                     with the message. (Defaults to '')
+        :type icon: str
+        :param timeout: The time (in ms) the message should be visible.
+                        (Defaults to 6000ms (6s))
+        :type timeout: int
+        :param append: A flag which indicates that this message should be
+                       appended to the last one, if possible.
+                       (Defaults to False)
+        :type append: bool
+        :param update: A flag which indicates that this message should update
+                       (replace) the last message. (Defaults to False)
+        :type update: bool
+        :param reference: The identifier of the message which should be updated
+                          or to which this one should be appended. Use 'None' to
+                          indicate that the id of the last message should be
+                          used and use '""' to indicate that no reference is
+                          given. (Defaults to None)
+        :type reference: str
+        :param display_at: The time (in s since the epoch) when the message
+                           should be displayed. Use 'None' to display the
+                           message as soon as possible. (Defaults to None)
+        :type display_at: float
+        :param display_after: The time (in ms) after which the message should
+                              be displayed. This is ignored if 'display_at' is
+                              given. (Defaults to None)
+        :type display_after: int
+        :rtype: str
+        :return: The unique identifier for this message.
+        """
+        # The handler uses the same encoding of the reference as the DBus
+        # interface.
+        if reference is None:
+            reference = ""
+        elif reference == "":
+            reference = "not-set"
+
+        if display_at is None and display_after is not None:
+            display_at = time() + display_after / 1000
+
+        if display_at is not None:
+            return self._handler.display_message_at(self._id, subject, body,
+                    icon, timeout, append, update, reference, display_at)
+
+        return self._handler.display_message(self._id, subject, body, icon,
+                timeout, append, update, reference)
+
+    def register_template(self, subject, body = "", icon = "",
+            timeout = 6000, append = False, update = False):
+        """
+        Register a template for messages. See 'Client.register_template'.
+
+        :rtype: str
+        :return: The unique identifier of the template.
+        :raises ValueError: If the template is invalid.
+        """
+        return self._handler.register_template(self._id, subject, body, icon,
+                timeout, append, update)
+
+    def display_template(self, template_id, arguments = None):
+        """
+        Hand a new notification message which is created from a template to
+        the server. See 'Client.display_template'.
+
+        :param template_id: The unique identifier of the template as returned
+                            by 'register_template'.
+        :type template_id: str
+        :param arguments: The values of the placeholders of the template.
+                          (Defaults to None)
+        :type arguments: dict[str, str]
+        :rtype: str
+        :return: The unique identifier for this message.
+        :raises ValueError: If the template is unknown or an argument is
+                            missing.
+        """
+        return self._handler.display_template(self._id, template_id,
+                arguments or {})
+
+    def open_progress(self, subject, icon = "", timeout = 6000):
+        """
+        Open a stream which reports the progress of a task. See
+        'Client.open_progress'.
+
+        :rtype: str
+        :return: The unique identifier of the progress stream.
+        """
+        return self._handler.open_progress(self._id, subject, icon, timeout)
+
+    def push_progress(self, progress_id, value, text = ""):
+        """
+        Report the progress of a task. See 'Client.push_progress'.
+
+        :param progress_id: The unique identifier of the progress stream as
+                            returned by 'open_progress'.
+        :type progress_id: str
+        :param value: The progress in percent.
+        :type value: float
+        :param text: The text which describes the current step.
+                     (Defaults to '')
+        :type text: str
+        """
+        self._handler.push_progress(self._id, progress_id, value, text)
+
+    def close_progress(self, progress_id):
+        """
+        Close a progress stream before it is complete.
+
+        :param progress_id: The unique identifier of the progress stream as
+                            returned by 'open_progress'.
+        :type progress_id: str
+        """
+        self._handler.close_progress(self._id, progress_id)
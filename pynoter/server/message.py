@@ -12,16 +12,21 @@
 ###############################################################################
 
 from gi.repository.Notify import Notification
-from gi.repository.GLib import Variant
+from gi.repository.GLib import Variant, Error as GLibError, timeout_add, \
+        source_remove
 
 from threading import Condition, RLock
 
+from time import monotonic
+
 from enum import IntEnum
 
 from uuid import uuid4
 
 import logging
 
+from pynoter.server.profiler import Profiler, profiler
+
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +39,10 @@ class Message:
     notification daemon.
     """
 
+    EXPIRY_GRACE = 5000     #< The time in ms after its timeout after which a
+                            #  visible message counts as vanished, even if the
+                            #  daemon never reported it as closed.
+
     class ClosedReason(IntEnum):
         """
         Reasons why the notification bubble is closed.
@@ -59,6 +68,7 @@ class Message:
 
         Unknown = -1
         Vanished = 1
+        Dismissed = 2
         Explicit = 3
 
 
@@ -70,7 +80,8 @@ class Message:
         return str(uuid4()).replace('-', '_')
 
     def __init__(self, client_handler, subject, body = "", icon = "",
-            timeout = 6000, append = False, update = False, reference = ""):
+            timeout = 6000, append = False, update = False, reference = "",
+            client = "", message_id = None):
         """
         Constructor of the class.
 
@@ -101,11 +112,20 @@ class Message:
                           important if one of these flags are set.
                           (Defaults to '""')
         :type reference: str
-
+        :param client: The unique identifier of the client which sent the
+                       message. (Defaults to '""')
+        :type client: str
+        :param message_id: The unique identifier of the message if it is
+                           already known, e.g. because the message is restored.
+                           (Defaults to None, a new one is created)
+        :type message_id: str
         """
         logger.debug("Create new message (S: {}, B: {})".format(subject, body))
 
-        self._id = Message.create_unique_id()
+        if message_id is None:
+            message_id = Message.create_unique_id()
+
+        self._id = message_id
 
         self._subject = subject
         self._body = body
@@ -114,6 +134,7 @@ class Message:
         self._append = append
         self._update = update
         self._reference = reference
+        self._client = client
         self._client_handler = client_handler
 
         self._closed_lock = RLock()
@@ -122,6 +143,13 @@ class Message:
         self._closed_reason = None
 
         self._callback_id = -1
+        self._notification = None
+        self._expiry_timer = None       #< The timer which expires the message
+                                        #  if the daemon never closes it.
+        self._expires_at = None         #< The time after which the visible
+                                        #  message counts as vanished.
+
+        self._repeats = 0
 
     def _closed_callback(self, notification):
         """
@@ -134,10 +162,28 @@ class Message:
         :param notification: The closed notification instance.
         :type notification: Notification
         """
+        self._set_closed(Message.ClosedReason.get(
+            notification.get_closed_reason()))
+
+        # Disconnect from the signal.
+        notification.disconnect(self._callback_id)
+        self._callback_id = -1
+
+    def _set_closed(self, reason):
+        """
+        Mark the message as closed and inform everyone who is interested in
+        this.
+
+        :param reason: The reason why the message got closed.
+        :type reason: ClosedReason
+        """
         with self._closed_lock:
             # Set the close reason.
-            self._closed_reason = Message.ClosedReason.get(
-                    notification.get_closed_reason())
+            self._closed_reason = reason
+
+            if self._expiry_timer is not None:
+                source_remove(self._expiry_timer)
+                self._expiry_timer = None
 
             logger.debug("Notification closed with {}".format(
                 self._closed_reason.name))
@@ -154,9 +200,44 @@ class Message:
         for listener in listeners:
             listener(self, self._closed_reason == Message.ClosedReason.Vanished)
 
-        # Disconnect from the signal.
-        notification.disconnect(self._callback_id)
-        self._callback_id = -1
+    def close(self):
+        """
+        Close the notification bubble of this message if it is currently
+        visible on the screen.
+
+        :rtype: bool
+        :return: Whether or not the notification could be closed.
+        """
+        with self._closed_lock:
+            if self._closed_reason is not None or self._notification is None:
+                # The message is already closed or was never displayed.
+                return False
+
+            notification = self._notification
+
+        logger.debug("Close message {}.".format(self._id))
+
+        try:
+            return notification.close()
+        except GLibError as e:
+            logger.error("Failed to close the message: {}".format(e))
+
+            return False
+
+    def discard(self):
+        """
+        Mark a message which was never displayed as closed.
+
+        This should be used if the message is removed before it got displayed,
+        so that everyone waiting for the message gets informed.
+        """
+        with self._closed_lock:
+            if self._closed_reason is not None:
+                return
+
+        logger.debug("Discard message {}.".format(self._id))
+
+        self._set_closed(Message.ClosedReason.Explicit)
 
     def display(self, use_flags = True):
         """
@@ -180,20 +261,41 @@ class Message:
             self._subject, self._body, self._timeout, self._append,
             self._update))
 
+        body = self._body
+        if self._repeats > 0:
+            # Identical messages were dropped in favor of this one. Let the
+            # user know how often it was sent.
+            body += "\n(repeated {} times)".format(self._repeats)
+
+        # Hand the decoded image to the daemon if the icon cache has it, so
+        # that the image file is not loaded again.
+        icon_cache = self._client_handler.icon_cache
+        image = icon_cache.lookup(self._icon) if icon_cache is not None \
+                else None
+        icon = self._icon if image is None else ""
+
         if self._update:
             # This message should replace the last one. So alter the last
             # notification message object.
             logger.debug("Update old message.")
 
             self._client_handler.notification.update(self._subject,
-                    self._body, self._icon)
+                    body, icon)
+
+            if image is None:
+                # Drop the image of the replaced message.
+                self._client_handler.notification.set_hint("image-data",
+                        None)
         else:
             # The old message should not be replaced, so create a new
             # notification message object.
             logger.debug("Create new message.")
 
             self._client_handler.notification = Notification.new(
-                    self._subject, self._body, self._icon)
+                    self._subject, body, icon)
+
+        if image is not None:
+            self._client_handler.notification.set_image_from_pixbuf(image)
 
         # Set append hint, so that following messages can be appended to this
         # one.
@@ -202,9 +304,9 @@ class Message:
 
         # Register for the close event of the notification.
         self._closed_reason = None
-        self._callback_id = \
-                self._client_handler.notification.connect("closed",
-                        self._closed_callback)
+        self._notification = self._client_handler.notification
+        self._callback_id = self._notification.connect("closed",
+                self._closed_callback)
 
         # We now have a properly constructed notification message object. So we
         # can show it now on the screen.
@@ -214,12 +316,55 @@ class Message:
             logger.error("Failed to show the message.".format(
                 self._subject, self._body))
 
+            self._notification.disconnect(self._callback_id)
+            self._callback_id = -1
+            self._notification = None
+
             return False
 
         logger.debug("Message successfully showed.")
 
+        # Do not rely on the daemon to report that a message is closed. A
+        # message which is never closed would otherwise keep its handler
+        # alive forever. Messages which never expire are left to the user.
+        if self._timeout > 0:
+            with self._closed_lock:
+                if self._expiry_timer is not None:
+                    source_remove(self._expiry_timer)
+
+                self._expires_at = monotonic() + \
+                        (self._timeout + Message.EXPIRY_GRACE) / 1000
+                self._expiry_timer = timeout_add(
+                        self._timeout + Message.EXPIRY_GRACE, self.expire)
+
         return True
 
+    def expire(self):
+        """
+        Mark a visible message as vanished, because the daemon did not report
+        it as closed although its timeout passed.
+
+        :rtype: bool
+        :return: Always False, so that the main loop does not call this
+                 function again.
+        """
+        with self._closed_lock:
+            self._expiry_timer = None
+
+            if self._closed_reason is not None or self._notification is None:
+                return False
+
+            if self._callback_id != -1:
+                self._notification.disconnect(self._callback_id)
+                self._callback_id = -1
+
+        logger.warning("Message {} expired without being closed.".format(
+            self._id))
+
+        self._set_closed(Message.ClosedReason.Vanished)
+
+        return False
+
     def notify_if_closed(self, callback):
         """
         Register a callback which is called if the notification for this
@@ -238,6 +383,13 @@ class Message:
         # The message already is closed. So directly call the callback.
         callback(self, self._closed_reason == Message.ClosedReason.Vanished)
 
+    def repeat(self):
+        """
+        Record that an identical message was sent again and dropped in favor
+        of this one.
+        """
+        self._repeats += 1
+
     def wait_for_closed(self):
         """
         Wait until the notification for this message gets closed.
@@ -249,10 +401,18 @@ class Message:
         :return: True if the notification vanished, False if it got closed
                  differently.
         """
-        with self._closed_lock:
-            if self._closed_reason is None:
-                # The message did not get closed yet. Wait for it.
-                self._closed_waiters.wait(self._timeout/1000)
+        program = self._client_handler.program_name
+        start = profiler.enter(Profiler.WAIT_FOR_CLOSED, program) \
+                if profiler.active else 0
+
+        try:
+            with self._closed_lock:
+                if self._closed_reason is None:
+                    # The message did not get closed yet. Wait for it.
+                    self._closed_waiters.wait(self._timeout/1000)
+        finally:
+            if start:
+                profiler.leave(Profiler.WAIT_FOR_CLOSED, program, start)
 
         # The message already is closed, or the timeout hit.
         return self._closed_reason == Message.ClosedReason.Vanished
@@ -267,6 +427,78 @@ class Message:
         """
         return self._append
 
+    @property
+    def body(self):
+        """
+        Get the body of this message.
+
+        :rtype: str
+        :return: The body of this message.
+        """
+        return self._body
+
+    @property
+    def closed(self):
+        """
+        Whether or not the notification for this message is already closed.
+
+        :rtype: bool
+        :return: Whether or not the notification is closed.
+        """
+        return self._closed_reason is not None
+
+    @property
+    def client(self):
+        """
+        Get the identifier of the client which sent this message.
+
+        :rtype: str
+        :return: The identifier of the client.
+        """
+        return self._client
+
+    @property
+    def client_handler(self):
+        """
+        Get the client handler to which this message belongs.
+
+        :rtype: ClientHandler
+        :return: The client handler of this message.
+        """
+        return self._client_handler
+
+    @property
+    def closed_reason(self):
+        """
+        Get the reason why the notification for this message got closed.
+
+        :rtype: ClosedReason
+        :return: The reason or None if the message is not closed yet.
+        """
+        return self._closed_reason
+
+    @property
+    def expires_at(self):
+        """
+        Get the time after which the visible message counts as vanished,
+        even if the daemon did not close it.
+
+        :rtype: float
+        :return: The time (see 'time.monotonic') or None if the message was
+                 not displayed yet or never expires.
+        """
+        return self._expires_at
+
+    @property
+    def icon(self):
+        """
+        Get the icon of this message.
+
+        :rtype: str
+        :return: The name or path of the icon of this message.
+        """
+        return self._icon
+
     @property
     def id(self):
         """
@@ -287,6 +519,17 @@ class Message:
         """
         return self._reference
 
+    @property
+    def repeats(self):
+        """
+        Get the number of identical messages which were dropped in favor of
+        this one.
+
+        :rtype: int
+        :return: The number of repetitions of this message.
+        """
+        return self._repeats
+
     @property
     def subject(self):
         """
@@ -16,10 +16,17 @@
 # (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
 ###############################################################################
 
-from threading import Thread, Lock, RLock, Semaphore
+from collections import OrderedDict, deque
+
+from threading import Thread, Condition, Lock
+
+from time import monotonic, time
 
 import logging
 
+from pynoter.server.flight_recorder import FlightRecorder
+from pynoter.server.profiler import Profiler, profiler
+
 
 logger = logging.getLogger(__name__)
 
@@ -80,7 +87,16 @@ class MessageItem(Item):
         """
         message_handler._show_with_closure(self)
         message_handler._wait()
-        message_handler._reset_current()
+
+    @property
+    def handler(self):
+        """
+        Get the client handler serving the client of this message.
+
+        :rtype: ClientHandler
+        :return: The client handler of this message item.
+        """
+        return self._handler
 
     @property
     def id(self):
@@ -161,8 +177,11 @@ def closure(item, queue):
         others = [i for i in queue if revises(i, item)]
 
         for i in others[:]:
-            # Remove the item from the queue.
-            queue.remove(i)
+            # Remove the item from the queue. If this is not possible anymore,
+            # the item got withdrawn in the meantime.
+            if not queue.remove(i):
+                others.remove(i)
+                continue
 
             # Find all items revising the found ones recursively.
             others.extend(closure(i, queue))
@@ -200,13 +219,31 @@ class Queue:
         Constructor of this class. It will set up the internal data structure
         as well as all synchronization variables.
         """
-        self._queue = []                #< The internal list of messages.
+        self._queue = OrderedDict()     #< The internal ordered set of items.
+                                        #  This allows removing arbitrary
+                                        #  items in constant time.
+
+        self._lock = Lock()             #< The lock to protect the internal
+                                        #  set.
 
-        self._semaphore = Semaphore(0)  #< The counting semaphore used to reach
+        self._not_empty = Condition(self._lock) #< The condition used to reach
                                         #  the producer consumer pattern without
                                         #  busy waiting.
 
-        self._lock = Lock()             #< The lock to protect the internal list.
+        self._held = False              #< Whether the items are kept in the
+                                        #  queue instead of being handed out.
+
+    def __contains__(self, item):
+        """
+        Check whether the given item is currently in the queue.
+
+        :param item: The item which should be checked.
+        :type item: Item
+        :rtype: bool
+        :return: Whether or not the item is in the queue.
+        """
+        with self._lock:
+            return item in self._queue
 
     def __iter__(self):
         """
@@ -219,6 +256,16 @@ class Queue:
             for i in self._queue:
                 yield i
 
+    def __len__(self):
+        """
+        Get the number of items in the queue.
+
+        :rtype: int
+        :return: The number of items in the queue.
+        """
+        with self._lock:
+            return len(self._queue)
+
     def enqueue(self, item):
         """
         Add an item to the tail of the queue.
@@ -227,34 +274,61 @@ class Queue:
         :type item: Item
         """
         with self._lock:
-            self._queue.append(item)
-
-        self._semaphore.release()
+            self._queue[item] = None
+            self._not_empty.notify()
 
     def dequeue(self):
         """
         Get another item from the queue. If there are items in the list, the
-        head will be returned. Otherwise, this method will block until a new
-        item is added.
+        head will be returned. Otherwise, or while the queue is held, this
+        method will block until a new item is added.
         """
-        self._semaphore.acquire()
+        with self._lock:
+            while self._held or not self._queue:
+                self._not_empty.wait()
+
+            return self._queue.popitem(last=False)[0]
 
+    def drain(self):
+        """
+        Remove all items from the queue.
+
+        :rtype: list[Item]
+        :return: The removed items in the order of the queue.
+        """
         with self._lock:
-            return self._queue.pop(0)
+            items = list(self._queue)
+            self._queue.clear()
 
-    def remove(self, item):
+            return items
+
+    def hold(self, held):
         """
-        Remove an item from the list at an arbitrary position.
+        Keep all items in the queue or hand them out again.
 
-        This will also count down the internal semaphore.
+        :param held: Whether or not the items should be kept in the queue.
+        :type held: bool
+        """
+        with self._lock:
+            self._held = held
+            self._not_empty.notify_all()
 
-        :param item: The item which should be removed from the list.
-        :type item: Item
+    def remove(self, item):
         """
-        self._semaphore.acquire()
+        Remove an item from the queue at an arbitrary position.
 
+        :param item: The item which should be removed from the queue.
+        :type item: Item
+        :rtype: bool
+        :return: Whether or not the item was part of the queue.
+        """
         with self._lock:
-            self._queue.remove(item)
+            if item not in self._queue:
+                return False
+
+            del self._queue[item]
+
+            return True
 
 
 class MessageHandler(Thread):
@@ -265,10 +339,18 @@ class MessageHandler(Thread):
     to the producer consumer pattern.
     """
 
-    def __init__(self):
+    def __init__(self, journal = None, flight_recorder = None):
         """
         Constructor of the class. Here the thread will be initialized as well
         as all used locks and other synchronization variables.
+
+        :param journal: The journal where all enqueued, displayed and closed
+                        messages are recorded. (Defaults to None)
+        :type journal: Journal
+        :param flight_recorder: The flight recorder which keeps the most recent
+                                events. A new one is created if None is given.
+                                (Defaults to None)
+        :type flight_recorder: FlightRecorder
         """
         logger.debug("Create a new message handler")
 
@@ -285,17 +367,123 @@ class MessageHandler(Thread):
         self._current = None        #< Information about the message which is
                                     #  displayed at the moment.
 
-        self._current_lock = RLock() #< Lock for the information about the
-                                    #  currently displayed message as they are
-                                    #  accessed from this thread and from
-                                    #  others as well.
+        self._shown = {}            #< The items which are displayed since the
+                                    #  current message appeared (including the
+                                    #  closure which is about to be displayed)
+                                    #  by their id.
+
+        self._revisions = deque()   #< Items which revise a displayed message
+                                    #  and which the worker should display
+                                    #  next.
+
+        self._held = False          #< Whether all new messages are held back
+                                    #  in the queue, e.g. during a hand-off.
+
+        self._wakeup = Condition()  #< Condition to protect the current,
+                                    #  displayed and revising items and to wake
+                                    #  up the worker while it waits for the
+                                    #  current message to vanish. It is never
+                                    #  held while a message is displayed.
 
-    def _reset_current(self):
+        self._items = {}            #< Index of all items which are queued or
+                                    #  visible, by the id of their message.
+
+        self._items_lock = Lock()   #< Lock for the index of items.
+
+        self._journal = journal     #< The journal which records the state of
+                                    #  the messages or None.
+
+        self._sinks = []            #< The sinks to which all message events
+                                    #  are mirrored.
+
+        self._flight_recorder = flight_recorder #< The recorder of the most
+                                    #  recent events.
+        if self._flight_recorder is None:
+            self._flight_recorder = FlightRecorder()
+
+    def _publish(self, kind, item, reason = None):
         """
-        Reset the information about the currently shown message to its default.
+        Mirror an event of a message to all sinks.
+
+        :param kind: The kind of the event ('enqueued', 'displayed' or
+                     'closed').
+        :type kind: str
+        :param item: The item of the message.
+        :type item: MessageItem
+        :param reason: The reason why the message got closed. (Defaults to
+                       None)
+        :type reason: int
+        """
+        if not self._sinks:
+            return
+
+        message = item.message
+        event = {
+            'kind': kind,
+            'time': time(),
+            'program': item.handler.program_name,
+            'handler': item.handler.id,
+            'client': message.client,
+            'id': message.id,
+            'subject': message.subject,
+            'body': message.body,
+            'icon': message.icon,
+            'timeout': message.timeout,
+            'append': bool(message.appends),
+            'update': bool(message.updates),
+            'reference': message.reference,
+            'reason': reason
+        }
+
+        for sink in self._sinks:
+            sink.submit(event)
+
+    def _add_to_index(self, item):
+        """
+        Add the given item to the index of known items. It will be removed
+        again as soon as its message gets closed.
+
+        :param item: The item which should be added.
+        :type item: MessageItem
         """
-        with self._current_lock:
-            self._current = None
+        with self._items_lock:
+            self._items[item.message.id] = item
+
+        item.message.notify_if_closed(
+                lambda message, vanished: self._remove_from_index(item))
+
+    def _remove_from_index(self, item):
+        """
+        Callback which is called if the message of an indexed item got closed.
+
+        :param item: The item whose message got closed.
+        :type item: MessageItem
+        """
+        message = item.message
+
+        with self._items_lock:
+            self._items.pop(message.id, None)
+
+        if self._journal is not None:
+            self._journal.record_close(message)
+
+        self._flight_recorder.record(FlightRecorder.CLOSE, message.id,
+                "reason={}".format(message.closed_reason))
+
+        self._publish('closed', item, int(message.closed_reason))
+
+    def _wake(self, message, vanished):
+        """
+        Callback which is called if a displayed message got closed, so that
+        the worker stops waiting.
+
+        :param message: The message which got closed.
+        :type message: Message
+        :param vanished: Flag which indicates that the message vanished.
+        :type vanished: bool
+        """
+        with self._wakeup:
+            self._wakeup.notify_all()
 
     def _show_without_closure(self, item, use_flags = True):
         """
@@ -308,10 +496,36 @@ class MessageHandler(Thread):
                           displaying or not. (Defaults to True)
         :type use_flags: bool
         """
-        if item.message.display(use_flags):
-            with self._current_lock:
+        program = item.handler.program_name
+        start = profiler.enter(Profiler.DISPLAY, program) \
+                if profiler.active else 0
+
+        try:
+            displayed = item.message.display(use_flags)
+        finally:
+            if start:
+                profiler.leave(Profiler.DISPLAY, program, start)
+
+        if displayed:
+            self._flight_recorder.record(FlightRecorder.DISPLAY,
+                    item.message.id)
+
+            with self._wakeup:
                 self._current = item
 
+            if self._journal is not None:
+                self._journal.record_display(item.message)
+
+            self._publish('displayed', item)
+
+            item.message.notify_if_closed(self._wake)
+        else:
+            self._flight_recorder.record(FlightRecorder.DISPLAY_FAILED,
+                    item.message.id)
+
+            # The message will never be visible, so no one should wait for it.
+            item.message.discard()
+
     def _show_with_closure(self, item):
         """
         Display the given notification message together with all the other
@@ -320,31 +534,188 @@ class MessageHandler(Thread):
         :param item: The message queue item which should be displayed.
         :type item: MessageItem
         """
-        with self._current_lock:
-            # Calculate the closure for the item.
+        # Make the item known as displayed first, so that messages which
+        # revise it and which arrive in the meantime are not queued.
+        with self._wakeup:
+            self._current = item
+            self._shown = {item.id: item}
+
+        # Calculate the closure for the item.
+        program = item.handler.program_name
+        start = profiler.enter(Profiler.CLOSURE, program) \
+                if profiler.active else 0
+
+        try:
             clo = closure(item, self._queue)
+        finally:
+            if start:
+                profiler.leave(Profiler.CLOSURE, program, start)
 
-            # Display the item without flags.
-            self._show_without_closure(item, use_flags=False)
+        self._flight_recorder.record(FlightRecorder.CLOSURE, item.message.id,
+                "size={}".format(len(clo)))
 
-            # Display the item from the closure.
+        with self._wakeup:
             for i in clo:
-                self._show_without_closure(i)
+                self._shown[i.id] = i
+
+        # Display the item without flags.
+        self._show_without_closure(item, use_flags=False)
+
+        # Display the item from the closure.
+        for i in clo:
+            self._show_without_closure(i)
 
     def _wait(self):
         """
-        Wait until the message currently displayed vanishes.
+        Wait until the message currently displayed vanishes. In the meantime,
+        display the messages which revise it as soon as they arrive.
+        """
+        logger.debug("Wait until the current message vanishes.")
+
+        program = self._current.handler.program_name \
+                if self._current is not None else ""
+        start = profiler.enter(Profiler.WAIT, program) \
+                if profiler.active else 0
+
+        try:
+            self._wait_until_closed()
+        finally:
+            if start:
+                profiler.leave(Profiler.WAIT, program, start)
+
+    def _wait_until_closed(self):
+        """
+        Wait until the message currently displayed vanishes, while displaying
+        the messages which revise it. See '_wait'.
+
+        The wait ends at the latest when the timeout of the message plus a
+        grace period passed, so that a daemon which never closes a message
+        does not stall the display of all other messages.
         """
         while True:
-            logger.debug("Wait until the current message vanishes.")
+            item = None
+
+            with self._wakeup:
+                while not self._revisions:
+                    cur = self._current
+
+                    if cur is None or cur.message.closed:
+                        # Reset the current message while holding the lock,
+                        # so that all later messages are queued.
+                        self._current = None
+                        self._shown = {}
+
+                        logger.debug("Waiting done.")
+
+                        return
+
+                    deadline = cur.message.expires_at
+                    if deadline is None:
+                        self._wakeup.wait()
+                        continue
 
-            with self._current_lock:
-                cur = self._current
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
 
-            if cur is None or cur.message.wait_for_closed():
-                logger.debug("Waiting done.")
+                    self._wakeup.wait(remaining)
 
-                return
+                if self._revisions:
+                    item = self._revisions.popleft()
+
+            if item is None:
+                # Expire the message without holding the lock, as this calls
+                # back into the message handler.
+                cur.message.expire()
+                continue
+
+            logger.debug("Show revising message from {}.".format(
+                item.handler.id))
+
+            # The new message will change the currently displayed one.
+            self._show_without_closure(item)
+
+    def add_sink(self, sink):
+        """
+        Add a sink to which all message events are mirrored. The sink must be
+        started and stopped by the caller.
+
+        :param sink: The sink which should be added.
+        :type sink: Sink
+        """
+        logger.debug("Add sink {}.".format(sink.sink_name))
+
+        self._sinks.append(sink)
+
+    def close(self, handler, message_id):
+        """
+        Withdraw the message with the given identifier. If the message is still
+        queued it will be removed from the queue, if it is visible its
+        notification will be closed.
+
+        This method is normally executed on the client handlers thread.
+
+        :param handler: The client handler which wants to close the message.
+        :type handler: ClientHandler
+        :param message_id: The identifier of the message which should be
+                           closed.
+        :type message_id: str
+        :rtype: bool
+        :return: Whether or not the message could be closed.
+        """
+        with self._items_lock:
+            item = self._items.get(message_id)
+
+        if item is None or item.handler is not handler:
+            # The message is already gone or belongs to someone else.
+            return False
+
+        with self._wakeup:
+            revision = item in self._revisions
+            if revision:
+                self._revisions.remove(item)
+
+        if revision or self._queue.remove(item):
+            logger.debug("Remove queued message {}.".format(message_id))
+
+            item.message.discard()
+
+            return True
+
+        logger.debug("Close visible message {}.".format(message_id))
+
+        return item.message.close()
+
+    def take_pending(self):
+        """
+        Take all messages out of the queue which are still waiting to be
+        displayed, e.g. to hand them over to another server.
+
+        :rtype: list[MessageItem]
+        :return: The items of the pending messages in the order of the queue.
+        """
+        # Messages which should revise the visible one come first, as they
+        # were meant to be displayed next.
+        with self._wakeup:
+            revisions = list(self._revisions)
+            self._revisions.clear()
+
+        pending = []
+
+        for item in revisions + self._queue.drain():
+            if not isinstance(item, MessageItem):
+                # Keep the items which control the handler itself.
+                self._queue.enqueue(item)
+                continue
+
+            with self._items_lock:
+                self._items.pop(item.message.id, None)
+
+            pending.append(item)
+
+        logger.debug("Took {} pending messages.".format(len(pending)))
+
+        return pending
 
     def enqueue(self, handler, message):
         """
@@ -358,23 +729,105 @@ class MessageHandler(Thread):
         :param message: The message object which should be displayed.
         :type message: Message
         """
-        item = MessageItem(handler, message)
+        program = handler.program_name
+        start = profiler.enter(Profiler.ENQUEUE, program) \
+                if profiler.active else 0
+
+        try:
+            self._enqueue(MessageItem(handler, message))
+        finally:
+            if start:
+                profiler.leave(Profiler.ENQUEUE, program, start)
+
+    def _enqueue(self, item):
+        """
+        Enqueue the given item. See 'enqueue'.
+
+        :param item: The message queue item which should be enqueued.
+        :type item: MessageItem
+        """
+        handler = item.handler
+        message = item.message
+
+        self._flight_recorder.record(FlightRecorder.ENQUEUE, message.id,
+                "program={} reference={}".format(handler.program_name,
+                    message.reference))
+
+        if self._journal is not None:
+            self._journal.record_enqueue(handler, message)
 
-        with self._current_lock:
-            if revises(item, self._current):
-                logger.debug("Directly show message from {}.".format(
-                    handler.id))
+        self._publish('enqueued', item)
 
-                # The new message will change the currently displayed one.
-                # Hence display it directly without adding it to the queue.
-                self._show_without_closure(item)
+        self._add_to_index(item)
 
-                return
+        # Never display anything here, as this would block the caller until
+        # the notification daemon answered.
+        with self._wakeup:
+            shown = self._shown.get(item.ref_id)
+            revision = not self._held and shown is not None and \
+                    revises(item, shown)
 
-        # Otherwise, just add it to the queue.
-        logger.debug("Enqueue message from {}.".format(handler.id))
+            if revision:
+                logger.debug("Pass revising message from {} to the worker."
+                        .format(handler.id))
 
-        self._queue.enqueue(item)
+                # The new message will change a currently displayed one.
+                # Hence the worker displays it next, without the queue.
+                self._flight_recorder.record(FlightRecorder.REVISE,
+                        message.id)
+
+                self._shown[item.id] = item
+                self._revisions.append(item)
+                self._wakeup.notify_all()
+
+        if not revision:
+            # Otherwise, just add it to the queue.
+            logger.debug("Enqueue message from {}.".format(handler.id))
+
+            self._queue.enqueue(item)
+
+    def expire_displayed(self):
+        """
+        Mark all messages which are visible as vanished, e.g. because the
+        notification daemon which showed them went away.
+
+        This method is normally executed on the main loop.
+        """
+        with self._items_lock:
+            items = list(self._items.values())
+
+        for item in items:
+            # Messages which are still queued are not affected.
+            item.message.expire()
+
+    def hold(self, held):
+        """
+        Hold back all messages which are not displayed yet, or display them
+        again. Held messages stay in the queue, where 'take_pending' can take
+        them, e.g. to hand them over to another server in their order.
+
+        :param held: Whether or not the messages should be held back.
+        :type held: bool
+        """
+        logger.debug("{} the queue.".format("Hold" if held else "Release"))
+
+        with self._wakeup:
+            self._held = held
+
+        self._queue.hold(held)
+
+    def knows(self, message_id):
+        """
+        Check whether a message with the given identifier is pending or
+        visible.
+
+        :param message_id: The identifier of the message.
+        :type message_id: str
+        :rtype: bool
+        :return: Whether or not the message is known.
+        """
+        with self._items_lock:
+            return message_id in self._items
 
     def run(self):
         """
@@ -394,11 +847,55 @@ class MessageHandler(Thread):
 
         logger.debug("Message handler stopped.")
 
+    @property
+    def flight_recorder(self):
+        """
+        Get the flight recorder which keeps the most recent events.
+
+        :rtype: FlightRecorder
+        :return: The flight recorder of this message handler.
+        """
+        return self._flight_recorder
+
+    @property
+    def statistics(self):
+        """
+        Get the sizes of the internal queues of this message handler.
+
+        :rtype: dict
+        :return: The number of queued items, of indexed items, of displayed
+                 items and of revisions which wait to be displayed.
+        """
+        with self._items_lock:
+            indexed = len(self._items)
+
+        with self._wakeup:
+            shown = len(self._shown)
+            revisions = len(self._revisions)
+
+        return {
+            'queued': float(len(self._queue)),
+            'indexed': float(indexed),
+            'shown': float(shown),
+            'revisions': float(revisions)
+        }
+
+    @property
+    def sinks(self):
+        """
+        Get the sinks to which all message events are mirrored.
+
+        :rtype: list[Sink]
+        :return: The sinks of this message handler.
+        """
+        return list(self._sinks)
+
     def stop(self):
         """
         Stop the execution of this message handler.
         """
         logger.debug("Stopping message handler.")
 
+        self._queue.hold(False)
         self._queue.enqueue(HandlerStopItem())
 
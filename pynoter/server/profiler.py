@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- profiler
+#
+# The profiler of the pynoter package. The hot paths of the server (handling
+# 'display_message', enqueuing, calculating closures, displaying and waiting
+# for messages) are surrounded by hook points, which report to the profiler
+# of the process. While no session is running, a hook only checks the
+# 'active' flag of the profiler. A session is started at runtime, e.g. via
+# DBus, and ends after a given time. It either traces the duration of the
+# hooked calls per program, optionally only every n-th call, or runs cProfile
+# around them with one profile per thread and program.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from cProfile import Profile
+
+from io import StringIO
+
+from pstats import Stats
+
+from threading import Lock, get_ident, local
+
+from time import monotonic, perf_counter
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['Profiler', 'profiler']
+
+
+class Profiler:
+    """
+    This class collects the timings of the hooked calls while a session is
+    running.
+
+    A hook point looks like this:
+
+        start = profiler.enter(Profiler.ENQUEUE, program) \
+                if profiler.active else 0
+        ...
+        if start:
+            profiler.leave(Profiler.ENQUEUE, program, start)
+    """
+
+    DISPLAY_MESSAGE = 'display_message' #< Hook of the client handler call.
+    ENQUEUE = 'enqueue'                 #< Hook of enqueuing a message.
+    CLOSURE = 'closure'                 #< Hook of calculating a closure.
+    DISPLAY = 'display'                 #< Hook of displaying a message.
+    WAIT = 'wait'                       #< Hook of waiting until the displayed
+                                        #  message vanished.
+    WAIT_FOR_CLOSED = 'wait_for_closed' #< Hook of waiting for a message.
+
+    TRACE = 'trace'                     #< Session which traces the calls.
+    CPROFILE = 'cprofile'               #< Session which runs cProfile.
+
+    def __init__(self):
+        """
+        Constructor of the class.
+        """
+        self.active = False             #< Whether a session is running. The
+                                        #  hooks check this before anything
+                                        #  else.
+
+        # Internal variables
+        self._mode = None               #< The mode of the last session.
+        self._every = 1                 #< Only every n-th call of each hook
+                                        #  is measured.
+        self._calls = {}                #< The number of calls in the session
+                                        #  by hook.
+        self._deadline = 0              #< The time when the session ends.
+        self._started = 0               #< The time when the session started.
+        self._ended = 0                 #< The time when the session ended.
+
+        self._stats = {}                #< The number of measured calls, their
+                                        #  total and maximum duration by hook
+                                        #  and program.
+
+        self._profiles = {}             #< The cProfile profiles by thread
+                                        #  and program.
+
+        self._local = local()           #< The nesting depth of the hooks and
+                                        #  the running profile per thread.
+
+        self._lock = Lock()             #< Lock for the statistics and profiles.
+
+    def start(self, mode, every = 1, duration = 10):
+        """
+        Start a new session. The results of the previous session are dropped.
+
+        :param mode: The mode of the session (TRACE or CPROFILE).
+        :type mode: str
+        :param every: Only every n-th call of each hook is measured.
+                      (Defaults to 1)
+        :type every: int
+        :param duration: The time in s after which the session ends.
+                         (Defaults to 10)
+        :type duration: float
+        :raises ValueError: If the mode or the parameters are invalid.
+        """
+        if mode not in (Profiler.TRACE, Profiler.CPROFILE):
+            raise ValueError("Unknown profiling mode '{}'.".format(mode))
+
+        if every < 1 or duration <= 0:
+            raise ValueError("The sampling interval and the duration must " +
+                    "be positive.")
+
+        logger.info("Start {} session for {} s (every {} calls).".format(mode,
+            duration, every))
+
+        with self._lock:
+            self._mode = mode
+            self._every = every
+            self._calls = {}
+            self._stats = {}
+            self._profiles = {}
+            self._started = monotonic()
+            self._ended = 0
+            self._deadline = self._started + duration
+
+        self.active = True
+
+    def stop(self):
+        """
+        End the running session. Calls which are inside a hook are still
+        measured.
+        """
+        with self._lock:
+            if not self.active:
+                return
+
+            self.active = False
+            self._ended = monotonic()
+
+        logger.info("Stopped {} session.".format(self._mode))
+
+    def enter(self, hook, program):
+        """
+        Enter a hooked call. Only call this if the profiler is active.
+
+        :param hook: The name of the hook.
+        :type hook: str
+        :param program: The name of the program for which the call is made.
+        :type program: str
+        :rtype: float
+        :return: The start of the call if it is measured or 0.
+        """
+        if monotonic() > self._deadline:
+            self.stop()
+            return 0
+
+        # Count the calls per hook, so that nested hooks are sampled
+        # independently.
+        calls = self._calls.get(hook, 0) + 1
+        self._calls[hook] = calls
+
+        if calls % self._every:
+            return 0
+
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+
+        if self._mode == Profiler.CPROFILE and depth == 0:
+            # Only the outermost hook of a thread profiles, as a thread can
+            # only run one profile at a time. The calls of one program run in
+            # several threads, and a profile must only be enabled in one of
+            # them, hence each thread gets its own.
+            key = (get_ident(), program)
+
+            with self._lock:
+                profile = self._profiles.get(key)
+                if profile is None:
+                    profile = Profile()
+                    self._profiles[key] = profile
+
+            try:
+                profile.enable()
+            except ValueError:
+                # Another thread is profiling and the interpreter only
+                # supports one profiler for all threads.
+                profile = None
+
+            self._local.profile = profile
+
+        return perf_counter()
+
+    def leave(self, hook, program, start):
+        """
+        Leave a hooked call which was measured.
+
+        :param hook: The name of the hook.
+        :type hook: str
+        :param program: The name of the program for which the call was made.
+        :type program: str
+        :param start: The start of the call as returned by 'enter'.
+        :type start: float
+        """
+        elapsed = perf_counter() - start
+
+        depth = self._local.depth - 1
+        self._local.depth = depth
+
+        if depth == 0:
+            profile = getattr(self._local, 'profile', None)
+            if profile is not None:
+                profile.disable()
+                self._local.profile = None
+
+        with self._lock:
+            stats = self._stats.get((hook, program))
+            if stats is None:
+                stats = [0, 0.0, 0.0]
+                self._stats[(hook, program)] = stats
+
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def report(self, limit = 20):
+        """
+        Get the results of the current or the last session.
+
+        :param limit: The number of functions which are listed per program if
+                      cProfile was used. (Defaults to 20)
+        :type limit: int
+        :rtype: str
+        :return: The human readable results.
+        """
+        with self._lock:
+            if self._mode is None:
+                return "No profiling session was run.\n"
+
+            stats = sorted(self._stats.items(),
+                    key=lambda item: item[1][1], reverse=True)
+            profiles = {}
+            for (_, program), profile in self._profiles.items():
+                profiles.setdefault(program, []).append(profile)
+
+            duration = (self._ended or monotonic()) - self._started
+
+        out = StringIO()
+
+        out.write("{} session, {:.1f} s{}, every {} calls measured.\n\n".format(
+            self._mode, duration, " (running)" if self.active else "",
+            self._every))
+
+        out.write("{:<20} {:<16} {:>8} {:>12} {:>10} {:>10}\n".format(
+            "program", "hook", "calls", "total (ms)", "mean (ms)", "max (ms)"))
+
+        for (hook, program), (calls, total, longest) in stats:
+            out.write("{:<20} {:<16} {:>8} {:>12.2f} {:>10.3f} {:>10.3f}\n"
+                    .format(program, hook, calls, total * 1000,
+                        total / calls * 1000, longest * 1000))
+
+        for program in sorted(profiles):
+            out.write("\ncProfile of {}:\n".format(program))
+
+            # Merge the profiles of all threads of the program.
+            merged = None
+            for profile in profiles[program]:
+                try:
+                    if merged is None:
+                        merged = Stats(profile, stream=out)
+                    else:
+                        merged.add(profile)
+                except TypeError:
+                    # The profile did not collect anything yet.
+                    pass
+
+            if merged is None:
+                out.write("No data.\n")
+            else:
+                merged.sort_stats('cumulative').print_stats(limit)
+
+        return out.getvalue()
+
+
+profiler = Profiler()                   #< The profiler of the process.
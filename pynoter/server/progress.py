@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- progress
+#
+# The progress streams of the pynoter package. A client which reports the
+# progress of a long running task opens a stream and pushes its progress to
+# it as often as it likes. The server only keeps the latest value of each
+# stream and renders it at a limited rate as a message which updates the
+# previous one. Hence, a build which reports thousands of steps only causes
+# a few redraws. As soon as the progress reaches 100%, the stream renders
+# its final state and closes.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from uuid import uuid4
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['ProgressStream']
+
+
+class ProgressStream:
+    """
+    This class holds the state of one progress stream.
+    """
+
+    __slots__ = ['id', 'client', 'subject', 'icon', 'timeout', 'value',
+            'text', 'finished', 'scheduled', 'message_id', '_rendered',
+            '_last_render']
+
+    BAR_WIDTH = 20                  #< The number of characters of the bar.
+
+    def __init__(self, client, subject, icon, timeout):
+        """
+        Constructor of the class.
+
+        :param client: The unique identifier of the client which opened the
+                       stream.
+        :type client: str
+        :param subject: The subject of the messages of the stream.
+        :type subject: str
+        :param icon: The icon of the messages of the stream.
+        :type icon: str
+        :param timeout: The time in ms how long each message should be visible.
+        :type timeout: int
+        """
+        self.id = str(uuid4()).replace('-', '_')
+        self.client = client
+        self.subject = subject
+        self.icon = icon
+        self.timeout = timeout
+
+        self.value = 0.0                #< The latest progress in percent.
+        self.text = ""                  #< The latest text.
+        self.finished = False           #< Whether the stream is complete.
+        self.scheduled = False          #< Whether a render is scheduled.
+        self.message_id = ""            #< The id of the last rendered message.
+
+        self._rendered = None           #< The rendered value and text.
+        self._last_render = None        #< The time of the last render.
+
+    def push(self, value, text):
+        """
+        Set the latest progress of the stream.
+
+        :param value: The progress in percent. Values of 100 or more complete
+                      the stream.
+        :type value: float
+        :param text: The text which describes the current step.
+        :type text: str
+        """
+        self.value = min(max(float(value), 0.0), 100.0)
+        self.text = text
+
+        if self.value >= 100.0:
+            self.finished = True
+
+    def delay(self, now, interval):
+        """
+        Get the time until the stream may be rendered again.
+
+        :param now: The current time in s.
+        :type now: float
+        :param interval: The minimal time in s between two renders.
+        :type interval: float
+        :rtype: float
+        :return: The time in s to wait.
+        """
+        if self._last_render is None:
+            return 0.0
+
+        return max(self._last_render + interval - now, 0.0)
+
+    @property
+    def changed(self):
+        """
+        Whether the state changed since the last render.
+
+        :rtype: bool
+        :return: Whether or not the stream must be rendered again.
+        """
+        return self._rendered != (self.value, self.text)
+
+    def render(self, now):
+        """
+        Render the latest state of the stream as the body of a message and
+        remember it as rendered.
+
+        :param now: The current time in s.
+        :type now: float
+        :rtype: str
+        :return: The body of the message.
+        """
+        self._rendered = (self.value, self.text)
+        self._last_render = now
+
+        filled = int(self.value / 100 * ProgressStream.BAR_WIDTH)
+        bar = "[{}{}] {:.0f}%".format("#" * filled,
+                "-" * (ProgressStream.BAR_WIDTH - filled), self.value)
+
+        if not self.text:
+            return bar
+
+        return bar + "\n" + self.text
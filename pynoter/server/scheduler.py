@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- scheduler
+#
+# The scheduler of the pynoter package. This class was designed to hold back
+# messages which should be displayed at a later point in time. All pending
+# messages are kept in one heap ordered by their due time and a single thread
+# moves them into the queue of the message handler as soon as they are due.
+# Hence, the number of pending messages does not influence the number of
+# threads or timers which are used.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from heapq import heapify, heappush, heappop
+
+from itertools import count
+
+from threading import Thread, Condition
+
+from time import time
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['Scheduler']
+
+
+class Scheduler(Thread):
+    """
+    This class is the worker thread which hands scheduled messages over to the
+    message handler when they become due.
+    """
+
+    def __init__(self, message_handler, journal = None):
+        """
+        Constructor of the class.
+
+        :param message_handler: The message handler which should display the
+                                messages as soon as they are due.
+        :type message_handler: MessageHandler
+        :param journal: The journal which records the scheduled messages or
+                        None. (Defaults to None)
+        :type journal: Journal
+        """
+        logger.debug("Create a new scheduler")
+
+        # Call the super constructor to properly setup the thread.
+        super(Scheduler, self).__init__()
+
+        # Internal variables.
+        self._message_handler = message_handler
+        self._journal = journal
+
+        self._should_stop = False   #< Indicates that the thread should stop
+                                    #  its loop.
+
+        self._heap = []             #< The heap of pending entries ordered by
+                                    #  their due time. Each entry is a list of
+                                    #  due time, sequence number, handler and
+                                    #  message. Cancelled entries have their
+                                    #  message set to None.
+
+        self._cancelled = 0         #< The number of cancelled entries which
+                                    #  are still part of the heap.
+
+        self._entries = {}          #< Index of the pending entries by the id
+                                    #  of their message.
+
+        self._sequence = count()    #< Sequence numbers to keep the order of
+                                    #  entries with the same due time.
+
+        self._condition = Condition() #< Condition to protect the heap and to
+                                    #  wake up the thread.
+
+    def __len__(self):
+        """
+        Get the number of pending messages.
+
+        :rtype: int
+        :return: The number of pending messages.
+        """
+        with self._condition:
+            return len(self._entries)
+
+    def cancel(self, handler, message_id):
+        """
+        Cancel a pending message.
+
+        The entry is only marked as cancelled and dropped as soon as it
+        reaches the top of the heap. If more than half of the heap are
+        cancelled entries, the heap is rebuilt without them.
+
+        :param handler: The client handler which wants to cancel the message.
+        :type handler: ClientHandler
+        :param message_id: The identifier of the message which should be
+                           cancelled.
+        :type message_id: str
+        :rtype: Message
+        :return: The cancelled message or None if there is no such message.
+        """
+        with self._condition:
+            entry = self._entries.get(message_id)
+
+            if entry is None or entry[2] is not handler:
+                return None
+
+            del self._entries[message_id]
+
+            message = entry[3]
+            entry[2] = entry[3] = None
+
+            self._cancelled += 1
+            if self._cancelled * 2 > len(self._heap):
+                self._heap = [e for e in self._heap if e[3] is not None]
+                heapify(self._heap)
+                self._cancelled = 0
+
+        logger.debug("Cancelled scheduled message {}.".format(message_id))
+
+        if self._journal is not None:
+            self._journal.record_close(message)
+
+        return message
+
+    def take_pending(self):
+        """
+        Take all messages which are not due yet, e.g. to hand them over to
+        another server.
+
+        :rtype: list[(float, ClientHandler, Message)]
+        :return: The due time, handler and message of all pending entries in
+                 the order in which they become due.
+        """
+        with self._condition:
+            entries = sorted(e for e in self._heap if e[3] is not None)
+
+            self._heap = []
+            self._entries = {}
+            self._cancelled = 0
+
+        return [(e[0], e[2], e[3]) for e in entries]
+
+    def schedule(self, handler, message, display_at):
+        """
+        Schedule a message which should be displayed at the given time.
+
+        This method is normally executed on the client handlers thread.
+
+        :param handler: The client handler.
+        :type handler: ClientHandler
+        :param message: The message object which should be displayed.
+        :type message: Message
+        :param display_at: The time (in s since the epoch) when the message
+                           should be displayed.
+        :type display_at: float
+        """
+        logger.debug("Schedule message from {} for {}.".format(handler.id,
+            display_at))
+
+        if self._journal is not None:
+            self._journal.record_enqueue(handler, message, display_at)
+
+        entry = [display_at, next(self._sequence), handler, message]
+
+        with self._condition:
+            self._entries[message.id] = entry
+            heappush(self._heap, entry)
+
+            if self._heap[0] is entry:
+                # The new entry is due earlier than everything else. So the
+                # thread must recalculate its waiting time.
+                self._condition.notify()
+
+    def run(self):
+        """
+        Main execution routine of the scheduler.
+        """
+        logger.debug("Scheduler started.")
+
+        while True:
+            due = []
+
+            with self._condition:
+                while not self._should_stop:
+                    # Drop all cancelled entries at the top of the heap.
+                    while self._heap and self._heap[0][3] is None:
+                        heappop(self._heap)
+                        self._cancelled -= 1
+
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+
+                    delay = self._heap[0][0] - time()
+                    if delay > 0:
+                        self._condition.wait(delay)
+                        continue
+
+                    # Collect all entries which are due now.
+                    while self._heap and self._heap[0][0] <= time():
+                        entry = heappop(self._heap)
+
+                        if entry[3] is not None:
+                            del self._entries[entry[3].id]
+                            due.append((entry[2], entry[3]))
+                        else:
+                            self._cancelled -= 1
+
+                    break
+
+                if self._should_stop:
+                    break
+
+            # Hand the messages over without holding the lock.
+            for handler, message in due:
+                logger.debug("Scheduled message from {} is due.".format(
+                    handler.id))
+
+                handler.message_due(message)
+                self._message_handler.enqueue(handler, message)
+
+        logger.debug("Scheduler stopped.")
+
+    def stop(self):
+        """
+        Stop the execution of this scheduler.
+        """
+        logger.debug("Stopping scheduler.")
+
+        with self._condition:
+            self._should_stop = True
+            self._condition.notify()
@@ -14,16 +14,36 @@
 from dbus import SessionBus, SystemBus
 from dbus.service import Object, BusName, method
 from dbus.mainloop.glib import DBusGMainLoop
-from dbus.exceptions import NameExistsException
+from dbus.exceptions import DBusException, NameExistsException
 
 import gi.repository.GLib as glib
 
 import logging
 
-from threading import Thread
+from collections import Counter, OrderedDict, deque
+
+from gc import collect, get_objects
+
+from os import getpid
+from os.path import join
+
+from threading import Thread, Event, RLock, active_count
+
+from time import monotonic
 
 from pynoter.server.client_handler import ClientHandler
-from pynoter.server.message_handler import MessageHandler
+from pynoter.server.flight_recorder import FlightRecorder
+from pynoter.server.handoff import HandoffListener, request_handoff, \
+        confirm_handoff, serve_handoff
+from pynoter.server.history import History
+from pynoter.server.icon_cache import IconCache
+from pynoter.server.journal import Journal
+from pynoter.server.message import Message
+from pynoter.server.message_handler import MessageHandler, MessageItem
+from pynoter.server.profiler import profiler
+from pynoter.server.scheduler import Scheduler
+from pynoter.spool import drain_spool, runtime_dir
+from pynoter.trace import TraceRecorder
 
 
 logger = logging.getLogger(__name__)
@@ -35,7 +55,23 @@ class Server(Object, Thread):
     all the clients and controls everything.
     """
 
-    def __init__(self, bus_suffix = None, use_system_bus = False):
+    EVICTION_GRACE = 10     #< The time in s after its last activity during
+                            #  which a handler is never removed, e.g. because
+                            #  its client did not register yet.
+    SPOOL_INTERVAL = 5      #< The time in s between two drains of the spool,
+                            #  for clients which did not notice yet that the
+                            #  server is running.
+    DAEMON_NAME = 'org.freedesktop.Notifications' #< The bus name of the
+                            #  notification daemon on the session bus.
+
+    def __init__(self, bus_suffix = None, use_system_bus = False,
+            dedup_window = 0, journal_dir = None, spool_dir = None,
+            takeover = False, sinks = None, history_size = 1000,
+            additional_buses = None, handler_pool = 4,
+            handler_idle_timeout = 3600, max_handlers = 1024,
+            trace_file = None, flight_recorder_size = 4096,
+            flight_recorder_file = None, icon_cache_size = 32 * 1024 * 1024,
+            icon_workers = 2):
         """
         Constructor of the class. Within this method the DBus connection will
         be initiated as well as other setup.
@@ -51,50 +87,248 @@ class Server(Object, Thread):
                                started as a system wide daemon.
                                (Defaults to False)
         :type use_system_bus: bool
+        :param dedup_window: The default time in ms during which the client
+                             handlers drop messages which are identical to
+                             recently shown or queued ones. A value of 0
+                             disables this. (Defaults to 0)
+        :type dedup_window: int
+        :param journal_dir: The directory where a journal of all pending
+                            messages should be kept, so that they survive a
+                            restart of the server. (Defaults to None)
+        :type journal_dir: str
+        :param spool_dir: The directory where clients spool their messages if
+                          the server is not running. These messages are
+                          displayed when the server starts. (Defaults to None)
+        :type spool_dir: str
+        :param takeover: Flag which indicates, that a server with the same name
+                         is already running and that this server should take
+                         over its handlers, clients and pending messages before
+                         it replaces it on the bus. (Defaults to False)
+        :type takeover: bool
+        :param sinks: Additional sinks to which all messages should be
+                      mirrored besides the screen. The server starts and stops
+                      them. (Defaults to None)
+        :type sinks: list[Sink]
+        :param history_size: The number of messages which are kept in the
+                             history after they were received. A value of 0
+                             disables the history. (Defaults to 1000)
+        :type history_size: int
+        :param additional_buses: Further buses on which the server should be
+                                 reachable as well, given as pairs of the
+                                 'use_system_bus' flag and the bus suffix. All
+                                 clients share the same message handler and
+                                 hence the screen. (Defaults to None)
+        :type additional_buses: list[(bool, str)]
+        :param handler_pool: The number of client handlers which are created
+                             in advance, so that registering a new program
+                             only has to bind one of them. The pool is
+                             refilled when the main loop is idle. A value of
+                             0 disables the pool. (Defaults to 4)
+        :type handler_pool: int
+        :param handler_idle_timeout: The time in s after which client handlers
+                                     without clients and messages are removed.
+                                     This catches lingering handlers whose last
+                                     message never closed as well as handlers
+                                     at which no client ever registered. A
+                                     value of 0 disables this.
+                                     (Defaults to 3600)
+        :type handler_idle_timeout: int
+        :param max_handlers: The maximum number of client handlers. If there
+                             are more, the least recently used handlers without
+                             clients and messages are removed.
+                             (Defaults to 1024)
+        :type max_handlers: int
+        :param trace_file: The file where all calls of the clients should be
+                           recorded, so that they can be replayed later on
+                           (see 'pynoter.trace'). (Defaults to None)
+        :type trace_file: str
+        :param flight_recorder_size: The number of recent events which the
+                                     flight recorder keeps. (Defaults to 4096)
+        :type flight_recorder_size: int
+        :param flight_recorder_file: The file to which the flight recorder is
+                                     dumped. (Defaults to a file in the
+                                     runtime directory of the user)
+        :type flight_recorder_file: str
+        :param icon_cache_size: The maximum size in bytes of the icons which
+                                are decoded in advance and kept in memory. A
+                                value of 0 disables the icon cache.
+                                (Defaults to 32MiB)
+        :type icon_cache_size: int
+        :param icon_workers: The number of threads which decode the icons.
+                             (Defaults to 2)
+        :type icon_workers: int
         """
-        # Initialize the DBus connection.
+        # Initialize the DBus connections. The first bus is the primary one,
+        # whose name identifies this server, e.g. for a hand-off.
+        buses = [(use_system_bus, bus_suffix)]
+        for bus in additional_buses or []:
+            if bus not in buses:
+                buses.append(bus)
 
-        # Create the bus name.
-        if bus_suffix is None:
-            name = "org.pynoter"
-        else:
-            name = "org.pynoter." + bus_suffix
+        if takeover:
+            # Get the state of the running server. It will not serve any
+            # requests until we took over. Queue up for its names, so that we
+            # get them as soon as the running server releases them.
+            handoff, snapshot = request_handoff(Server._name(bus_suffix))
 
-        # Determine which bus to use.
-        if use_system_bus:
-            self._dbus_bus = SystemBus(mainloop=DBusGMainLoop(set_as_default=True))
+        self._bus_names = [Server._claim_name(system, suffix, takeover)
+                for system, suffix in buses]
 
-            logger.debug("Start server using system bus at {}.".format(name))
+        # Finalize the DBus initialization. Several names may share the same
+        # connection, but the server can only be exported once per connection.
+        Object.__init__(self)
+
+        self._connections = []
+        for bus_name in self._bus_names:
+            if not any(c is bus_name.get_bus() for c in self._connections):
+                self._connections.append(bus_name.get_bus())
+                self.add_to_connection(bus_name.get_bus(), '/')
+
+        # Initialize the thread.
+        Thread.__init__(self)
+
+        # Internal variables
+        self._client_handlers = OrderedDict() #< The client handlers by id,
+                                        #  the least recently active first.
+        self._last_active = {}          #< The time when each handler was
+                                        #  active for the last time by id.
+        self._handlers_lock = RLock()   #< Lock for the handlers, as local
+                                        #  clients use them from their own
+                                        #  threads.
+
+        self._idle_timeout = handler_idle_timeout
+        self._max_handlers = max_handlers
+        self._eviction_timer = None     #< The timer which removes idle
+                                        #  handlers.
+        self._eviction_scheduled = False #< Whether the removal of handlers
+                                        #  above the limit is scheduled.
+        self._evicted_idle = 0          #< The number of removed idle handlers.
+        self._evicted_capacity = 0      #< The number of handlers which were
+                                        #  removed due to the limit.
+        if journal_dir is not None:
+            self._journal = Journal(journal_dir)
+
+            # The running server still writes its journal and hands its
+            # pending messages over instead. Its journal is recovered by the
+            # next server which starts without a hand-off.
+            self._recovered = self._journal.recover() if not takeover else []
         else:
-            self._dbus_bus = SessionBus(mainloop=DBusGMainLoop(set_as_default=True))
+            self._journal = None
+            self._recovered = []
 
-            logger.debug("Start server using session bus at {}.".format(name))
+        self._flight_recorder = FlightRecorder(flight_recorder_size)
+        self._flight_recorder_file = flight_recorder_file #< The file of the
+                                        #  dumps or None for the runtime
+                                        #  directory, which is checked on
+                                        #  each dump.
 
-        try:
-            bus_name = BusName(name, bus=self._dbus_bus, do_not_queue=True)
-        except NameExistsException:
-            logger.error(("A server with the name '{}' already exists on this" +
-                    " bus.").format(name))
+        self._message_handler = MessageHandler(self._journal,
+                self._flight_recorder)
+        self._scheduler = Scheduler(self._message_handler, self._journal)
 
-            raise ValueError("A server with the given name already exists on" +
-                    " the bus. You must choose a different name or a different" +
-                    " bus.")
+        self._sinks = list(sinks) if sinks is not None else []
+        if history_size > 0:
+            self._history = History(history_size)
+            self._sinks.append(self._history)
+        else:
+            self._history = None
 
-        # Finalize the DBus initialization.
-        Object.__init__(self, bus_name, '/')
+        for sink in self._sinks:
+            self._message_handler.add_sink(sink)
+        self._dedup_window = dedup_window
+        self._spool_dir = spool_dir
+        self._spool_timer = None        #< The timer which drains the spool.
 
-        # Initialize the thread.
-        Thread.__init__(self)
+        self._daemon_watch = None       #< The watch for the bus name of the
+                                        #  notification daemon.
+        self._daemon_owner = None       #< The unique bus name of the current
+                                        #  notification daemon.
+
+        self._icon_cache = None         #< The cache of the decoded icons.
+        if icon_cache_size > 0:
+            self._icon_cache = IconCache(icon_cache_size, icon_workers)
+
+        self._recorder = None           #< The recorder of the client calls.
+        if trace_file is not None:
+            self._recorder = TraceRecorder(trace_file)
 
-        # Internal variables
-        self._bus_name = bus_name
-        self._client_handlers = []
-        self._message_handler = MessageHandler()
         self._running = False
 
+        self._pool = deque()            #< The unbound client handlers.
+        self._pool_size = handler_pool  #< The size of the pool.
+        self._pool_refilling = False    #< Whether the refill of the pool is
+                                        #  already scheduled on the main loop.
+
+        self._handoff_listener = None
+        self._handed_off = Event()
+
         self._main_loop = glib.MainLoop.new(None, False)
         glib.threads_init()
 
+        if takeover:
+            self._restore_snapshot(snapshot)
+            self._restore_snapshot(confirm_handoff(handoff))
+
+            logger.debug("Took over from the running server.")
+
+    @staticmethod
+    def _name(bus_suffix):
+        """
+        Get the bus name of a server.
+
+        :param bus_suffix: The suffix which should be added to the normal
+                           'org.pynoter' bus name or None.
+        :type bus_suffix: str
+        :rtype: str
+        :return: The bus name.
+        """
+        if bus_suffix is None:
+            return "org.pynoter"
+
+        return "org.pynoter." + bus_suffix
+
+    @staticmethod
+    def _claim_name(use_system_bus, bus_suffix, queue):
+        """
+        Connect to a bus and claim the bus name of the server there.
+
+        :param use_system_bus: Flag which indicates, that the DBus system bus
+                               should be used instead of the session bus.
+        :type use_system_bus: bool
+        :param bus_suffix: The suffix which should be added to the normal
+                           'org.pynoter' bus name or None.
+        :type bus_suffix: str
+        :param queue: Flag which indicates, that we should queue up for the
+                      name if another server owns it.
+        :type queue: bool
+        :rtype: BusName
+        :return: The claimed bus name.
+        """
+        name = Server._name(bus_suffix)
+
+        # Determine which bus to use.
+        if use_system_bus:
+            bus = SystemBus(mainloop=DBusGMainLoop(set_as_default=True))
+
+            logger.debug("Start server using system bus at {}.".format(name))
+        else:
+            bus = SessionBus(mainloop=DBusGMainLoop(set_as_default=True))
+
+            logger.debug("Start server using session bus at {}.".format(name))
+
+        if queue:
+            return BusName(name, bus=bus)
+
+        try:
+            return BusName(name, bus=bus, do_not_queue=True)
+        except NameExistsException:
+            logger.error(("A server with the name '{}' already exists on " +
+                    "this bus.").format(name))
+
+            raise ValueError("A server with the given name already exists" +
+                    " on the bus. You must choose a different name or a" +
+                    " different bus.")
+
     def __del__(self):
         """
         Destructor of the class. Properly shutdown everything.
@@ -123,16 +357,686 @@ class Server(Object, Thread):
         :rtype: str
         :return: The address of the handler for this particular program.
         """
-        # Check if a handler already exists.
-        for handler in self._client_handlers:
-            if handler.can_handle(program_name, multi_client, lingering):
-                return handler.path
+        if self._recorder is not None:
+            self._recorder.record(TraceRecorder.GET_HANDLER,
+                    TraceRecorder.flags(multi_client, lingering),
+                    program_name)
+
+        return self.handler_for(program_name, multi_client, lingering).path
+
+    @method(dbus_interface='org.pynoter.server', out_signature='a{sa{sd}}')
+    def get_sink_statistics(self):
+        """
+        Get the statistics of all sinks to which the messages are mirrored.
+
+        :rtype: dict
+        :return: The statistics (submitted, processed, failed, dropped and
+                 queued events as well as the lag in s) per sink.
+        """
+        return dict((sink.sink_name, sink.statistics) for sink in self._sinks)
+
+    @method(dbus_interface='org.pynoter.server', out_signature='a{sd}')
+    def get_handler_statistics(self):
+        """
+        Get the statistics of the client handlers.
+
+        :rtype: dict
+        :return: The number of handlers, idle handlers and handlers in the
+                 pool as well as the number of handlers which were removed
+                 because they were idle or above the limit.
+        """
+        with self._handlers_lock:
+            handlers = list(self._client_handlers.values())
+
+            statistics = {
+                'handlers': float(len(handlers)),
+                'pooled': float(len(self._pool)),
+                'evicted_idle': float(self._evicted_idle),
+                'evicted_capacity': float(self._evicted_capacity)
+            }
+
+        statistics['idle'] = float(sum(1 for h in handlers if h.idle))
+
+        return statistics
+
+    @method(dbus_interface='org.pynoter.server', out_signature='a{sd}')
+    def get_icon_cache_statistics(self):
+        """
+        Get the statistics of the cache of the decoded icons.
+
+        :rtype: dict
+        :return: The number of cached icons, their size in bytes and the
+                 number of hits, misses and evicted icons.
+        """
+        if self._icon_cache is None:
+            raise ValueError("The icon cache is disabled.")
+
+        return self._icon_cache.statistics
+
+    @method(dbus_interface='org.pynoter.server', in_signature='b',
+            out_signature='a{sd}')
+    def get_object_counts(self, collect_garbage):
+        """
+        Get the number of live objects and the sizes of the queues of the
+        server, to find leaks. This walks all objects of the process, so it
+        should not be called frequently.
+
+        :param collect_garbage: Flag which indicates whether unreachable
+                                objects are collected before counting.
+        :type collect_garbage: bool
+        :rtype: dict
+        :return: The number of messages, message items, client handlers and
+                 threads as well as the sizes of the queues of the message
+                 handler and of the scheduler.
+        """
+        if collect_garbage:
+            collect()
+
+        classes = (Message, MessageItem, ClientHandler)
+        counts = Counter(type(o) for o in get_objects()
+                if isinstance(o, classes))
+
+        statistics = self._message_handler.statistics
+
+        statistics.update({
+            'messages': float(counts[Message]),
+            'message_items': float(counts[MessageItem]),
+            'client_handlers': float(counts[ClientHandler]),
+            'threads': float(active_count()),
+            'scheduled': float(len(self._scheduler))
+        })
+
+        return statistics
+
+    @method(dbus_interface='org.pynoter.server', in_signature='sdi',
+            out_signature='a(sssssdddi)')
+    def history(self, program_name, since, limit):
+        """
+        Get the messages which the server received after the given time.
+
+        To get the next page, call this method again with the receive time of
+        the last returned message.
+
+        :param program_name: The name of the program whose messages should be
+                             returned. Use '' for all programs.
+        :type program_name: str
+        :param since: Only messages which were received after this time (in s
+                      since the epoch) are returned.
+        :type since: float
+        :param limit: The maximum number of messages which are returned.
+        :type limit: int
+        :rtype: list[tuple]
+        :return: The id, program, subject, body, icon, the times when the
+                 message was received, displayed and closed (or 0) and the
+                 reason why it was closed (or 0) of each message, oldest first.
+        """
+        if self._history is None:
+            raise ValueError("The history is disabled.")
+
+        return self._history.query(program_name, since, limit)
+
+    @method(dbus_interface='org.pynoter.server', in_signature='si',
+            out_signature='a(sssssdddi)')
+    def recent_history(self, program_name, limit):
+        """
+        Get the messages which the server received most recently.
+
+        :param program_name: The name of the program whose messages should be
+                             returned. Use '' for all programs.
+        :type program_name: str
+        :param limit: The maximum number of messages which are returned.
+        :type limit: int
+        :rtype: list[tuple]
+        :return: The messages as described in 'history', oldest first.
+        """
+        if self._history is None:
+            raise ValueError("The history is disabled.")
+
+        return self._history.recent(program_name, limit)
+
+    @method(dbus_interface='org.pynoter.server', in_signature='s',
+            out_signature='(sssssdddi)')
+    def history_entry(self, message_id):
+        """
+        Get the history entry of a single message.
+
+        :param message_id: The unique identifier of the message.
+        :type message_id: str
+        :rtype: tuple
+        :return: The message as described in 'history'.
+        """
+        if self._history is None:
+            raise ValueError("The history is disabled.")
+
+        entry = self._history.lookup(message_id)
+        if entry is None:
+            raise ValueError("The message is not part of the history.")
+
+        return entry
+
+    @method(dbus_interface='org.pynoter.server', out_signature='s')
+    def dump_flight_recorder(self):
+        """
+        Write the most recent events of the server to the file of the flight
+        recorder.
+
+        :rtype: str
+        :return: The path of the file.
+        """
+        try:
+            path = self._flight_recorder_file
+            if path is None:
+                path = join(runtime_dir(),
+                        "flight-recorder-{}.log".format(getpid()))
+
+            logger.info("Dump the flight recorder to {}.".format(path))
+
+            self._flight_recorder.dump(path)
+        except (OSError, RuntimeError) as e:
+            raise ValueError("Failed to dump the flight recorder: {}".format(e))
+
+        return path
+
+    @method(dbus_interface='org.pynoter.server', in_signature='sid')
+    def start_profiling(self, mode, every, duration):
+        """
+        Start to profile the hot paths of the server. The results of the
+        previous session are dropped.
+
+        :param mode: Either 'trace' to measure the duration of the calls per
+                     program or 'cprofile' to run cProfile around them, with
+                     one profile per program.
+        :type mode: str
+        :param every: Only every n-th call is measured.
+        :type every: int
+        :param duration: The time in s after which profiling stops again.
+        :type duration: float
+        """
+        profiler.start(mode, every, duration)
+
+    @method(dbus_interface='org.pynoter.server')
+    def stop_profiling(self):
+        """
+        Stop profiling the hot paths of the server.
+        """
+        profiler.stop()
+
+    @method(dbus_interface='org.pynoter.server', in_signature='i',
+            out_signature='s')
+    def profiling_report(self, limit):
+        """
+        Get the results of the current or the last profiling session.
+
+        :param limit: The number of functions which are listed per program if
+                      cProfile was used.
+        :type limit: int
+        :rtype: str
+        :return: The human readable results.
+        """
+        return profiler.report(limit)
+
+    def _create_client_handler(self, program_name, multi_client, lingering,
+            handler_id = None):
+        """
+        Create a new client handler for the given program.
+
+        :param program_name: The name of the program which the handler should
+                             serve.
+        :type program_name: str
+        :param multi_client: Flag which indicates if the handler serves
+                             multiple clients.
+        :type multi_client: bool
+        :param lingering: Flag which indicates, that the handler should stay
+                          alive even if all clients vanished.
+        :type lingering: bool
+        :param handler_id: The unique identifier of the handler if it is
+                           already known. (Defaults to None)
+        :type handler_id: str
+        :rtype: ClientHandler
+        :return: The new client handler.
+        """
+        if handler_id is None:
+            try:
+                handler = self._pool.popleft()
+            except IndexError:
+                pass
+            else:
+                handler.bind(program_name, multi_client, lingering,
+                        self._dedup_window)
+                self._schedule_pool_refill()
+
+                self._flight_recorder.record(FlightRecorder.HANDLER_BIND,
+                        handler.id, "program={}".format(program_name))
+
+                return handler
 
-        # No handler found, so create a new one.
         handler = ClientHandler(program_name, multi_client, lingering,
-                self._message_handler, self._bus_name, self)
+                self._message_handler, self._connections, self,
+                dedup_window=self._dedup_window, handler_id=handler_id)
+
+        self._flight_recorder.record(FlightRecorder.HANDLER_CREATE,
+                handler.id, "program={}".format(program_name))
+
+        return handler
+
+    def _evict(self, handler, reason):
+        """
+        Remove an idle client handler from the server and from DBus.
+
+        :param handler: The handler which should be removed.
+        :type handler: ClientHandler
+        :param reason: The reason why the handler is removed ('idle' or
+                       'capacity').
+        :type reason: str
+        """
+        self._flight_recorder.record(FlightRecorder.HANDLER_EVICT, handler.id,
+                "reason={}".format(reason))
+
+        self.remove_client_handler(handler)
+
+        try:
+            handler.remove_from_connection()
+        except LookupError:
+            pass
+
+    def _evict_idle(self):
+        """
+        Remove all handlers which are idle for longer than the idle timeout.
+
+        This method runs periodically on the main loop. As the handlers are
+        ordered by their last activity, only the handlers which were inactive
+        for long enough are looked at.
+
+        :rtype: bool
+        :return: Always True, so that the timer keeps running.
+        """
+        deadline = monotonic() - max(self._idle_timeout,
+                Server.EVICTION_GRACE)
+
+        with self._handlers_lock:
+            candidates = []
+            for handler_id, handler in self._client_handlers.items():
+                if self._last_active[handler_id] > deadline:
+                    break
+
+                candidates.append(handler)
+
+        # Check the handlers without holding the lock, as they take their own
+        # lock first and the server's lock afterwards.
+        for handler in candidates:
+            if handler.idle:
+                logger.debug("Evict idle client handler {}.".format(
+                    handler.id))
+
+                self._evict(handler, 'idle')
+                self._evicted_idle += 1
+
+        return True
+
+    def _evict_over_capacity(self):
+        """
+        Remove the least recently active idle handlers until there are not
+        more handlers than allowed.
+
+        This method runs on the main loop after a handler was added.
+
+        :rtype: bool
+        :return: Always False, so that the main loop does not call this
+                 function again.
+        """
+        deadline = monotonic() - Server.EVICTION_GRACE
+
+        with self._handlers_lock:
+            self._eviction_scheduled = False
+
+            excess = len(self._client_handlers) - self._max_handlers
+
+            candidates = []
+            for handler_id, handler in self._client_handlers.items():
+                if self._last_active[handler_id] > deadline:
+                    break
+
+                candidates.append(handler)
+
+        for handler in candidates:
+            if excess <= 0:
+                break
 
-        return handler.path
+            if handler.idle:
+                logger.debug("Evict client handler {} above the limit.".format(
+                    handler.id))
+
+                self._evict(handler, 'capacity')
+                self._evicted_capacity += 1
+                excess -= 1
+
+        if excess > 0:
+            logger.warning(("There are {} client handlers more than allowed, " +
+                    "but all of them are in use.").format(excess))
+
+        return False
+
+    def _schedule_pool_refill(self):
+        """
+        Refill the pool of client handlers as soon as the main loop is idle.
+        """
+        with self._handlers_lock:
+            if self._pool_refilling:
+                return
+
+            self._pool_refilling = True
+
+        glib.idle_add(self._refill_pool)
+
+    def _refill_pool(self):
+        """
+        Add one client handler to the pool.
+
+        This method runs on the main loop whenever it is idle, so that a storm
+        of registrations is not delayed by creating the handlers.
+
+        :rtype: bool
+        :return: Whether or not the pool needs more handlers.
+        """
+        with self._handlers_lock:
+            if len(self._pool) >= self._pool_size or not self._running:
+                self._pool_refilling = False
+                return False
+
+        handler = ClientHandler(None, False, False, self._message_handler,
+                self._connections, self)
+        self._pool.append(handler)
+
+        self._flight_recorder.record(FlightRecorder.HANDLER_CREATE,
+                handler.id, "pooled")
+
+        return True
+
+    def _restore_messages(self, records):
+        """
+        Enqueue messages again which were pending when the server stopped.
+
+        The messages of each former client handler are given to a new lingering
+        handler, so that references between them stay intact and the handler
+        vanishes as soon as its messages are displayed.
+
+        :param records: The descriptions of the pending messages in the order
+                        in which they were enqueued.
+        :type records: list[dict]
+        """
+        handlers = {}
+
+        for record in records:
+            handler = handlers.get(record['handler'])
+            if handler is None:
+                handler = self._create_client_handler(record['program'],
+                        record['multi_client'], True)
+                handlers[record['handler']] = handler
+
+            handler.inject_message(record['client'], record['subject'],
+                    record['body'], record['icon'], record['timeout'],
+                    record['append'], record['update'], record['reference'],
+                    record['id'], record.get('display_at'))
+
+    def _daemon_changed(self, owner):
+        """
+        Callback which is called if the notification daemon appears, vanishes
+        or is replaced.
+
+        The notifications of a daemon which went away are gone, and it never
+        reports them as closed. Hence all visible messages are marked as
+        vanished, as otherwise the worker would wait forever for a message
+        which never expires, and its handler could never be removed.
+
+        :param owner: The unique bus name of the new daemon or an empty string
+                      if there is none.
+        :type owner: str
+        """
+        previous = self._daemon_owner
+        self._daemon_owner = owner
+
+        if not previous or previous == owner:
+            return
+
+        logger.warning("The notification daemon went away. Mark all visible " +
+                "messages as vanished.")
+
+        self._message_handler.expire_displayed()
+
+    def _drain_spool(self):
+        """
+        Display the messages which clients spooled while the server was not
+        running.
+
+        All messages of a program and flag combination are given to the same
+        lingering handler. As the spool files are drained in the order in which
+        they were created, the order of the messages of each program and the
+        references between them are preserved.
+
+        This method runs at the start and periodically on the main loop, as
+        clients which started while the server was not running keep writing
+        to the spool until they notice that it is running.
+
+        :rtype: bool
+        :return: Always True, so that the timer keeps running.
+        """
+        handlers = {}
+
+        try:
+            records = drain_spool(self._spool_dir)
+        except OSError as e:
+            logger.error("Failed to drain the spool: {}".format(e))
+            return True
+
+        for record in records:
+            key = (record['program'], record['multi_client'],
+                    record['lingering'])
+
+            handler = handlers.get(key)
+            if handler is None:
+                handler = self._create_client_handler(record['program'],
+                        record['multi_client'], True)
+                handlers[key] = handler
+
+            handler.inject_message(record['client'], record['subject'],
+                    record['body'], record['icon'], record['timeout'],
+                    record['append'], record['update'], record['reference'],
+                    record['id'], record['display_at'])
+
+        return True
+
+    def _release(self):
+        """
+        Remove the server and all its handlers from DBus and give up the bus
+        names, so that another server can take over.
+        """
+        logger.debug("Release the bus names.")
+
+        handlers = list(self._client_handlers.values()) + list(self._pool)
+
+        for handler in handlers:
+            handler.remove_from_connection()
+        self._pool.clear()
+
+        self.remove_from_connection()
+
+        for bus_name in self._bus_names:
+            bus_name.get_bus().release_name(bus_name.get_name())
+
+        self._handed_off.set()
+
+    def _restore_snapshot(self, snapshot):
+        """
+        Restore the state which was handed over from another server.
+
+        :param snapshot: The snapshot of the other server.
+        :type snapshot: dict
+        """
+        logger.debug("Restore {} handlers and {} messages.".format(
+            len(snapshot['handlers']), len(snapshot['messages'])))
+
+        # The snapshot which is sent after the bus names were released also
+        # contains the handlers of the first one.
+        handlers = {}
+        for state in snapshot['handlers']:
+            handler = self._client_handlers.get(state['id'])
+            if handler is None:
+                handler = self._create_client_handler(state['program'],
+                        state['multi_client'], state['lingering'],
+                        handler_id=state['id'])
+
+            handlers[state['id']] = handler
+
+        for record in snapshot['messages']:
+            handlers[record['handler']].inject_message(record['client'],
+                    record['subject'], record['body'], record['icon'],
+                    record['timeout'], record['append'], record['update'],
+                    record['reference'], record['id'], record['display_at'])
+
+        # Restore the handler state last, so that the injected messages do not
+        # alter it.
+        for state in snapshot['handlers']:
+            handlers[state['id']].restore(state)
+
+    def _call_on_main_loop(self, function):
+        """
+        Call a function on the main loop and wait for its result.
+
+        :param function: The function which should be called.
+        :type function: callable
+        :return: The result of the function.
+        """
+        done = Event()
+        result = []
+
+        def call():
+            try:
+                result.append(function())
+            finally:
+                done.set()
+
+            return False
+
+        glib.idle_add(call)
+        done.wait()
+
+        return result[0]
+
+    def _take_snapshot(self, pending = True):
+        """
+        Take the pending messages and create a snapshot of the state of this
+        server for a hand-off.
+
+        This method runs on the main loop, so that no DBus call is processed
+        while the snapshot is taken.
+
+        :param pending: Whether or not the pending messages are taken.
+                        Otherwise, the snapshot only contains the handlers and
+                        the message handler holds back all messages until they
+                        are taken. (Defaults to True)
+        :type pending: bool
+        :rtype: tuple[dict, list, list]
+        :return: The snapshot and the taken queued and scheduled messages.
+        """
+        if pending:
+            # Take the scheduled messages first, so that a message which
+            # becomes due in the meantime is found in the queue.
+            scheduled = self._scheduler.take_pending()
+            queued = self._message_handler.take_pending()
+        else:
+            self._message_handler.hold(True)
+            queued = []
+            scheduled = []
+
+        pending = [(None, item.handler, item.message) for item in queued] + \
+                scheduled
+
+        # Handlers without clients and pending messages are only waiting for
+        # a message on the screen of this server to close.
+        busy = set(handler for _, handler, _ in pending)
+        handlers = [h for h in self._client_handlers.values()
+                if h.clients or h in busy]
+
+        snapshot = {
+            'handlers': [handler.snapshot() for handler in handlers],
+            'messages': [{
+                'handler': handler.id,
+                'client': message.client,
+                'id': message.id,
+                'subject': message.subject,
+                'body': message.body,
+                'icon': message.icon,
+                'timeout': message.timeout,
+                'append': bool(message.appends),
+                'update': bool(message.updates),
+                'reference': message.reference,
+                'display_at': display_at
+            } for display_at, handler, message in pending]
+        }
+
+        return snapshot, queued, scheduled
+
+    def _serve_handoff(self, connection):
+        """
+        Hand the state of this server over to a new one.
+
+        This method runs on the hand-off listener. The server keeps serving
+        DBus calls while the new server restores the snapshot of the handlers,
+        but holds back all messages. They are only sent along once the bus
+        names are released, so that the messages of each program keep their
+        order, and references and withdrawals of pending messages are resolved
+        by the server which has them.
+
+        :param connection: The connection to the new server.
+        :type connection: socket
+        :rtype: bool
+        :return: Whether or not the new server took over.
+        """
+        logger.debug("Hand over the state to a new server.")
+
+        snapshot, _, _ = self._call_on_main_loop(
+                lambda: self._take_snapshot(False))
+
+        queued = []
+        scheduled = []
+
+        def release():
+            changes, taken_queued, taken_scheduled = self._take_snapshot()
+            queued.extend(taken_queued)
+            scheduled.extend(taken_scheduled)
+
+            self._release()
+            self._message_handler.hold(False)
+
+            # The messages belong to the journal of the new server now.
+            if self._journal is not None:
+                for item in queued:
+                    self._journal.record_close(item.message)
+
+                for _, _, message in scheduled:
+                    self._journal.record_close(message)
+
+            return changes
+
+        if serve_handoff(connection, snapshot,
+                lambda: self._call_on_main_loop(release)):
+            logger.info("Handed over to a new server.")
+            return True
+
+        # The new server did not take over, so continue as if nothing
+        # happened.
+        def restore():
+            self._message_handler.hold(False)
+
+            for item in queued:
+                self._message_handler.enqueue(item.handler, item.message)
+
+            for display_at, handler, message in scheduled:
+                self._scheduler.schedule(handler, message, display_at)
+
+        self._call_on_main_loop(restore)
+
+        return False
 
     # Normal Interface
 
@@ -143,9 +1047,21 @@ class Server(Object, Thread):
         :param handler: The client handler which should be added.
         :type handler: ClientHandler
         """
-        if not handler in self._client_handlers:
-            logger.debug("Add new client handler: {}".format(handler.id))
-            self._client_handlers.append(handler)
+        with self._handlers_lock:
+            if not handler.id in self._client_handlers:
+                logger.debug("Add new client handler: {}".format(handler.id))
+                self._client_handlers[handler.id] = handler
+                self._last_active[handler.id] = monotonic()
+
+            if len(self._client_handlers) <= self._max_handlers or \
+                    self._eviction_scheduled:
+                return
+
+            self._eviction_scheduled = True
+
+        # Remove handlers on the main loop, as we might be called while a lock
+        # of a handler is held.
+        glib.idle_add(self._evict_over_capacity)
 
     def remove_client_handler(self, handler):
         """
@@ -154,9 +1070,121 @@ class Server(Object, Thread):
         :param handler: The handler which should be removed.
         :type handler: ClientHandler
         """
-        if handler in self._client_handlers:
-            logger.debug("Remove client handler: {}".format(handler.id))
-            self._client_handlers.remove(handler)
+        with self._handlers_lock:
+            if handler.id in self._client_handlers:
+                logger.debug("Remove client handler: {}".format(handler.id))
+                del self._client_handlers[handler.id]
+                del self._last_active[handler.id]
+
+                self._flight_recorder.record(FlightRecorder.HANDLER_REMOVE,
+                        handler.id)
+
+    def touch_client_handler(self, handler):
+        """
+        Remember that the given client handler was just active, so that it is
+        not removed as idle.
+
+        :param handler: The handler which was active.
+        :type handler: ClientHandler
+        """
+        with self._handlers_lock:
+            if handler.id in self._client_handlers:
+                self._client_handlers.move_to_end(handler.id)
+                self._last_active[handler.id] = monotonic()
+
+    def handler_for(self, program_name, multi_client, lingering):
+        """
+        Get a handler for the given program. If no existing handler can serve
+        it, a new one is created.
+
+        :param program_name: The name of the program for which a client wants
+                             to be handled.
+        :type program_name: str
+        :param multi_client: Flag which indicates if there will be more clients
+                             registering for the same client_name, which should
+                             be treated as one client.
+        :type multi_client: bool
+        :param lingering: Flag which indicates, that the handler for this
+                          client should stay alive even if the current client
+                          vanishes.
+        :type lingering: bool
+        :rtype: ClientHandler
+        :return: The handler for this particular program.
+        """
+        with self._handlers_lock:
+            # Check if a handler already exists.
+            for handler in self._client_handlers.values():
+                if handler.can_handle(program_name, multi_client, lingering):
+                    return handler
+
+            # No handler found, so create a new one.
+            return self._create_client_handler(program_name, multi_client,
+                    lingering)
+
+    def hand_off(self, connection):
+        """
+        Hand the state of this server over to a new server which requested it.
+
+        This method is called from the hand-off listener and blocks until the
+        hand-off is done. The main loop is only blocked while the snapshots
+        are taken and the bus names are released.
+
+        :param connection: The connection to the new server.
+        :type connection: socket
+        :rtype: bool
+        :return: Whether or not the new server took over.
+        """
+        return self._serve_handoff(connection)
+
+    @property
+    def handed_off(self):
+        """
+        Get the event which is set as soon as another server took over.
+
+        :rtype: Event
+        :return: The event which indicates the hand-off.
+        """
+        return self._handed_off
+
+    @property
+    def flight_recorder(self):
+        """
+        Get the flight recorder which keeps the most recent events.
+
+        :rtype: FlightRecorder
+        :return: The flight recorder of this server.
+        """
+        return self._flight_recorder
+
+    @property
+    def icon_cache(self):
+        """
+        Get the cache of the decoded icons.
+
+        :rtype: IconCache
+        :return: The icon cache or None if icons are not cached.
+        """
+        return self._icon_cache
+
+    @property
+    def recorder(self):
+        """
+        Get the recorder of the client calls.
+
+        :rtype: TraceRecorder
+        :return: The recorder or None if the calls are not recorded.
+        """
+        return self._recorder
+
+    @property
+    def scheduler(self):
+        """
+        Get the scheduler which holds back messages until they are due.
+
+        :rtype: Scheduler
+        :return: The scheduler of this server.
+        """
+        return self._scheduler
 
     def run(self):
         """
@@ -180,9 +1208,59 @@ class Server(Object, Thread):
 
             logger.debug("Starting server...")
 
+            if self._journal is not None:
+                logger.debug("Start journal.")
+                self._journal.start()
+
+            for sink in self._sinks:
+                logger.debug("Start sink {}.".format(sink.sink_name))
+                sink.start()
+
             logger.debug("Start message handler.")
             self._message_handler.start()
 
+            logger.debug("Start scheduler.")
+            self._scheduler.start()
+
+            if self._recovered:
+                logger.debug("Restore {} pending messages.".format(
+                    len(self._recovered)))
+                self._restore_messages(self._recovered)
+                self._recovered = []
+
+            if self._spool_dir is not None:
+                logger.debug("Drain spool at {}.".format(self._spool_dir))
+                self._drain_spool()
+                self._spool_timer = glib.timeout_add_seconds(
+                        Server.SPOOL_INTERVAL, self._drain_spool)
+
+            logger.debug("Watch the notification daemon.")
+            try:
+                self._daemon_watch = SessionBus().watch_name_owner(
+                        Server.DAEMON_NAME, self._daemon_changed)
+            except DBusException as e:
+                logger.warning("Failed to watch the notification daemon: " +
+                        "{}".format(e))
+
+            if self._pool_size > 0:
+                logger.debug("Fill the pool of client handlers.")
+                self._schedule_pool_refill()
+
+            if self._idle_timeout > 0:
+                logger.debug("Evict client handlers after {} s idle.".format(
+                    self._idle_timeout))
+                self._eviction_timer = glib.timeout_add_seconds(
+                        min(self._idle_timeout, 60), self._evict_idle)
+
+            logger.debug("Listen for hand-off requests.")
+            try:
+                self._handoff_listener = HandoffListener(self,
+                        self._bus_names[0].get_name())
+                self._handoff_listener.start()
+            except (OSError, RuntimeError) as e:
+                logger.warning("Failed to listen for hand-off requests: " +
+                        "{}".format(e))
+
             # Call Thread's start method so that the server thread is started.
             Thread.start(self)
 
@@ -196,14 +1274,60 @@ class Server(Object, Thread):
 
             logger.debug("Stopping server...")
 
-            logger.debug("Tear down DBus connection.")
-            self.remove_from_connection(self._dbus_bus, self._object_path)
+            if self._handoff_listener is not None:
+                logger.debug("Stop listening for hand-off requests.")
+                self._handoff_listener.stop()
+
+            if not self._handed_off.is_set():
+                logger.debug("Tear down DBus connections.")
+                self.remove_from_connection()
+
+                for handler in self._pool:
+                    handler.remove_from_connection()
+                self._pool.clear()
+
+            if self._eviction_timer is not None:
+                glib.source_remove(self._eviction_timer)
+                self._eviction_timer = None
+
+            if self._spool_timer is not None:
+                glib.source_remove(self._spool_timer)
+                self._spool_timer = None
+
+            if self._daemon_watch is not None:
+                self._daemon_watch.cancel()
+                self._daemon_watch = None
+
+            logger.debug("Stop scheduler.")
+            self._scheduler.stop()
+            if self._scheduler.is_alive():
+                self._scheduler.join()
 
             logger.debug("Stop message handler.")
             self._message_handler.stop()
-            if self._message_handler.isAlive():
+            if self._message_handler.is_alive():
                 self._message_handler.join()
 
+            for sink in self._sinks:
+                logger.debug("Stop sink {}.".format(sink.sink_name))
+                sink.stop()
+                if sink.is_alive():
+                    sink.join()
+
+            if self._journal is not None:
+                logger.debug("Stop journal.")
+                self._journal.stop()
+                if self._journal.is_alive():
+                    self._journal.join()
+
+            if self._recorder is not None:
+                logger.debug("Stop recording.")
+                self._recorder.close()
+
+            if self._icon_cache is not None:
+                logger.debug("Stop icon cache.")
+                self._icon_cache.shutdown()
+
             logger.debug("Stop main loop.")
             self._main_loop.quit()
 
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- sinks
+#
+# The sinks of the pynoter package. Besides being displayed on the screen,
+# every message can be mirrored to further destinations, e.g. a log file or
+# local subscribers. Each sink has its own bounded queue and worker thread,
+# so that a slow sink never delays the display of the notifications. If the
+# queue of a sink is full, its overflow policy decides what happens.
+#
+# Every sink receives the events of all messages in the order in which they
+# happened: 'enqueued' when a message arrives, 'displayed' when it is shown
+# and 'closed' when it vanished. Appended or updated messages are delivered
+# as events of their own, which carry the flags and the reference. It is up
+# to the sink whether it merges them like the display does.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from collections import deque
+
+from json import dumps
+
+from os import makedirs, remove
+from os.path import dirname
+
+from socket import socket, AF_UNIX, SOCK_STREAM
+
+from threading import Thread, Condition, Lock
+
+from time import monotonic, strftime, localtime
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['Sink', 'LogFileSink', 'SocketSink']
+
+
+class Sink(Thread):
+    """
+    The base class of all sinks. It implements the queue and the worker
+    thread. Subclasses must implement the 'process' method.
+    """
+
+    BLOCK = 'block'             #< Wait until there is space in the queue.
+                                #  This delays the display pipeline.
+    DROP_OLDEST = 'drop_oldest' #< Drop the oldest event in the queue.
+    DROP_NEWEST = 'drop_newest' #< Drop the new event.
+
+    def __init__(self, name, capacity = 1024, overflow = DROP_OLDEST):
+        """
+        Constructor of the class.
+
+        :param name: The name of the sink, used for statistics.
+        :type name: str
+        :param capacity: The maximum number of events which are queued.
+                         (Defaults to 1024)
+        :type capacity: int
+        :param overflow: The policy which is applied if the queue is full.
+                         (Defaults to Sink.DROP_OLDEST)
+        :type overflow: str
+        """
+        if overflow not in (Sink.BLOCK, Sink.DROP_OLDEST, Sink.DROP_NEWEST):
+            raise ValueError("Unknown overflow policy '{}'.".format(overflow))
+
+        if capacity <= 0:
+            raise ValueError("The capacity of a sink must be positive.")
+
+        # Call the super constructor to properly setup the thread.
+        super(Sink, self).__init__(name="sink-" + name)
+
+        self._sink_name = name
+        self._capacity = capacity
+        self._overflow = overflow
+
+        self._queue = deque()       #< The queued events together with the
+                                    #  time when they were submitted.
+
+        self._condition = Condition() #< Condition to protect the queue and to
+                                    #  wake up the threads.
+
+        self._should_stop = False   #< Indicates that the thread should stop
+                                    #  its loop.
+
+        self._submitted = 0         #< The number of submitted events.
+        self._processed = 0         #< The number of processed events.
+        self._dropped = 0           #< The number of dropped events.
+        self._failed = 0            #< The number of events whose processing
+                                    #  failed.
+
+    def process(self, event):
+        """
+        Process a single event.
+
+        This method is called on the thread of the sink.
+
+        :param event: The event which should be processed.
+        :type event: dict
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Release all resources of the sink. This is called on the thread of the
+        sink after the last event was processed.
+        """
+        pass
+
+    def submit(self, event):
+        """
+        Add an event to the queue of the sink.
+
+        This method is normally executed on the threads of the message
+        handler and the client handlers. It only blocks if the overflow policy
+        says so.
+
+        :param event: The event which should be processed.
+        :type event: dict
+        """
+        with self._condition:
+            self._submitted += 1
+
+            if len(self._queue) >= self._capacity:
+                if self._overflow == Sink.DROP_NEWEST:
+                    self._dropped += 1
+                    return
+
+                if self._overflow == Sink.DROP_OLDEST:
+                    self._queue.popleft()
+                    self._dropped += 1
+                else:
+                    while len(self._queue) >= self._capacity and \
+                            not self._should_stop:
+                        self._condition.wait()
+
+            self._queue.append((monotonic(), event))
+            self._condition.notify_all()
+
+    def run(self):
+        """
+        Main execution routine of the sink.
+        """
+        logger.debug("Sink {} started.".format(self._sink_name))
+
+        while True:
+            with self._condition:
+                while not self._queue and not self._should_stop:
+                    self._condition.wait()
+
+                if not self._queue:
+                    break
+
+                _, event = self._queue.popleft()
+                self._condition.notify_all()
+
+            try:
+                self.process(event)
+            except Exception as e:
+                logger.error("Sink {} failed to process an event: {}".format(
+                    self._sink_name, e))
+
+                with self._condition:
+                    self._failed += 1
+            else:
+                with self._condition:
+                    self._processed += 1
+
+        self.close()
+
+        logger.debug("Sink {} stopped.".format(self._sink_name))
+
+    def stop(self):
+        """
+        Stop the execution of this sink after all queued events are
+        processed.
+        """
+        with self._condition:
+            self._should_stop = True
+            self._condition.notify_all()
+
+    @property
+    def sink_name(self):
+        """
+        Get the name of this sink.
+
+        :rtype: str
+        :return: The name of the sink.
+        """
+        return self._sink_name
+
+    @property
+    def statistics(self):
+        """
+        Get the statistics of this sink.
+
+        The lag is the time in seconds for which the oldest queued event is
+        already waiting.
+
+        :rtype: dict
+        :return: The number of submitted, processed, failed, dropped and queued
+                 events as well as the lag.
+        """
+        with self._condition:
+            if self._queue:
+                lag = monotonic() - self._queue[0][0]
+            else:
+                lag = 0.0
+
+            return {
+                'submitted': float(self._submitted),
+                'processed': float(self._processed),
+                'failed': float(self._failed),
+                'dropped': float(self._dropped),
+                'queued': float(len(self._queue)),
+                'lag': lag
+            }
+
+
+class LogFileSink(Sink):
+    """
+    A sink which writes every event as one line to a log file. Appended and
+    updated messages get lines of their own which are marked with their flags,
+    so the log shows every revision in the order in which it happened.
+    """
+
+    def __init__(self, path, capacity = 1024, overflow = Sink.DROP_OLDEST):
+        """
+        Constructor of the class.
+
+        :param path: The path of the log file.
+        :type path: str
+        :param capacity: The maximum number of events which are queued.
+                         (Defaults to 1024)
+        :type capacity: int
+        :param overflow: The policy which is applied if the queue is full.
+                         (Defaults to Sink.DROP_OLDEST)
+        :type overflow: str
+        """
+        super(LogFileSink, self).__init__("log", capacity, overflow)
+
+        self._file = open(path, 'a')
+
+    def process(self, event):
+        """
+        Write the event to the log file.
+
+        :param event: The event which should be processed.
+        :type event: dict
+        """
+        flags = ("A" if event['append'] else "-") + \
+                ("U" if event['update'] else "-")
+
+        self._file.write("{} {:9} {} {} [{}] {}: {}\n".format(
+            strftime("%Y-%m-%d %H:%M:%S", localtime(event['time'])),
+            event['kind'], event['program'], event['id'], flags,
+            event['subject'], event['body'].replace('\n', ' ')))
+
+        if not self._queue:
+            # Only flush if there is nothing else to write right now.
+            self._file.flush()
+
+    def close(self):
+        """
+        Close the log file.
+        """
+        self._file.close()
+
+
+class SocketSink(Sink):
+    """
+    A sink which sends every event as JSON line to all processes which are
+    connected to a local socket. Subscribers receive the events in order but
+    only from the moment they connected. Revisions are not merged, so
+    subscribers have to follow the references themselves.
+    """
+
+    def __init__(self, path, capacity = 1024, overflow = Sink.DROP_OLDEST):
+        """
+        Constructor of the class.
+
+        :param path: The path of the socket.
+        :type path: str
+        :param capacity: The maximum number of events which are queued.
+                         (Defaults to 1024)
+        :type capacity: int
+        :param overflow: The policy which is applied if the queue is full.
+                         (Defaults to Sink.DROP_OLDEST)
+        :type overflow: str
+        """
+        super(SocketSink, self).__init__("socket", capacity, overflow)
+
+        self._path = path
+
+        self._subscribers = []      #< The connected subscribers.
+        self._subscribers_lock = Lock() #< Lock for the subscribers.
+
+        makedirs(dirname(path) or '.', exist_ok=True)
+
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+
+        self._socket = socket(AF_UNIX, SOCK_STREAM)
+        self._socket.bind(path)
+        self._socket.listen(8)
+
+        self._acceptor = Thread(target=self._accept, daemon=True)
+        self._acceptor.start()
+
+    def _accept(self):
+        """
+        Accept new subscribers until the socket is closed.
+        """
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                break
+
+            logger.debug("New subscriber for the socket sink.")
+
+            # Subscribers which do not read their events in time are dropped.
+            connection.settimeout(1.0)
+
+            with self._subscribers_lock:
+                self._subscribers.append(connection)
+
+    def process(self, event):
+        """
+        Send the event to all subscribers. Subscribers which can not receive
+        it are dropped.
+
+        :param event: The event which should be processed.
+        :type event: dict
+        """
+        data = (dumps(event) + '\n').encode()
+
+        with self._subscribers_lock:
+            subscribers = self._subscribers[:]
+
+        for subscriber in subscribers:
+            try:
+                subscriber.sendall(data)
+            except OSError:
+                logger.debug("Drop subscriber of the socket sink.")
+
+                subscriber.close()
+                with self._subscribers_lock:
+                    self._subscribers.remove(subscriber)
+
+    def close(self):
+        """
+        Close the socket and all connections to subscribers.
+        """
+        self._socket.close()
+
+        with self._subscribers_lock:
+            for subscriber in self._subscribers:
+                subscriber.close()
+            self._subscribers = []
+
+        try:
+            remove(self._path)
+        except FileNotFoundError:
+            pass
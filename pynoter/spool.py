@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- spool
+#
+# The spool of the pynoter package. If the server can not be reached, clients
+# write their messages into a local spool directory instead of waiting for
+# the server. Each message is written into its own file, which only appears in
+# the spool once it is complete, so that the server can drain the spool while
+# clients still write into it and keep the order of the messages of each
+# program.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from json import dumps, loads
+
+from os import environ, getpid, getuid, listdir, lstat, makedirs, mkdir, \
+        remove, rename
+from os.path import join
+
+from stat import S_IMODE, S_ISDIR
+
+from time import time_ns
+
+from uuid import uuid4
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['SpoolWriter', 'default_spool_dir', 'drain_spool', 'private_dir',
+        'runtime_dir']
+
+
+def private_dir(path):
+    """
+    Create a directory which only the current user can access, or make sure
+    that the existing one is such a directory.
+
+    :param path: The path of the directory. Its parent must exist.
+    :type path: str
+    :rtype: str
+    :return: The path of the directory.
+    :raises RuntimeError: If the path is a symbolic link, not a directory, not
+                          owned by the current user or accessible by others.
+    """
+    try:
+        mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+
+    # Do not follow symbolic links, as another user could have placed one
+    # there before us.
+    status = lstat(path)
+
+    if not S_ISDIR(status.st_mode) or status.st_uid != getuid() or \
+            S_IMODE(status.st_mode) != 0o700:
+        raise RuntimeError(("Refuse to use {}, as it is not a private " +
+                "directory of the current user.").format(path))
+
+    return path
+
+
+def runtime_dir():
+    """
+    Get the directory where pynoter keeps runtime files of the current user.
+    The directory is created if necessary.
+
+    :rtype: str
+    :return: The path of the runtime directory.
+    :raises RuntimeError: If the directory is not private to the current user
+                          (see 'private_dir').
+    """
+    base = environ.get('XDG_RUNTIME_DIR')
+    if base is None:
+        # The fallback lives in a directory which everybody can write to, so
+        # another user could have created it first.
+        base = private_dir("/tmp/pynoter-{}".format(getuid()))
+
+    return private_dir(join(base, 'pynoter'))
+
+
+def default_spool_dir():
+    """
+    Get the default spool directory of the current user.
+
+    :rtype: str
+    :return: The path of the default spool directory.
+    """
+    return join(runtime_dir(), 'spool')
+
+
+def drain_spool(directory):
+    """
+    Take all messages out of the given spool directory.
+
+    The files are processed in the order in which they were created. Files
+    which clients still write are not yet named '*.spool' and are left alone.
+    Each file is renamed before it is read, so that two servers never display
+    the same message.
+
+    :param directory: The spool directory.
+    :type directory: str
+    :rtype: list[dict]
+    :return: The spooled messages in the order in which they were written.
+    """
+    try:
+        names = sorted(name for name in listdir(directory)
+                if name.endswith('.spool'))
+    except FileNotFoundError:
+        return []
+
+    records = []
+
+    for name in names:
+        path = join(directory, name)
+        draining = path + '.draining'
+
+        try:
+            rename(path, draining)
+        except FileNotFoundError:
+            continue
+
+        try:
+            with open(draining, 'r') as f:
+                records.append(loads(f.read()))
+        except ValueError:
+            logger.warning("Skip malformed spool file {}.".format(name))
+
+        remove(draining)
+
+    logger.debug("Drained {} messages from {} spool files.".format(
+        len(records), len(names)))
+
+    return records
+
+
+class SpoolWriter:
+    """
+    This class writes the messages of one client instance into the spool.
+    """
+
+    def __init__(self, directory, program_name, multi_client, lingering):
+        """
+        Constructor of the class.
+
+        :param directory: The spool directory.
+        :type directory: str
+        :param program_name: The name of the program which sends the messages.
+        :type program_name: str
+        :param multi_client: Flag which indicates if there are multiple clients
+                             for the same program which should be treated as
+                             one client.
+        :type multi_client: bool
+        :param lingering: Flag which indicates, that the handler for this
+                          client should stay alive even if the client vanishes.
+        :type lingering: bool
+        """
+        makedirs(directory, exist_ok=True)
+
+        # The time prefix keeps the files in the order in which the clients
+        # were started and the sequence number the messages of each client in
+        # the order in which they were written.
+        self._directory = directory
+        self._prefix = "{:020d}-{}-{}".format(time_ns(), getpid(),
+                uuid4().hex)
+        self._sequence = 0
+
+        self._program_name = program_name
+        self._multi_client = multi_client
+        self._lingering = lingering
+
+    def write(self, client, message_id, subject, body, icon, timeout, append,
+            update, reference, display_at = None):
+        """
+        Append a message to the spool.
+
+        The message is written into a temporary file which is renamed into
+        the spool once it is complete, so that the server never sees a
+        partially written message or loses one which it drains in the
+        meantime.
+
+        :param client: The identifier of the client.
+        :type client: str
+        :param message_id: The identifier of the message.
+        :type message_id: str
+        :param subject: The subject of the message.
+        :type subject: str
+        :param body: The body of the message.
+        :type body: str
+        :param icon: The icon of the message.
+        :type icon: str
+        :param timeout: The time in ms how long the message should be visible.
+        :type timeout: int
+        :param append: The append flag of the message.
+        :type append: bool
+        :param update: The update flag of the message.
+        :type update: bool
+        :param reference: The reference of the message as it would be sent to
+                          the server.
+        :type reference: str
+        :param display_at: The time (in s since the epoch) when the message
+                           should be displayed or None. (Defaults to None)
+        :type display_at: float
+        """
+        record = {
+            'program': self._program_name,
+            'multi_client': self._multi_client,
+            'lingering': self._lingering,
+            'client': client,
+            'id': message_id,
+            'subject': subject,
+            'body': body,
+            'icon': icon,
+            'timeout': timeout,
+            'append': append,
+            'update': update,
+            'reference': reference,
+            'display_at': display_at
+        }
+
+        name = join(self._directory, "{}-{:010d}".format(self._prefix,
+            self._sequence))
+        self._sequence += 1
+
+        with open(name + '.tmp', 'x') as f:
+            f.write(dumps(record))
+
+        rename(name + '.tmp', name + '.spool')
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- template
+#
+# The message templates of the pynoter package. Programs which send many
+# similar messages register the constant parts (subject, body, icon and
+# flags) once as a template and afterwards only send the arguments for its
+# placeholders. The placeholders use the syntax of 'str.format' with names,
+# e.g. '{host}' or '{percent:>3}'. Each format string is parsed only once and
+# the parsed form is shared by all templates which use it.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from functools import lru_cache
+
+from hashlib import sha1
+
+from json import dumps
+
+from re import compile as compile_regex
+
+from string import Formatter
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['Template']
+
+
+MAX_WIDTH = 1024                    #< The maximum width and precision of a
+                                    #  placeholder, as the server would
+                                    #  allocate the padding otherwise.
+
+NUMBER = compile_regex(r'\d+')      #< A number in a format specification.
+
+
+@lru_cache(maxsize=1024)
+def _compile(text):
+    """
+    Parse a format string into its literal parts and placeholders.
+
+    :param text: The format string.
+    :type text: str
+    :rtype: tuple
+    :return: The literal text, the name, the conversion and the format
+             specification of each part. The name is None for the last part
+             if it has no placeholder.
+    :raises ValueError: If the format string is malformed, uses positional,
+                        attribute or index placeholders or a too large width
+                        or precision.
+    """
+    parts = []
+
+    for literal, name, spec, conversion in Formatter().parse(text):
+        if name is not None:
+            if not name.isidentifier():
+                raise ValueError(("Only named placeholders are allowed, not " +
+                        "'{}'.").format(name))
+
+            if '{' in spec:
+                raise ValueError("Nested placeholders are not allowed.")
+
+            # Besides the width and the precision, a specification may only
+            # contain a single digit as fill character.
+            if any(int(n) > MAX_WIDTH for n in NUMBER.findall(spec)):
+                raise ValueError(("The width and precision of '{}' must not " +
+                        "exceed {}.").format(name, MAX_WIDTH))
+
+        parts.append((literal, name, conversion, spec))
+
+    return tuple(parts)
+
+
+def _render(parts, arguments):
+    """
+    Render a parsed format string with the given arguments.
+
+    :param parts: The parsed format string (see '_compile').
+    :type parts: tuple
+    :param arguments: The values of the placeholders.
+    :type arguments: dict[str, str]
+    :rtype: str
+    :return: The rendered text.
+    :raises ValueError: If an argument is missing.
+    """
+    result = []
+
+    for literal, name, conversion, spec in parts:
+        result.append(literal)
+
+        if name is None:
+            continue
+
+        try:
+            value = arguments[name]
+        except KeyError:
+            raise ValueError("The argument '{}' is missing.".format(name))
+
+        if conversion == 'r':
+            value = repr(value)
+        elif conversion == 'a':
+            value = ascii(value)
+
+        result.append(format(value, spec) if spec else str(value))
+
+    return ''.join(result)
+
+
+class Template:
+    """
+    This class represents a message template with named placeholders in its
+    subject, body and icon.
+    """
+
+    @staticmethod
+    def create_id(subject, body, icon, timeout, append, update):
+        """
+        Create the identifier of a template. The identifier only depends on
+        the content of the template, so registering the same template again
+        yields the same identifier.
+
+        :rtype: str
+        :return: The identifier of the template.
+        """
+        content = dumps([subject, body, icon, timeout, bool(append),
+            bool(update)])
+
+        return sha1(content.encode('utf-8')).hexdigest()[:16]
+
+    def __init__(self, subject, body = "", icon = "", timeout = 6000,
+            append = False, update = False):
+        """
+        Constructor of the class. The format strings are parsed here.
+
+        :param subject: The subject of the messages.
+        :type subject: str
+        :param body: The body of the messages. (Defaults to '')
+        :type body: str
+        :param icon: The icon of the messages. (Defaults to '')
+        :type icon: str
+        :param timeout: The time in ms how long the messages should be visible.
+                        (Defaults to 6000)
+        :type timeout: int
+        :param append: Flag which indicates whether the messages should be
+                       appended to the last one if possible. (Defaults to False)
+        :type append: bool
+        :param update: Flag which indicates whether the messages should replace
+                       the last one if possible. (Defaults to False)
+        :type update: bool
+        :raises ValueError: If one of the format strings is invalid.
+        """
+        self._id = Template.create_id(subject, body, icon, timeout, append,
+                update)
+        self._source = (subject, body, icon, timeout, bool(append),
+                bool(update))
+
+        self._subject = _compile(subject)
+        self._body = _compile(body)
+        self._icon = _compile(icon)
+
+        self._timeout = timeout
+        self._append = bool(append)
+        self._update = bool(update)
+
+    def render(self, arguments):
+        """
+        Fill in the placeholders of the template.
+
+        :param arguments: The values of the placeholders.
+        :type arguments: dict[str, str]
+        :rtype: (str, str, str)
+        :return: The subject, the body and the icon of the message.
+        :raises ValueError: If an argument is missing.
+        """
+        return (_render(self._subject, arguments),
+                _render(self._body, arguments),
+                _render(self._icon, arguments))
+
+    @property
+    def append(self):
+        """
+        Whether the messages should be appended to the last one.
+
+        :rtype: bool
+        :return: The append flag of the template.
+        """
+        return self._append
+
+    @property
+    def id(self):
+        """
+        Get the unique identifier of the template.
+
+        :rtype: str
+        :return: The identifier of the template.
+        """
+        return self._id
+
+    @property
+    def source(self):
+        """
+        Get the arguments with which the template was created.
+
+        :rtype: tuple
+        :return: The subject, body, icon, timeout, append and update flag.
+        """
+        return self._source
+
+    @property
+    def timeout(self):
+        """
+        Get the time in ms how long the messages should be visible.
+
+        :rtype: int
+        :return: The timeout of the template.
+        """
+        return self._timeout
+
+    @property
+    def update(self):
+        """
+        Whether the messages should replace the last one.
+
+        :rtype: bool
+        :return: The update flag of the template.
+        """
+        return self._update
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- trace
+#
+# The traffic trace of the pynoter package. The server can record every call
+# of its clients (get_handler, register, display_message and unregister) in
+# a compact binary file, so that a storm which happened in production can be
+# replayed against another server later on. Each record has a fixed size and
+# refers to its strings by index. A string is written only once, the first
+# time it is used. As message identifiers are rarely used twice, the table of
+# written strings is bounded. When it is full, a reset record starts a new
+# table, and the strings which are still in use are simply written again.
+# Subjects and bodies are not recorded at all, as they are
+# not needed to reproduce the load and may contain private information.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from struct import Struct
+
+from threading import Lock
+
+from time import monotonic, time
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['TraceRecorder', 'read_trace']
+
+
+MAGIC = b'PNTR\x02'                 #< The magic number and version at the
+                                    #  start of each trace file.
+
+MAGIC_V1 = b'PNTR\x01'              #< The magic number of traces without
+                                    #  reset records.
+
+START = Struct('<d')                #< The wall clock time when the recording
+                                    #  started.
+
+RECORD = Struct('<BdBIIIIi')        #< A record consisting of its kind, the
+                                    #  time since the start in s, the flags,
+                                    #  the indices of the program, the client,
+                                    #  the message and the reference and the
+                                    #  timeout of the message.
+
+LENGTH = Struct('<H')               #< The length of a string which follows.
+
+
+class TraceRecorder:
+    """
+    This class records the calls of the clients of a server into a trace file.
+
+    The recorder can be used from multiple threads. The records are buffered
+    and only written to disk in larger chunks.
+    """
+
+    STRING = 0                      #< Record kind which defines a string.
+    GET_HANDLER = 1                 #< Record kind for 'get_handler'.
+    REGISTER = 2                    #< Record kind for 'register'.
+    DISPLAY = 3                     #< Record kind for 'display_message'.
+    UNREGISTER = 4                  #< Record kind for 'unregister'.
+    RESET = 5                       #< Record kind which drops all strings.
+
+    MAX_STRINGS = 65536             #< The maximum number of strings in the
+                                    #  table before it is reset.
+
+    MULTI_CLIENT = 0x01             #< Flag for a multi client handler.
+    LINGERING = 0x02                #< Flag for a lingering handler.
+    APPEND = 0x04                   #< Flag for a message which appends.
+    UPDATE = 0x08                   #< Flag for a message which updates.
+
+    def __init__(self, path):
+        """
+        Constructor of the class. The trace file is created here and an
+        existing file is replaced.
+
+        :param path: The path of the trace file.
+        :type path: str
+        """
+        logger.debug("Record the traffic to {}.".format(path))
+
+        # Internal variables
+        self._file = open(path, 'wb')
+        self._start = monotonic()       #< The start of the recording.
+
+        self._strings = {'': 0}         #< The indices of all strings which
+                                        #  were written already.
+
+        self._records = 0               #< The number of recorded calls.
+
+        self._lock = Lock()             #< Lock for the file and the strings.
+
+        self._file.write(MAGIC)
+        self._file.write(START.pack(time()))
+
+    def _index(self, string):
+        """
+        Get the index of the given string and write it to the file if it is
+        used for the first time. The lock must be held.
+
+        :param string: The string.
+        :type string: str
+        :rtype: int
+        :return: The index of the string.
+        """
+        index = self._strings.get(string)
+
+        if index is None:
+            index = len(self._strings)
+            self._strings[string] = index
+
+            data = string.encode('utf-8')[:0xffff]
+
+            self._file.write(RECORD.pack(TraceRecorder.STRING, 0, 0, index,
+                0, 0, 0, 0))
+            self._file.write(LENGTH.pack(len(data)))
+            self._file.write(data)
+
+        return index
+
+    @staticmethod
+    def flags(multi_client = False, lingering = False, append = False,
+            update = False):
+        """
+        Combine the given flags of a call to the flags of a record.
+
+        :rtype: int
+        :return: The flags of the record.
+        """
+        return (TraceRecorder.MULTI_CLIENT if multi_client else 0) | \
+                (TraceRecorder.LINGERING if lingering else 0) | \
+                (TraceRecorder.APPEND if append else 0) | \
+                (TraceRecorder.UPDATE if update else 0)
+
+    def record(self, kind, flags, program, client = "", message = "",
+            reference = "", timeout = 0):
+        """
+        Record a call of a client.
+
+        :param kind: The kind of the call.
+        :type kind: int
+        :param flags: The flags of the call (see 'flags').
+        :type flags: int
+        :param program: The name of the program which called.
+        :type program: str
+        :param client: The identifier of the client which called or which
+                       registered. (Defaults to '')
+        :type client: str
+        :param message: The identifier of the message which was displayed.
+                        (Defaults to '')
+        :type message: str
+        :param reference: The reference of the message as given by the client.
+                          (Defaults to '')
+        :type reference: str
+        :param timeout: The timeout of the message in ms. (Defaults to 0)
+        :type timeout: int
+        """
+        with self._lock:
+            if self._file is None:
+                return
+
+            # Reset the table before the record, as all of its strings must
+            # be part of the same table.
+            if len(self._strings) + 4 > TraceRecorder.MAX_STRINGS:
+                self._file.write(RECORD.pack(TraceRecorder.RESET, 0, 0, 0, 0,
+                    0, 0, 0))
+                self._strings = {'': 0}
+
+            self._file.write(RECORD.pack(kind, monotonic() - self._start,
+                flags, self._index(program), self._index(client),
+                self._index(message), self._index(reference), timeout))
+
+            self._records += 1
+
+    def close(self):
+        """
+        Write all buffered records and close the trace file.
+        """
+        with self._lock:
+            if self._file is None:
+                return
+
+            logger.debug("Recorded {} calls.".format(self._records))
+
+            self._file.close()
+            self._file = None
+
+
+def read_trace(path):
+    """
+    Read the calls which were recorded in a trace file.
+
+    :param path: The path of the trace file.
+    :type path: str
+    :rtype: (float, list[tuple])
+    :return: The wall clock time when the recording started and the calls in
+             the order in which they were recorded. Each call is a tuple of
+             the kind, the time since the start in s, the flags, the program,
+             the client, the message, the reference and the timeout.
+    :raises ValueError: If the file is not a trace file.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if not data.startswith(MAGIC) and not data.startswith(MAGIC_V1):
+        raise ValueError("The file is not a pynoter trace.")
+
+    offset = len(MAGIC)
+    start, = START.unpack_from(data, offset)
+    offset += START.size
+
+    strings = ['']
+    calls = []
+
+    while offset + RECORD.size <= len(data):
+        kind, at, flags, program, client, message, reference, timeout = \
+                RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+
+        if kind == TraceRecorder.STRING:
+            if offset + LENGTH.size > len(data):
+                break
+
+            length, = LENGTH.unpack_from(data, offset)
+            offset += LENGTH.size
+
+            strings.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+            continue
+
+        if kind == TraceRecorder.RESET:
+            strings = ['']
+            continue
+
+        calls.append((kind, at, flags, strings[program], strings[client],
+            strings[message], strings[reference], timeout))
+
+    return start, calls
@@ -0,0 +1,618 @@
+#!/usr/bin/env python3
+
+###############################################################################
+# pynoter -- watch
+#
+# The log watcher of the pynoter package. The watcher follows files with
+# inotify, like 'tail -F', and matches each new line against a set of rules.
+# All rules are compiled once into a single regular expression, so a line is
+# scanned by one match call, no matter how many rules there are. The first
+# rule which matches a line turns it into a message, whose subject, body and
+# icon are templates (see 'pynoter.template') filled with the named groups of
+# the rule. All messages are sent through one client.
+#
+# License: GPLv3
+#
+# (c) Till Smejkal - till.smejkal+pynoter@ossmail.de
+###############################################################################
+
+from dbus.exceptions import DBusException
+
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+
+from json import load
+
+from os import O_CLOEXEC, O_NONBLOCK, close, fsencode, fstat, pipe, read, \
+        set_blocking, strerror, write
+from os.path import abspath, basename, dirname
+
+from re import IGNORECASE, compile as compile_regex, error as RegexError
+
+from select import select
+
+from struct import Struct
+
+from pynoter.template import Template
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['LogWatcher', 'Rule', 'RuleSet', 'load_rules']
+
+
+class Rule:
+    """
+    This class represents a rule which turns matching lines into messages.
+
+    Besides the named groups of the pattern, the templates may use the
+    placeholders '{line}', '{file}' and '{rule}'.
+    """
+
+    BUILTINS = ('line', 'file', 'rule') #< The placeholders of every rule.
+
+    def __init__(self, pattern, subject, body = "{line}", icon = "",
+            timeout = 6000, append = False, update = False,
+            ignore_case = False, name = None):
+        """
+        Constructor of the class. The pattern and the templates are checked
+        here.
+
+        :param pattern: The regular expression which a line must contain.
+        :type pattern: str
+        :param subject: The template of the subject of the messages.
+        :type subject: str
+        :param body: The template of the body of the messages.
+                     (Defaults to '{line}')
+        :type body: str
+        :param icon: The template of the icon of the messages.
+                     (Defaults to '')
+        :type icon: str
+        :param timeout: The time in ms how long the messages should be visible.
+                        (Defaults to 6000)
+        :type timeout: int
+        :param append: Flag which indicates whether each message should be
+                       appended to the previous message of this rule.
+                       (Defaults to False)
+        :type append: bool
+        :param update: Flag which indicates whether each message should replace
+                       the previous message of this rule. (Defaults to False)
+        :type update: bool
+        :param ignore_case: Flag which indicates whether the pattern ignores
+                            the case. (Defaults to False)
+        :type ignore_case: bool
+        :param name: The name of the rule. (Defaults to the pattern)
+        :type name: str
+        :raises ValueError: If the pattern or one of the templates is invalid.
+        """
+        try:
+            regex = compile_regex(pattern, IGNORECASE if ignore_case else 0)
+        except RegexError as e:
+            raise ValueError("Invalid pattern '{}': {}".format(pattern, e))
+
+        # The groups are renamed in the combined expression, which breaks
+        # references to groups by their number.
+        if compile_regex(r'(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(\d').search(pattern):
+            raise ValueError(("The pattern '{}' must reference groups by " +
+                    "name.").format(pattern))
+
+        self.pattern = pattern
+        self.ignore_case = ignore_case
+        self.name = name if name is not None else pattern
+        self.groups = tuple(regex.groupindex)
+        self.template = Template(subject, body, icon, timeout, append, update)
+
+        # Fill in all placeholders once, so that unknown ones are reported
+        # now and not for the first matching line.
+        self.template.render(dict.fromkeys(self.groups + Rule.BUILTINS, ""))
+
+
+class RuleSet:
+    """
+    This class combines rules into one regular expression.
+    """
+
+    FLAGS = compile_regex(r'\(\?([aiLmsux]+)\)') #< Inline flags which apply
+                                    #  to the whole pattern.
+
+    GROUP = compile_regex(r'(?<!\\)((?:\\\\)*)\((\?P[<=]|\?\()(\w+)([>)])')
+                                    #< The definitions of and references to
+                                    #  named groups.
+
+    @staticmethod
+    def _scope_flags(pattern):
+        """
+        Turn the inline flags at the start of a pattern into flags which only
+        apply to the pattern, as global flags are only allowed at the start
+        of the combined expression.
+
+        :param pattern: The pattern.
+        :type pattern: str
+        :rtype: str
+        :return: The pattern with scoped flags.
+        """
+        flags = ""
+
+        match = RuleSet.FLAGS.match(pattern)
+        while match is not None:
+            flags += match.group(1)
+            pattern = pattern[match.end():]
+            match = RuleSet.FLAGS.match(pattern)
+
+        if not flags:
+            return pattern
+
+        # A comment of a verbose pattern must not hide the closing
+        # parenthesis.
+        return "(?{}:{}{})".format(flags, pattern,
+                "\n" if 'x' in flags else "")
+
+    def __init__(self, rules):
+        """
+        Constructor of the class. The combined expression is compiled here.
+
+        :param rules: The rules in the order of their priority.
+        :type rules: list[Rule]
+        :raises ValueError: If no rule is given or a rule can not be combined
+                            with the others.
+        """
+        if not rules:
+            raise ValueError("At least one rule is needed.")
+
+        self._rules = list(rules)
+
+        # Each rule becomes a lookahead which searches the whole line. The
+        # alternatives are tried in order, so the first matching rule wins,
+        # even if a later one matches further left. The groups are prefixed
+        # with the index of their rule, as names must be unique.
+        alternatives = []
+        self._groups = []               #< The renamed groups of each rule.
+
+        for index, rule in enumerate(self._rules):
+            prefix = "_r{}_".format(index)
+
+            pattern = RuleSet.GROUP.sub(lambda m: "{}({}{}{}{}".format(
+                m.group(1), m.group(2), prefix, m.group(3), m.group(4)),
+                RuleSet._scope_flags(rule.pattern))
+
+            if rule.ignore_case:
+                pattern = "(?i:{})".format(pattern)
+
+            alternative = "(?=.*?(?P<_r{}>{}))".format(index, pattern)
+
+            try:
+                compile_regex(alternative)
+            except RegexError as e:
+                raise ValueError("The pattern of rule '{}' can not be "
+                        "combined with the others: {}".format(rule.name, e))
+
+            alternatives.append(alternative)
+            self._groups.append([(prefix + group, group)
+                for group in rule.groups])
+
+        try:
+            self._regex = compile_regex("|".join(alternatives))
+        except RegexError as e:
+            raise ValueError("The rules can not be combined: {}".format(e))
+
+    def match(self, line, path = ""):
+        """
+        Find the first rule which matches the given line.
+
+        :param line: The line.
+        :type line: str
+        :param path: The path of the file of the line. (Defaults to '')
+        :type path: str
+        :rtype: (Rule, dict[str, str])
+        :return: The rule and the values of its placeholders or None if no
+                 rule matches.
+        """
+        match = self._regex.match(line)
+        if match is None:
+            return None
+
+        index = int(match.lastgroup[2:])
+        rule = self._rules[index]
+
+        arguments = {'line': line, 'file': path, 'rule': rule.name}
+        for renamed, group in self._groups[index]:
+            arguments[group] = match.group(renamed) or ""
+
+        return rule, arguments
+
+    @property
+    def rules(self):
+        """
+        Get the rules in the order of their priority.
+
+        :rtype: list[Rule]
+        :return: The rules.
+        """
+        return list(self._rules)
+
+
+def load_rules(path):
+    """
+    Load rules from a JSON file. The file contains a list of objects with the
+    parameters of 'Rule', e.g.
+
+        [{"pattern": "error: (?P<what>.*)", "subject": "Build failed",
+          "body": "{what}", "icon": "dialog-error"}]
+
+    :param path: The path of the file.
+    :type path: str
+    :rtype: list[Rule]
+    :return: The rules.
+    :raises ValueError: If the file does not describe valid rules.
+    """
+    with open(path) as f:
+        entries = load(f)
+
+    if not isinstance(entries, list):
+        raise ValueError("The rules must be a list.")
+
+    rules = []
+
+    for entry in entries:
+        try:
+            rules.append(Rule(**entry))
+        except TypeError as e:
+            raise ValueError("Invalid rule {}: {}".format(entry, e))
+
+    return rules
+
+
+class _Inotify:
+    """
+    This class is a minimal wrapper of the inotify interface of Linux.
+    """
+
+    MODIFY = 0x00000002             #< The file was modified.
+    MOVED_TO = 0x00000080           #< A file was moved into the directory.
+    CREATE = 0x00000100             #< A file was created in the directory.
+
+    EVENT = Struct('iIII')          #< The header of an event.
+
+    _libc = None                    #< The C library.
+
+    def __init__(self):
+        """
+        Constructor of the class. The inotify instance is created here.
+
+        :raises RuntimeError: If inotify is not available.
+        """
+        if _Inotify._libc is None:
+            try:
+                _Inotify._libc = CDLL(find_library('c') or 'libc.so.6',
+                        use_errno=True)
+                _Inotify._libc.inotify_init1
+            except (OSError, AttributeError):
+                raise RuntimeError("inotify is not available.")
+
+        self._fd = _Inotify._libc.inotify_init1(O_NONBLOCK | O_CLOEXEC)
+        if self._fd < 0:
+            raise RuntimeError("Failed to initialize inotify: {}".format(
+                strerror(get_errno())))
+
+    def add_watch(self, path, mask):
+        """
+        Watch a file or directory.
+
+        :param path: The path of the file or directory.
+        :type path: str
+        :param mask: The events which should be reported.
+        :type mask: int
+        :rtype: int
+        :return: The watch descriptor or -1 if the path can not be watched.
+        """
+        return _Inotify._libc.inotify_add_watch(self._fd, fsencode(path),
+                mask)
+
+    def remove_watch(self, wd):
+        """
+        Stop watching a file or directory.
+
+        :param wd: The watch descriptor.
+        :type wd: int
+        """
+        _Inotify._libc.inotify_rm_watch(self._fd, wd)
+
+    def read(self):
+        """
+        Read the pending events.
+
+        :rtype: list[(int, int, str)]
+        :return: The watch descriptor, the mask and the name of each event.
+        """
+        try:
+            data = read(self._fd, 65536)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, length = _Inotify.EVENT.unpack_from(data, offset)
+            offset += _Inotify.EVENT.size
+
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            events.append((wd, mask, name.decode(errors='replace')))
+
+        return events
+
+    def close(self):
+        """
+        Close the inotify instance.
+        """
+        close(self._fd)
+
+    def fileno(self):
+        """
+        Get the file descriptor of the inotify instance.
+
+        :rtype: int
+        :return: The file descriptor.
+        """
+        return self._fd
+
+
+class _FollowedFile:
+    """
+    This class reads the lines which are appended to a file.
+    """
+
+    MAX_LINE = 65536                #< Longer lines are split.
+
+    def __init__(self, path):
+        """
+        Constructor of the class.
+
+        :param path: The absolute path of the file.
+        :type path: str
+        """
+        self.path = path
+        self.wd = -1                #< The watch descriptor of the file.
+
+        # Internal variables
+        self._file = None           #< The opened file.
+        self._partial = b''         #< The last line if it is not complete.
+
+    def open(self, from_start):
+        """
+        Open the file, closing the previously opened one.
+
+        :param from_start: Flag which indicates whether the lines which are in
+                           the file already are read.
+        :type from_start: bool
+        :rtype: bool
+        :return: Whether or not the file exists.
+        """
+        self.close()
+
+        try:
+            self._file = open(self.path, 'rb')
+        except OSError:
+            return False
+
+        if not from_start:
+            self._file.seek(0, 2)
+
+        return True
+
+    def lines(self):
+        """
+        Read the complete lines which were appended since the last call.
+
+        :rtype: list[str]
+        :return: The new lines.
+        """
+        if self._file is None:
+            return []
+
+        if fstat(self._file.fileno()).st_size < self._file.tell():
+            # The file was truncated.
+            logger.debug("{} was truncated.".format(self.path))
+
+            self._file.seek(0)
+            self._partial = b''
+
+        data = self._partial + self._file.read()
+        lines = data.split(b'\n')
+
+        self._partial = lines.pop()
+        if len(self._partial) > _FollowedFile.MAX_LINE:
+            lines.append(self._partial)
+            self._partial = b''
+
+        return [line.decode(errors='replace').rstrip('\r') for line in lines]
+
+    def close(self):
+        """
+        Close the file.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        self._partial = b''
+
+
+class LogWatcher:
+    """
+    This class follows files and turns their matching lines into messages.
+    Files which are rotated, truncated or created later on are followed as
+    well.
+    """
+
+    def __init__(self, client, rules, paths):
+        """
+        Constructor of the class.
+
+        :param client: The client which sends the messages.
+        :type client: Client
+        :param rules: The rules for the lines.
+        :type rules: RuleSet
+        :param paths: The paths of the files which should be followed.
+        :type paths: list[str]
+        :raises RuntimeError: If inotify is not available.
+        """
+        # Internal variables
+        self._client = client
+        self._rules = rules
+
+        self._inotify = _Inotify()
+
+        self._files = [_FollowedFile(abspath(p)) for p in paths]
+        self._by_wd = {}            #< The file of each file watch.
+        self._directories = {}      #< The files in each watched directory by
+                                    #  their name, by watch descriptor.
+
+        self._last = {}             #< The id of the last message of each rule.
+
+        self._wakeup = pipe()       #< Pipe which interrupts the loop.
+        for fd in self._wakeup:
+            set_blocking(fd, False)
+
+        self._running = False
+
+    def _watch(self, followed):
+        """
+        Watch a file which was opened (again).
+
+        :param followed: The file.
+        :type followed: _FollowedFile
+        """
+        followed.wd = self._inotify.add_watch(followed.path, _Inotify.MODIFY)
+
+        if followed.wd >= 0:
+            self._by_wd[followed.wd] = followed
+
+    def _handle(self, followed):
+        """
+        Send the messages for the new lines of a file.
+
+        :param followed: The file.
+        :type followed: _FollowedFile
+        """
+        for line in followed.lines():
+            result = self._rules.match(line, followed.path)
+            if result is None:
+                continue
+
+            rule, arguments = result
+            template = rule.template
+
+            subject, body, icon = template.render(arguments)
+
+            if template.update or template.append:
+                # Refer to the previous message of the same rule, not to the
+                # last message of the client.
+                reference = self._last.get(rule, "")
+            else:
+                reference = None
+
+            try:
+                self._last[rule] = self._client.display_message(subject,
+                        body, icon, template.timeout, template.append,
+                        template.update, reference)
+            except DBusException as e:
+                # The message or an earlier batch of the client was lost, e.g.
+                # due to a transient bus error. Keep following the files.
+                logger.error("Failed to display a message for {}: {}".format(
+                    followed.path, e))
+
+    def _reopen(self, followed):
+        """
+        Follow the new file at the path of a file which was rotated.
+
+        :param followed: The file.
+        :type followed: _FollowedFile
+        """
+        logger.debug("Reopen {}.".format(followed.path))
+
+        # Do not miss the last lines of the old file.
+        self._handle(followed)
+
+        if self._by_wd.pop(followed.wd, None) is not None:
+            self._inotify.remove_watch(followed.wd)
+
+        if followed.open(True):
+            self._watch(followed)
+            self._handle(followed)
+
+    def run(self):
+        """
+        Follow the files until 'stop' is called.
+        """
+        for followed in self._files:
+            # Watch the directory as well, to notice when the file is created
+            # or replaced by a rotated one.
+            wd = self._inotify.add_watch(dirname(followed.path),
+                    _Inotify.CREATE | _Inotify.MOVED_TO)
+            if wd < 0:
+                logger.warning("Can not watch the directory of {}.".format(
+                    followed.path))
+            else:
+                self._directories.setdefault(wd, {})[
+                        basename(followed.path)] = followed
+
+            if followed.open(False):
+                self._watch(followed)
+            else:
+                logger.info("Wait for {} to be created.".format(
+                    followed.path))
+
+        self._running = True
+
+        while self._running:
+            ready, _, _ = select([self._inotify, self._wakeup[0]], [], [])
+
+            if self._wakeup[0] in ready:
+                try:
+                    read(self._wakeup[0], 64)
+                except BlockingIOError:
+                    pass
+
+            modified = []
+
+            for wd, event, name in self._inotify.read():
+                files = self._directories.get(wd)
+
+                if files is not None:
+                    followed = files.get(name)
+                    if followed is not None:
+                        self._reopen(followed)
+                elif event & _Inotify.MODIFY:
+                    followed = self._by_wd.get(wd)
+                    if followed is not None and followed not in modified:
+                        modified.append(followed)
+
+            # Several modifications of a file are handled at once.
+            for followed in modified:
+                self._handle(followed)
+
+        for followed in self._files:
+            followed.close()
+
+        self._inotify.close()
+
+        for fd in self._wakeup:
+            close(fd)
+
+    def stop(self):
+        """
+        Stop following the files. This can be called from any thread or a
+        signal handler.
+        """
+        self._running = False
+
+        try:
+            write(self._wakeup[1], b'\0')
+        except BlockingIOError:
+            pass